@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: latency of small requests while large results are served
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Serves a component's message and discovery handlers from one IOLoop.
+Some client threads repeatedly POST a query whose (cached) result has
+many rows, while others GET a capability. Reports the latency of the
+capability requests, once with large messages encoded on the IOLoop
+and once with them offloaded to the codec thread pool.
+
+Usage: PYTHONPATH=. python3 bench/http_latency.py [--rows R] [--heavy H] [--light L] [--seconds S]
+
+"""
+
+import argparse
+import asyncio
+import sys
+import threading
+import time
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import urllib3
+
+import mplane.component
+import mplane.model
+import mplane.scheduler
+import mplane.tls
+
+class BulkService(mplane.scheduler.Service):
+    def __init__(self, capability, rows):
+        super(BulkService, self).__init__(capability)
+        self.rows = rows
+
+    def run(self, specification, check_interrupt):
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2000-01-01 00:00:00 ... 2000-01-01 00:00:01")
+        for i in range(self.rows):
+            res.set_result_value("source.ip4", "10.0.%u.%u" % ((i >> 8) & 255, i & 255), i)
+            res.set_result_value("octets.ip", i * 1500, i)
+        return res
+
+def serve(scheduler, sockets, started):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    tls = mplane.tls.TlsState(None)
+    application = tornado.web.Application([
+        (r"/", mplane.component.MessagePostHandler,
+            {'scheduler': scheduler, 'tlsState': tls}),
+        (r"/capability/.*", mplane.component.DiscoveryHandler,
+            {'scheduler': scheduler, 'tlsState': tls, 'config': None}),
+    ])
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    started.set()
+    tornado.ioloop.IOLoop.current().start()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_load(port, spec_json, cap_path, heavy, light, seconds):
+    stop = threading.Event()
+    latencies = []
+    heavy_done = [0]
+
+    def heavy_client():
+        pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+        while not stop.is_set():
+            pool.urlopen("POST", "/", body=spec_json,
+                         headers={"content-type": "application/x-mplane+json"})
+            heavy_done[0] += 1
+
+    def light_client():
+        pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+        while not stop.is_set():
+            start = time.perf_counter()
+            pool.urlopen("GET", cap_path)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+    threads = [threading.Thread(target=heavy_client) for i in range(heavy)] + \
+              [threading.Thread(target=light_client) for i in range(light)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return (latencies, heavy_done[0])
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP handler latency benchmark")
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--heavy', type=int, default=2)
+    parser.add_argument('--light', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    cap = mplane.model.Capability(label="bench-bulk", verb=mplane.model.VERB_QUERY,
+                                  when="past ... now")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("source.ip4")
+    cap.add_result_column("octets.ip")
+    spec = mplane.model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.1.1.1")
+    spec.set_when("2000-01-01 00:00:00 + 1s")
+
+    scheduler = mplane.scheduler.Scheduler({"Component": {
+                    "scheduler_query_cache": {"bench-bulk": {"ttl": 3600}}}})
+    scheduler.add_service(BulkService(cap, args.rows))
+
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    started = threading.Event()
+    threading.Thread(target=serve, args=(scheduler, sockets, started), daemon=True).start()
+    started.wait()
+
+    # fill the query cache
+    spec_json = mplane.model.unparse_json(spec).encode("utf-8")
+    pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+    pool.urlopen("POST", "/", body=spec_json,
+                 headers={"content-type": "application/x-mplane+json"})
+    cap_path = "/capability/" + cap.get_token()
+
+    print("%u result rows, %u heavy and %u light clients, %.0f s" %
+          (args.rows, args.heavy, args.light, args.seconds))
+    offload_rows = mplane.model.CODEC_OFFLOAD_ROWS
+    for (name, rows) in (("inline", sys.maxsize), ("offload", offload_rows)):
+        mplane.model.CODEC_OFFLOAD_ROWS = rows
+        (latencies, heavy_done) = run_load(port, spec_json, cap_path,
+                                           args.heavy, args.light, args.seconds)
+        print("%-8s light p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms  (%u light, %u heavy)" %
+              (name, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+               max(latencies) * 1000, len(latencies), heavy_done))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: concurrent I/O-bound measurements on the event loop
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Runs many concurrent jobs of a coroutine Service which waits on I/O
+(simulated by asyncio.sleep), and reports the elapsed time and the
+number of threads in use while they run.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_async.py [--jobs N] [--wait S]
+
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+import mplane.model
+import mplane.scheduler
+
+class WaitService(mplane.scheduler.Service):
+    def __init__(self, capability, wait):
+        super(WaitService, self).__init__(capability)
+        self.wait = wait
+
+    async def run(self, specification, check_interrupt):
+        await asyncio.sleep(self.wait)
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2000-01-01 00:00:00 ... 2000-01-01 00:00:01")
+        res.set_result_value("delay.twoway.icmp.us.min", 1000)
+        return res
+
+def main():
+    parser = argparse.ArgumentParser(description="Coroutine service benchmark")
+    parser.add_argument('--jobs', type=int, default=5000)
+    parser.add_argument('--wait', type=float, default=2.0)
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    cap = mplane.model.Capability(label="bench-wait", when="now ... future")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("delay.twoway.icmp.us.min")
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(WaitService(cap, args.wait))
+
+    done = threading.Semaphore(0)
+    start = time.perf_counter()
+    for i in range(args.jobs):
+        spec = mplane.model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4",
+                                 "10.%u.%u.%u" % ((i >> 16) & 255, (i >> 8) & 255, i & 255))
+        spec.set_when("now + 10m")
+        scheduler.submit_job(user=None, specification=spec,
+                             callback=lambda receipt: done.release())
+    submitted = time.perf_counter() - start
+
+    time.sleep(args.wait / 2)
+    threads = threading.active_count()
+    for i in range(args.jobs):
+        done.acquire()
+    elapsed = time.perf_counter() - start
+
+    failed = sum(1 for job in scheduler.jobs.values() if job.failed())
+    print("%u jobs waiting %.1f s each" % (args.jobs, args.wait))
+    print("submitted in:  %8.3f s" % submitted)
+    print("completed in:  %8.3f s  (%u failed)" % (elapsed, failed))
+    print("threads while running: %u" % threads)
+
+if __name__ == "__main__":
+    main()
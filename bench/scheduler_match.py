@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: specification matching in Scheduler.submit_job
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Measures the cost of matching Specifications to Services in a Scheduler
+holding many services (as a supervisor wrapping thousands of
+RelayServices would), comparing the schema-indexed lookup in
+Scheduler.submit_job against a linear scan over all services.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_match.py [--services N] [--specs M]
+
+"""
+
+import argparse
+import itertools
+import random
+import time
+
+import mplane.model
+import mplane.scheduler
+
+class NullService(mplane.scheduler.Service):
+    def run(self, specification, check_interrupt):
+        return mplane.model.Result(specification=specification)
+
+def make_services(count):
+    """
+    Create count services whose capabilities have distinct
+    source addresses and a spread of different schemas.
+
+    """
+    columns = ["delay.twoway.icmp.us.min", "delay.twoway.icmp.us.mean",
+               "delay.twoway.icmp.us.max", "delay.twoway.icmp.count",
+               "packets.lost", "octets.ip", "packets.ip", "rtt.ms",
+               "hops.ip", "flows"]
+    schemas = list(itertools.chain.from_iterable(
+                    itertools.combinations(columns, n) for n in (3, 4)))
+
+    services = []
+    for i in range(count):
+        cap = mplane.model.Capability(label="bench-"+str(i),
+                                      when="now ... future / 1s")
+        cap.add_parameter("source.ip4", "10.%u.%u.%u" %
+                          ((i >> 16) & 255, (i >> 8) & 255, i & 255))
+        cap.add_parameter("destination.ip4")
+        for col in schemas[i % len(schemas)]:
+            cap.add_result_column(col)
+        services.append(NullService(cap))
+    return services
+
+def make_specs(services, count):
+    specs = []
+    for service in random.sample(services, count):
+        spec = mplane.model.Specification(capability=service.capability())
+        spec.set_parameter_value("destination.ip4", "192.0.2.1")
+        spec.set_when("now + 1s / 1s")
+        specs.append(spec)
+    return specs
+
+def linear_match(services, spec):
+    for service in services:
+        if spec.fulfills(service.capability()):
+            return service
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Scheduler matching benchmark")
+    parser.add_argument('--services', type=int, default=10000)
+    parser.add_argument('--specs', type=int, default=200)
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+    random.seed(42)
+
+    services = make_services(args.services)
+    scheduler = mplane.scheduler.Scheduler()
+    start = time.perf_counter()
+    for service in services:
+        scheduler.add_service(service)
+    add_time = time.perf_counter() - start
+
+    specs = make_specs(services, min(args.specs, len(services)))
+
+    start = time.perf_counter()
+    for spec in specs:
+        linear_match(services, spec)
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for spec in specs:
+        assert scheduler.match_service(spec) is not None
+    indexed_time = time.perf_counter() - start
+
+    print("%u services (%u schemas), %u specifications" %
+          (len(services), len(scheduler._services_by_schema), len(specs)))
+    print("add_service:   %8.3f ms total" % (add_time * 1000))
+    print("linear scan:   %8.3f ms/spec" % (linear_time * 1000 / len(specs)))
+    print("schema index:  %8.3f ms/spec" % (indexed_time * 1000 / len(specs)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: thread vs. process execution of CPU-bound services
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Runs a batch of CPU-bound jobs through a Scheduler, once with the
+service in thread execution mode and once in process execution mode,
+and reports the throughput of each.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_processes.py [--jobs N] [--work W] [--processes P]
+
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import mplane.model
+import mplane.scheduler
+
+class BusyService(mplane.scheduler.Service):
+    def __init__(self, capability, work):
+        super(BusyService, self).__init__(capability)
+        self.work = work
+
+    def run(self, specification, check_interrupt):
+        acc = 0
+        for i in range(self.work):
+            acc += i * i
+            if i % 100000 == 0 and check_interrupt():
+                break
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2000-01-01 00:00:00 ... 2000-01-01 00:00:01")
+        res.set_result_value("octets.ip", acc % 1000000)
+        return res
+
+class ProcessBusyService(BusyService):
+    execution_mode = mplane.scheduler.EXECUTION_PROCESS
+
+def run_batch(service_class, jobs, work, processes):
+    cap = mplane.model.Capability(label="bench-busy", when="now ... future")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("octets.ip")
+
+    config = {"Component": {"scheduler_processes": processes}}
+    scheduler = mplane.scheduler.Scheduler(config)
+    scheduler.add_service(service_class(cap, work))
+
+    done = threading.Semaphore(0)
+    start = time.perf_counter()
+    for i in range(jobs):
+        spec = mplane.model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4", "10.0.%u.%u" % (i >> 8, i & 255))
+        spec.set_when("now + 10m")
+        scheduler.submit_job(user=None, specification=spec,
+                             callback=lambda receipt: done.release())
+    for i in range(jobs):
+        done.acquire()
+    elapsed = time.perf_counter() - start
+
+    failed = sum(1 for job in scheduler.jobs.values() if job.failed())
+    scheduler.processes.shutdown()
+    return (elapsed, failed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Process execution benchmark")
+    parser.add_argument('--jobs', type=int, default=32)
+    parser.add_argument('--work', type=int, default=2000000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    print("%u jobs, %u iterations each, %u processes" %
+          (args.jobs, args.work, args.processes))
+    for (name, service_class) in (("thread", BusyService),
+                                  ("process", ProcessBusyService)):
+        (elapsed, failed) = run_batch(service_class, args.jobs, args.work, args.processes)
+        print("%-8s %8.3f s  %6.2f jobs/s  (%u failed)" %
+              (name, elapsed, args.jobs / elapsed, failed))
+
+if __name__ == "__main__":
+    main()
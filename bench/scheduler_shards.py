@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: scaling of the sharded scheduler with the number of shards
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Submits a batch of CPU-bound jobs from several client threads to a
+ShardedScheduler, redeeming each job's result, for increasing numbers
+of shards, and reports the throughput of each. Jobs run on the shards'
+worker threads, so the speedup is bounded by the number of CPUs.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_shards.py [--jobs N] [--work W] [--clients C] [--shards 1,2,4,8]
+
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import mplane.model
+import mplane.scheduler
+import mplane.shard
+
+class BusyService(mplane.scheduler.Service):
+    def __init__(self, capability, work):
+        super(BusyService, self).__init__(capability)
+        self.work = work
+
+    def run(self, specification, check_interrupt):
+        acc = 0
+        for i in range(self.work):
+            acc += i * i
+            if i % 100000 == 0 and check_interrupt():
+                break
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2000-01-01 00:00:00 ... 2000-01-01 00:00:01")
+        res.set_result_value("octets.ip", acc % 1000000)
+        return res
+
+def client(scheduler, cap, first, count, failures):
+    receipts = []
+    for i in range(first, first + count):
+        spec = mplane.model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4", "10.%u.%u.%u" % (i >> 16, (i >> 8) & 255, i & 255))
+        spec.set_when("now + 10m")
+        receipts.append(scheduler.process_message("bench", spec))
+
+    for receipt in receipts:
+        redemption = mplane.model.Redemption(receipt=receipt)
+        while True:
+            reply = scheduler.process_message("bench", redemption)
+            if not isinstance(reply, mplane.model.Receipt):
+                break
+            time.sleep(0.01)
+        if not isinstance(reply, mplane.model.Result):
+            failures.append(reply)
+
+def run_batch(shards, jobs, work, clients):
+    cap = mplane.model.Capability(label="bench-busy", when="now ... future")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("octets.ip")
+
+    scheduler = mplane.shard.ShardedScheduler(None, [BusyService(cap, work)], shards)
+
+    failures = []
+    per_client = jobs // clients
+    threads = [threading.Thread(target=client,
+                                args=(scheduler, cap, c * per_client, per_client, failures))
+               for c in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    scheduler.shutdown()
+    return (elapsed, per_client * clients, len(failures))
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded scheduler benchmark")
+    parser.add_argument('--jobs', type=int, default=64)
+    parser.add_argument('--work', type=int, default=1000000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--shards', default="1,2,4,8")
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    print("%u jobs, %u iterations each, %u clients, %u CPUs" %
+          (args.jobs, args.work, args.clients, os.cpu_count()))
+    baseline = None
+    for shards in [int(n) for n in args.shards.split(",")]:
+        (elapsed, jobs, failed) = run_batch(shards, args.jobs, args.work, args.clients)
+        if baseline is None:
+            baseline = elapsed
+        print("%2u shards %8.3f s  %6.2f jobs/s  x%.2f  (%u failed)" %
+              (shards, elapsed, jobs / elapsed, baseline / elapsed, failed))
+
+if __name__ == "__main__":
+    main()
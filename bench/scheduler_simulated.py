@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: repeated specifications run in simulated time
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Submits a number of repeated specifications with a 1-second period to
+a Scheduler on a simulated clock, advances the clock through their
+schedule, and reports the real time taken, i.e. the scheduler overhead
+per run, with the speedup over running the schedule in real time.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_simulated.py [--jobs N] [--seconds S]
+
+"""
+
+import argparse
+import time
+
+import mplane.clock
+import mplane.model
+import mplane.scheduler
+
+class TickService(mplane.scheduler.Service):
+    def run(self, specification, check_interrupt):
+        now = mplane.clock.utcnow()
+        res = mplane.model.Result(specification=specification)
+        res.set_when(mplane.model.When(a=now, b=now))
+        res.set_result_value("packets.lost", 0)
+        return res
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated clock benchmark")
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--seconds', type=int, default=60)
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+    clock = mplane.clock.SimulatedClock()
+    mplane.clock.set_clock(clock)
+
+    cap = mplane.model.Capability(label="bench-tick", when="now ... future / 1s")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("packets.lost")
+
+    # keep only the latest result of each job
+    scheduler = mplane.scheduler.Scheduler({"Component": {"scheduler_max_results": 1}})
+    scheduler.add_service(TickService(cap))
+
+    start = time.perf_counter()
+    for i in range(args.jobs):
+        spec = mplane.model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4", "10.%u.%u.%u" % (i >> 16, (i >> 8) & 255, i & 255))
+        spec.set_when("repeat now + %us / 1s { now + 0s / 1s }" % args.seconds)
+        scheduler.submit_job(user=None, specification=spec)
+    submitted = time.perf_counter()
+
+    clock.advance(args.seconds + 1, settle=scheduler.pool.join)
+    elapsed = time.perf_counter() - submitted
+
+    runs = scheduler.pool.stats()["submitted"]
+    failed = sum(1 for job in scheduler.jobs.values() if job.failed())
+    print("%u jobs, %u simulated seconds" % (args.jobs, args.seconds))
+    print("submit  %8.3f s" % (submitted - start))
+    print("run     %8.3f s  %u runs  %6.1f us/run  x%.0f real time  (%u failed)" %
+          (elapsed, runs, elapsed * 1e6 / runs, args.seconds / elapsed, failed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+##
+# mPlane Software Development Kit
+# Benchmark: timer overhead of scheduled and repeated specifications
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+
+"""
+Submits many future-scheduled repeated specifications to a Scheduler
+and reports the number of live threads, the timer backlog, and the lag
+between timer deadlines and their firing, before interrupting all jobs.
+
+Usage: PYTHONPATH=. python3 bench/scheduler_timers.py [--specs N] [--delay D] [--seconds S]
+
+"""
+
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mplane.model
+import mplane.scheduler
+
+class NullService(mplane.scheduler.Service):
+    def run(self, specification, check_interrupt):
+        return mplane.model.Result(specification=specification)
+
+def main():
+    parser = argparse.ArgumentParser(description="Scheduler timer benchmark")
+    parser.add_argument('--specs', type=int, default=10000)
+    parser.add_argument('--delay', type=float, default=5.0,
+                        help="seconds until the jobs start")
+    parser.add_argument('--seconds', type=float, default=8.0,
+                        help="seconds to wait before reporting")
+    args = parser.parse_args()
+
+    mplane.model.initialize_registry()
+
+    cap = mplane.model.Capability(label="bench-timers",
+                                  when="now ... future / 1s")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("delay.twoway.icmp.us.min")
+
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(NullService(cap))
+
+    # every job starts after a delay, and may run for ten minutes
+    start_at = datetime.utcnow() + timedelta(seconds=args.delay)
+    when = (mplane.model.unparse_time(start_at)+" ... "+
+            mplane.model.unparse_time(start_at + timedelta(minutes=10))+" / 1s")
+
+    threads_before = threading.active_count()
+    start = time.perf_counter()
+    for i in range(args.specs):
+        spec = mplane.model.Specification(capability=cap)
+        spec.set_parameter_value("destination.ip4",
+                                 "10.%u.%u.%u" % ((i >> 16) & 255, (i >> 8) & 255, i & 255))
+        spec.set_when(when)
+        scheduler.submit_job(user=None, specification=spec)
+    submit_time = time.perf_counter() - start
+
+    time.sleep(args.seconds)
+    stats = scheduler.timers.stats()
+
+    print("%u specifications submitted in %.3f s" % (args.specs, submit_time))
+    print("threads:       %u (was %u)" % (threading.active_count(), threads_before))
+    print("timer backlog: %u" % stats["backlog"])
+    print("timers fired:  %u" % stats["fired"])
+    print("lag mean/max:  %.3f / %.3f ms" %
+          (stats["lag_mean"] * 1000, stats["lag_max"] * 1000))
+
+    start = time.perf_counter()
+    for job in list(scheduler.jobs.values()):
+        job.interrupt()
+    print("interrupt all: %.3f s, backlog now %u" %
+          (time.perf_counter() - start, scheduler.timers.backlog()))
+
+if __name__ == "__main__":
+    main()
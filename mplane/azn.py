@@ -22,6 +22,10 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import threading
+import time
+import mplane.metrics
+
 # Factory function to create Authorization ON or OFF object
 def Authorization(config=None):
     if config is None:
@@ -37,6 +41,14 @@ class AuthorizationOff(object):
     def check(self, cap, identity):
         return True
 
+    def identity_class(self, identity):
+        """
+        Return a key shared by all identities authorized to use the same
+        capabilities; without authorization, all identities share one.
+
+        """
+        return None
+
 always_authorized = AuthorizationOff()
 
 class AuthorizationOn(object):
@@ -66,3 +78,303 @@ class AuthorizationOn(object):
                 if identity in self.role_id[role]:
                     return True
         return False
+
+    def identity_class(self, identity):
+        """
+        Return a key shared by all identities authorized to use the same
+        capabilities: the set of roles of the identity.
+
+        """
+        return frozenset(role for role in self.role_id if identity in self.role_id[role])
+
+_LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+
+class EndpointAccess(object):
+    """
+    Decides which peers may read an HTTP endpoint (e.g. metrics) enabled
+    by a section of the configuration, from the list of roles defined
+    in the "Roles" section of the "Access" section that the section's
+    "roles" key gives.
+
+    With TLS, only identities in those roles are served; if there is no
+    "roles" key, every identity is served if the endpoint is open by
+    default, and none otherwise. Without TLS, peers have no identity:
+    an endpoint open by default is served to every peer, others only to
+    peers on the loopback interface.
+
+    """
+    def __init__(self, config, section, open_default=True):
+        self.secure = config is not None and "TLS" in config
+        self.open_default = open_default
+        self.identities = None
+        if config is not None and section in config and "roles" in config[section]:
+            role_id = config.get("Access", {}).get("Roles", {})
+            self.identities = set()
+            for role in config[section]["roles"]:
+                if role not in role_id:
+                    raise ValueError("Unknown role '"+role+"' in "+section+" section of conf file. "
+                                     "See documentation for details")
+                self.identities.update(role_id[role])
+
+    def check(self, identity, remote_ip):
+        """Return True if the given peer may read the endpoint."""
+        if not self.secure:
+            return self.open_default or remote_ip in _LOOPBACK_ADDRESSES
+        if self.identities is None:
+            return self.open_default
+        return identity in self.identities
+
+DEFAULT_PRIORITY_CLASS = "default"
+
+class Priorities(object):
+    """
+    Maps capabilities and identities to priority classes, each with a
+    weight giving its share of the scheduler's worker threads, from the
+    optional "Priorities" section of the "Access" section.
+
+    """
+    def __init__(self, config=None):
+        self.weights = {DEFAULT_PRIORITY_CLASS: 1.0}
+        self.cap_class = {}
+        self.id_class = {}
+        self.role_id = {}
+        self.default = DEFAULT_PRIORITY_CLASS
+
+        if config is not None and "Access" in config and "Priorities" in config["Access"]:
+            priorities = config["Access"]["Priorities"]
+            for name in priorities.get("classes", {}):
+                self.weights[name] = float(priorities["classes"][name])
+            self.cap_class = priorities.get("capabilities", {})
+            self.id_class = priorities.get("identities", {})
+            self.default = priorities.get("default", DEFAULT_PRIORITY_CLASS)
+            self.role_id = config["Access"].get("Roles", {})
+
+            for name in [self.default] + list(self.cap_class.values()) + list(self.id_class.values()):
+                if name not in self.weights:
+                    raise ValueError("Unknown priority class '"+name+"' in conf file. "
+                                     "See documentation for details")
+
+    def classify(self, cap, identity):
+        """
+        Return the name and weight of the priority class of runs of
+        the given capability for the given identity: the class of the
+        capability's label if there is one, else that of the identity
+        or of one of its roles, else the default class.
+
+        """
+        name = self.cap_class.get(cap.get_label(), None)
+        if name is None and identity is not None:
+            name = self.id_class.get(identity, None)
+            if name is None:
+                for role in self.role_id:
+                    if role in self.id_class and identity in self.role_id[role]:
+                        name = self.id_class[role]
+                        break
+        if name is None:
+            name = self.default
+        return (name, self.weights[name])
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at rate tokens per second, holding at most
+    burst tokens. Tokens can be taken only while enough are available,
+    or charged after the fact, leaving the bucket in debt.
+
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(self.rate, 1)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, n=1):
+        """Take n tokens if available, returning True, else False."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def charge(self, n):
+        """Take n tokens, whether or not they are available."""
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+
+    def level(self):
+        """Return the number of tokens available (negative if in debt)."""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+_limit_rejections = mplane.metrics.Counter("mplane_limit_rejections_total",
+                    "Specifications rejected by admission limits",
+                    ("scope", "name", "limit"))
+
+LIMIT_IDENTITY = "identity"
+LIMIT_CAPABILITY = "capability"
+
+# idle limit states are evicted once this many are held
+MAX_LIMIT_STATES = 10000
+
+class _LimitState(object):
+    def __init__(self, limits):
+        self.limits = limits
+        self.jobs = 0
+        self.submissions = None
+        self.rows = None
+        if "rate" in limits:
+            self.submissions = TokenBucket(limits["rate"], limits.get("burst", None))
+        if "rows_per_hour" in limits:
+            self.rows = TokenBucket(float(limits["rows_per_hour"]) / 3600,
+                                    limits["rows_per_hour"])
+
+    def idle(self):
+        # no jobs running, and buckets full: as good as a new state
+        return (self.jobs == 0 and
+                (self.submissions is None or self.submissions.level() >= self.submissions.burst) and
+                (self.rows is None or self.rows.level() >= self.rows.burst))
+
+class Limits(object):
+    """
+    Admission limits for specifications per identity and per capability,
+    from the optional "Limits" section of the "Access" section: a rate of
+    submissions per second (a token bucket), a number of concurrent jobs,
+    and a number of result rows per hour.
+
+    Identity limits apply to each identity separately; those configured
+    for a role apply to each identity in the role, and the default limits
+    to every other identity. Capability limits are shared by all
+    identities using the capability.
+
+    The state of the limits of an identity or capability is dropped
+    once it is idle, i.e. no job is running and its buckets are full.
+
+    """
+    def __init__(self, config=None):
+        self.default = None
+        self.id_limits = {}
+        self.cap_limits = {}
+        self.role_id = {}
+        self._states = {}
+        self._lock = threading.Lock()
+
+        if config is not None and "Access" in config and "Limits" in config["Access"]:
+            limits = config["Access"]["Limits"]
+            self.default = limits.get("default", None)
+            self.id_limits = limits.get("identities", {})
+            self.cap_limits = limits.get("capabilities", {})
+            self.role_id = config["Access"].get("Roles", {})
+
+    def _identity_limits(self, identity):
+        if identity in self.id_limits:
+            return self.id_limits[identity]
+        for role in self.role_id:
+            if role in self.id_limits and identity in self.role_id[role]:
+                return self.id_limits[role]
+        return self.default
+
+    def _state(self, scope, name, limits):
+        key = (scope, name)
+        with self._lock:
+            state = self._states.get(key, None)
+            if state is None:
+                if len(self._states) >= MAX_LIMIT_STATES:
+                    self._prune()
+                state = _LimitState(limits)
+                self._states[key] = state
+            return state
+
+    def _prune(self):
+        for key in [key for (key, state) in self._states.items() if state.idle()]:
+            del self._states[key]
+
+    def prune(self):
+        """Drop the state of idle limits; returns the number of states held."""
+        with self._lock:
+            self._prune()
+            return len(self._states)
+
+    def _admit(self, scope, name, limits):
+        state = self._state(scope, name, limits)
+        if "jobs" in limits and state.jobs >= int(limits["jobs"]):
+            reason = "jobs"
+        elif state.rows is not None and state.rows.level() <= 0:
+            reason = "rows_per_hour"
+        elif state.submissions is not None and not state.submissions.take():
+            reason = "rate"
+        else:
+            return None
+        _limit_rejections.inc(scope, name, reason)
+        return "Limit exceeded: "+reason+" for "+scope+" "+str(name)
+
+    def admit_identity(self, identity):
+        """
+        Count a submission by an identity against its limits. Returns
+        None if it is admitted, or the reason it is not.
+
+        """
+        limits = self._identity_limits(identity)
+        if limits is None:
+            return None
+        return self._admit(LIMIT_IDENTITY, identity, limits)
+
+    def admit_capability(self, cap):
+        """
+        Count a submission for a capability against its limits. Returns
+        None if it is admitted, or the reason it is not.
+
+        """
+        limits = self.cap_limits.get(cap.get_label(), None)
+        if limits is None:
+            return None
+        return self._admit(LIMIT_CAPABILITY, cap.get_label(), limits)
+
+    def _states_for(self, identity, cap):
+        states = []
+        limits = self._identity_limits(identity)
+        if limits is not None:
+            states.append(self._state(LIMIT_IDENTITY, identity, limits))
+        limits = self.cap_limits.get(cap.get_label(), None)
+        if limits is not None:
+            states.append(self._state(LIMIT_CAPABILITY, cap.get_label(), limits))
+        return states
+
+    def job_started(self, identity, cap):
+        """Count a job started for an identity and capability."""
+        for state in self._states_for(identity, cap):
+            with self._lock:
+                state.jobs += 1
+
+    def job_ended(self, identity, cap, rows):
+        """Count a job ended, having produced the given number of rows."""
+        for state in self._states_for(identity, cap):
+            with self._lock:
+                if state.jobs > 0:
+                    state.jobs -= 1
+            if state.rows is not None:
+                state.rows.charge(rows)
+
+    def stats(self):
+        """
+        Return a dictionary mapping "scope name" to the concurrent jobs,
+        and submission and row tokens available, of each limited
+        identity and capability seen.
+
+        """
+        with self._lock:
+            items = list(self._states.items())
+        return {scope+" "+str(name): {
+                    "jobs": state.jobs,
+                    "submissions": state.submissions.level() if state.submissions else None,
+                    "rows": state.rows.level() if state.rows else None }
+                for ((scope, name), state) in items}
@@ -23,7 +23,12 @@
 
 import mplane.model
 import mplane.utils
-from datetime import datetime
+import mplane.azn
+import mplane.metrics
+import mplane.profiling
+from datetime import datetime, timedelta
+import threading
+import time
 
 import html.parser
 import urllib3
@@ -42,6 +47,8 @@ import queue
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
+import tornado.concurrent
+import tornado.gen
 
 import logging
 
@@ -56,6 +63,12 @@ DEFAULT_REGISTRATION_PATH = "register/capability"
 DEFAULT_SPECIFICATION_PATH = "show/specification"
 DEFAULT_RESULT_PATH = "register/result"
 
+# prefer a single Envelope of capabilities to a page of links to them
+DISCOVERY_ACCEPT = "application/x-mplane+json, text/html;q=0.9"
+
+# max seconds a specification poll is held until specifications are queued
+MAX_LONG_POLL = 60
+
 logger = logging.getLogger(__name__)
 
 class BaseClient(object):
@@ -69,6 +82,7 @@ class BaseClient(object):
 
     def __init__(self, tls_state, supervisor=False, exporter=None):
         self._tls_state = tls_state
+        self._result_sinks = []
         self.reset()
         self._ssn = -1
         self._supervisor = supervisor
@@ -84,6 +98,8 @@ class BaseClient(object):
         self._receipt_labels = {}
         self._results = {}
         self._result_labels = {}
+        # tokens of results of which only some rows have been received
+        self._partial_tokens = set()
         # structures for capability expiration after timeout
         self._capability_timeouts = {}
         self._capabilities_by_identity = {}
@@ -259,11 +275,13 @@ class BaseClient(object):
         # FIXME check the result identity against where we sent the specification to
         self._add_result(msg, identity)
 
-    def _add_result(self, msg, identity=None):
+    def _add_result(self, msg, identity=None, partial=False):
         """
         Add a result to internal state. The result will supercede any receipt
         stored for the same token, and will be recallable by token, and,
-        if present, by label.
+        if present, by label. The rows of a Result following a partial
+        result (a batch of rows from a running measurement) for the same
+        token are appended to it.
 
         Internal use only; use handle_message instead.
 
@@ -285,16 +303,43 @@ class BaseClient(object):
                 self._remove_receipt(receipt)
         except KeyError:
             pass
-        self._results[msg.get_token()] = msg
+
+        token = msg.get_token()
+        if token in self._partial_tokens and isinstance(msg, mplane.model.Result):
+            self._results[token].append_rows(msg)
+        else:
+            self._results[token] = msg
+        if partial:
+            self._partial_tokens.add(token)
+        else:
+            self._partial_tokens.discard(token)
+
+        # sinks are given the rows merged so far, and write those they
+        # have not yet written
+        for sink in self._result_sinks:
+            sink.write_message(self._results[token])
 
         if not isinstance(msg, mplane.model.Exception):
             if msg.get_label():
-                self._result_labels[msg.get_label()] = msg
+                self._result_labels[msg.get_label()] = self._results[token]
         else:
             # Exceptions are only added to result_labels if a receipt existed in receipts -WHY
             if receipt is not None:
                 self._result_labels[receipt.get_label()] = msg
 
+    def add_result_sink(self, sink):
+        """
+        Attach a sink (e.g. an :class:`mplane.exporter.ResultWriter`)
+        to which every Result or Envelope of results will be written
+        as it is received.
+
+        """
+        self._result_sinks.append(sink)
+
+    def remove_result_sink(self, sink):
+        """Detach a previously attached result sink."""
+        self._result_sinks.remove(sink)
+
     def _remove_result(self, msg):
         token = msg.get_token()
         if token in self._results:
@@ -324,6 +369,16 @@ class BaseClient(object):
     def _handle_exception(self, msg, identity):
         self._add_result(msg)
 
+    def _handle_partial_result(self, msg, identity):
+        # an envelope of rows from a running measurement, and its receipt
+        for imsg in msg.messages():
+            if isinstance(imsg, mplane.model.Result):
+                if self._supervisor:
+                    self._exporter.put_nowait([imsg, identity])
+                self._add_result(imsg, identity, partial=True)
+            elif isinstance(imsg, mplane.model.Receipt):
+                self._add_receipt(imsg, identity)
+
     def handle_message(self, msg, identity=None):
         """
         Handle a message. Used internally to process
@@ -347,7 +402,9 @@ class BaseClient(object):
         elif isinstance(msg, mplane.model.Exception):
             self._handle_exception(msg, identity)
         elif isinstance(msg, mplane.model.Envelope):
-            if msg.get_token() in self._receipts:
+            if any(isinstance(imsg, mplane.model.Receipt) for imsg in msg.messages()):
+                self._handle_partial_result(msg, identity)
+            elif msg.get_token() in self._receipts:
                 self._handle_result(msg, identity)
             else:
                 for imsg in msg.messages():
@@ -359,6 +416,7 @@ class BaseClient(object):
         """
         forget all receipts and results for the given token or label
         """
+        self._partial_tokens.discard(token_or_label)
         if token_or_label in self._result_labels:
             result = self._result_labels[token_or_label]
             del self._result_labels[token_or_label]
@@ -562,7 +620,10 @@ class HttpInitiatorClient(BaseClient):
     def retrieve_capabilities(self, url, urlchain=[], pool=None, identity=None):
         """
         Connect to the given URL, retrieve and process the
-        capabilities/withdrawals found there
+        capabilities/withdrawals found there. Components listing their
+        capabilities in a single Envelope are asked for it; pages of
+        links to capabilities, as served by older components, are
+        crawled instead.
         """
 
         # detect loops in capability links
@@ -585,10 +646,10 @@ class HttpInitiatorClient(BaseClient):
                 raise ValueError("HttpInitiatorClient capability retrieval missing connection pool")
 
         if url.path is not None:
-            path = url.path
+            path = url.request_uri
         else:
             path = "/"
-        res = pool.request('GET', path)
+        res = pool.request('GET', path, headers={"Accept": DISCOVERY_ACCEPT})
 
         if res.status == 200:
             ctype = res.getheader("Content-Type")
@@ -633,6 +694,11 @@ class HttpListenerClient(BaseClient):
             if "port" in self.config["Client"]["Listener"]:
                 listen_port = int(self.config["Client"]["Listener"]["port"])
 
+            # registered capabilities, queued specifications and results
+            # live in this process
+            if int(self.config["Client"]["Listener"].get("workers", 1)) > 1:
+                raise ValueError("HttpListenerClient does not support several workers")
+
             if "capability-path" in self.config["Client"]["Listener"]:
                 self.registration_path = self.config["Client"]["Listener"]["capability-path"]
 
@@ -668,8 +734,11 @@ class HttpListenerClient(BaseClient):
         if not self.result_path.startswith("/"):
             self.result_path = "/" + self.result_path
 
-        # Outgoing messages per component identifier
+        # Outgoing messages per component identifier, and the long polls
+        # waiting for them; messages may be queued from any thread
         self._outgoing = {}
+        self._outgoing_waiters = {}
+        self._outgoing_lock = threading.Lock()
 
         # specification serial number
         # used to create labels programmatically
@@ -679,14 +748,27 @@ class HttpListenerClient(BaseClient):
         self._callback_capability = {}
 
         # Create a request handler pointing at this client
-        self._tornado_application = tornado.web.Application([
+        handlers = [
             (self.registration_path, InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (self.registration_path + "/", InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (self.specification_path, InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (self.specification_path + "/", InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (self.result_path, InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
             (self.result_path + "/", InteractionsHandler, {'listenerclient': self, 'tlsState': self._tls_state}),
-        ])
+        ]
+        metrics_path = mplane.metrics.configure(config)
+        if metrics_path is not None:
+            handlers.append((metrics_path, mplane.metrics.MetricsHandler,
+                             {'tlsState': self._tls_state,
+                              'access': mplane.azn.EndpointAccess(config, "Metrics")}))
+        diagnostics_path = mplane.profiling.configure(config)
+        if diagnostics_path is not None:
+            # diagnostics expose code and memory: closed unless configured
+            handlers.append((diagnostics_path, mplane.profiling.DiagnosticsHandler,
+                             {'tlsState': self._tls_state,
+                              'access': mplane.azn.EndpointAccess(config, "Profiling",
+                                                                  open_default=False)}))
+        self._tornado_application = tornado.web.Application(handlers)
         http_server = tornado.httpserver.HTTPServer(self._tornado_application, ssl_options=tls_state.get_ssl_options())
 
         # run the server
@@ -696,13 +778,12 @@ class HttpListenerClient(BaseClient):
         else:
             http_server.listen(listen_port)
 
-        if io_loop is not None:
-            cli_t = Thread(target=self.listen_in_background(io_loop))
-            timeout_callback = tornado.ioloop.PeriodicCallback(self._check_timeouts, 5000, io_loop)
-        else:
-            cli_t = Thread(target=self.listen_in_background)
-            timeout_callback = tornado.ioloop.PeriodicCallback(self._check_timeouts, 5000)
+        # the server and the timeout callback are registered with this
+        # thread's IOLoop, which the background thread runs
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        timeout_callback = tornado.ioloop.PeriodicCallback(self._check_timeouts, 5000)
         timeout_callback.start()
+        cli_t = Thread(target=self.listen_in_background, args=(io_loop,))
         cli_t.daemon = True
         cli_t.start()
 
@@ -710,11 +791,16 @@ class HttpListenerClient(BaseClient):
         """ The server listens for requests in background """
 
         if io_loop is None:
-            tornado.ioloop.IOLoop.instance().start()
+            self._io_loop.start()
 
     def _check_timeouts(self):
         """ Checks if capabilities are expired, and if so, delete them """
 
+        # components waiting in a long poll are alive
+        for identity in list(self._outgoing_waiters):
+            for token in self._capabilities_by_identity.get(identity, []):
+                self._capability_timeouts[token] = datetime.utcnow()
+
         expired_tokens = []
         for token in self._capability_timeouts:
             interval = datetime.utcnow() - self._capability_timeouts[token]
@@ -726,9 +812,43 @@ class HttpListenerClient(BaseClient):
             self.handle_message(cap_withdraw, self.identity_for(token))
 
     def _push_outgoing(self, identity, msg):
-        if identity not in self._outgoing:
-            self._outgoing[identity] = []
-        self._outgoing[identity].append(msg)
+        with self._outgoing_lock:
+            if identity not in self._outgoing:
+                self._outgoing[identity] = []
+            self._outgoing[identity].append(msg)
+            waiters = self._outgoing_waiters.pop(identity, [])
+
+        # wake the long polls of the identity
+        for (io_loop, future) in waiters:
+            io_loop.add_callback(_set_future_done, future)
+
+    def _pop_outgoing(self, identity):
+        with self._outgoing_lock:
+            return self._outgoing.pop(identity, [])
+
+    async def _wait_outgoing(self, identity, timeout, wake):
+        """
+        Wait until messages are queued for an identity, timeout seconds
+        pass, or the future wake is done.
+
+        """
+        waiter = (tornado.ioloop.IOLoop.current(), wake)
+        with self._outgoing_lock:
+            if len(self._outgoing.get(identity, [])):
+                return
+            self._outgoing_waiters.setdefault(identity, []).append(waiter)
+
+        try:
+            await tornado.gen.with_timeout(timedelta(seconds=timeout), wake)
+        except tornado.gen.TimeoutError:
+            pass
+        finally:
+            with self._outgoing_lock:
+                waiters = self._outgoing_waiters.get(identity, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                    if len(waiters) == 0:
+                        del self._outgoing_waiters[identity]
 
     def invoke_capability(self, cap_tol, when, params, relabel=None, callback_when=None):
         """
@@ -788,16 +908,31 @@ class MPlaneHandler(tornado.web.RequestHandler):
 
     """
 
-    def _respond_message(self, msg):
+    async def _respond_message(self, msg):
         """
         Returns an HTTP response containing a JSON message
 
         """
         self.set_status(200)
         self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
+        unparse_start = time.monotonic()
+        body = await mplane.model.unparse_json_async(msg)
+        mplane.metrics.serialization_seconds.observe(time.monotonic() - unparse_start)
+        self.write(body)
         self.finish()
 
+    def prepare(self):
+        self._profiling_span = mplane.profiling.span(mplane.profiling.HTTP,
+                                                     self.__class__.__name__)
+        self._profiling_span.__enter__()
+
+    def on_finish(self):
+        mplane.metrics.http_request_seconds.observe(self.request.request_time(),
+                                                    self.__class__.__name__)
+        span = getattr(self, "_profiling_span", None)
+        if span is not None:
+            span.__exit__(None, None, None)
+
     def _respond_plain_text(self, code, text = None):
         """
         Returns an HTTP response containing a plain text message
@@ -820,6 +955,10 @@ class MPlaneHandler(tornado.web.RequestHandler):
             self.write(text)
         self.finish()
 
+def _set_future_done(future):
+    if not future.done():
+        future.set_result(None)
+
 # FIXME figure out what this class is for
 class InteractionsHandler(MPlaneHandler):
     """
@@ -827,7 +966,9 @@ class InteractionsHandler(MPlaneHandler):
     Each capability is registered independently
 
     Exposes the specifications, that will be periodically pulled by the
-    components
+    components. Components passing a wait argument (in seconds) are
+    answered once specifications are queued for them, or when the wait
+    ends, rather than at once.
 
     Receives results of specifications
 
@@ -835,16 +976,25 @@ class InteractionsHandler(MPlaneHandler):
     def initialize(self, listenerclient, tlsState):
         self._listenerclient = listenerclient
         self._tls = tlsState
+        self._wake = None
+        self._closed = False
+
+    def on_connection_close(self):
+        # end a long poll, leaving queued specifications for the next
+        self._closed = True
+        if self._wake is not None and not self._wake.done():
+            self._wake.set_result(None)
 
-    def post(self):
+    async def post(self):
         """
-        Receives POST requests that may contain Capabilities, Results, Receipts and Exceptions
+        Receives POST requests that may contain Capabilities, Results, Receipts and Exceptions.
+        Large messages are decoded on the codec thread pool.
 
         """
 
         # unwrap json message from body
         if self.request.headers["Content-Type"] == "application/x-mplane+json":
-            env = mplane.model.parse_json(self.request.body.decode("utf-8"))
+            env = await mplane.model.parse_json_async(self.request.body.decode("utf-8"))
         else:
             self._respond_plain_text(400, "Invalid format")
             return
@@ -926,7 +1076,7 @@ class InteractionsHandler(MPlaneHandler):
         return response
 
     # FIXME here's where the 428 comes from, noncompliant, see issue #4
-    def get(self):
+    async def get(self):
         """
         Receives GET specification requests
         """
@@ -943,7 +1093,17 @@ class InteractionsHandler(MPlaneHandler):
                 for token in self._listenerclient._capabilities_by_identity[identity]:
                     self._listenerclient._capability_timeouts[token] = datetime.utcnow()
 
-                specs = self._listenerclient._outgoing.pop(identity, [])
+                try:
+                    wait = min(float(self.get_argument("wait", 0)), MAX_LONG_POLL)
+                except ValueError:
+                    wait = 0
+                if wait > 0:
+                    self._wake = tornado.concurrent.Future()
+                    await self._listenerclient._wait_outgoing(identity, wait, self._wake)
+                    if self._closed:
+                        return
+
+                specs = self._listenerclient._pop_outgoing(identity)
                 env = mplane.model.Envelope()
                 for spec in specs:
 
@@ -963,7 +1123,7 @@ class InteractionsHandler(MPlaneHandler):
                     else:
                         logger.info("[fixme] Interrupt " + spec.get_token() + " successfully pulled by " + identity)
 
-                self._respond_json_text(200, mplane.model.unparse_json(env))
+                self._respond_json_text(200, await mplane.model.unparse_json_async(env))
             else:
                 self._respond_plain_text(428, "not registered")
         else:
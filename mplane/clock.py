@@ -0,0 +1,172 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Pluggable clocks
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Pluggable clocks for temporal scopes and scheduling.
+
+The current time used by :class:`mplane.model.When` and by the
+scheduler's jobs, timers and caches is read from the clock set with
+:func:`set_clock`, which defaults to the system clock.
+
+A :class:`SimulatedClock` only moves when told to. Timer queues using a
+simulated clock do not run a timer thread; instead,
+:meth:`SimulatedClock.advance` steps virtual time from one timer
+deadline to the next, firing the timers on the calling thread. This
+runs long repeated schedules in a fraction of real time, and
+reproduces their timing deterministically.
+
+"""
+
+from datetime import datetime, timedelta
+import threading
+import weakref
+import time
+
+_EPOCH = datetime(1970, 1, 1)
+
+class SystemClock(object):
+    """Reads the system clock."""
+
+    simulated = False
+
+    def utcnow(self):
+        """Return the current UTC time as a naive datetime."""
+        return datetime.utcnow()
+
+    def monotonic(self):
+        """Return seconds on a clock which never goes backwards."""
+        return time.monotonic()
+
+    def timestamp(self):
+        """Return the current time in seconds since the epoch."""
+        return time.time()
+
+    def attach(self, queue):
+        """Timer queues on the system clock run their own thread."""
+        pass
+
+    def detach(self, queue):
+        """Timer queues on the system clock run their own thread."""
+        pass
+
+class SimulatedClock(object):
+    """
+    A virtual clock starting at a given UTC datetime (default the
+    current time, to the second), advanced only by :meth:`advance`.
+    Attached timer queues are referenced weakly, so a discarded queue
+    (e.g. that of a discarded scheduler) is not kept alive by the clock.
+
+    """
+
+    simulated = True
+
+    def __init__(self, start=None):
+        super(SimulatedClock, self).__init__()
+        if start is None:
+            start = datetime.utcnow().replace(microsecond=0)
+        self._start = start
+        self._elapsed = 0.0
+        self._queues = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<SimulatedClock at "+str(self.utcnow())+">"
+
+    def utcnow(self):
+        """Return the current virtual UTC time."""
+        return self._start + timedelta(seconds=self._elapsed)
+
+    def monotonic(self):
+        """Return virtual seconds elapsed since the clock started."""
+        return self._elapsed
+
+    def timestamp(self):
+        """Return the current virtual time in seconds since the epoch."""
+        return (self._start - _EPOCH).total_seconds() + self._elapsed
+
+    def attach(self, queue):
+        """Drive a timer queue from this clock."""
+        with self._lock:
+            self._queues.append(weakref.ref(queue))
+
+    def detach(self, queue):
+        """Stop driving a timer queue from this clock."""
+        with self._lock:
+            self._queues = [r for r in self._queues
+                            if r() is not None and r() is not queue]
+
+    def advance(self, seconds, settle=None):
+        """
+        Advance virtual time by the given number of seconds, stopping at
+        each timer deadline on the way to fire the timers due, in order,
+        on the calling thread. If given, settle() is called after the
+        timers of each deadline have fired, e.g. to wait for the work
+        they started. Returns the number of timers fired.
+
+        """
+        target = self._elapsed + seconds
+        fired = 0
+        while True:
+            with self._lock:
+                self._queues = [r for r in self._queues if r() is not None]
+                queues = [q for q in (r() for r in self._queues) if q is not None]
+            deadlines = [d for d in (q.next_deadline() for q in queues) if d is not None]
+            if len(deadlines) == 0 or min(deadlines) > target:
+                break
+            self._elapsed = max(self._elapsed, min(deadlines))
+            for queue in queues:
+                fired += queue.fire_due()
+            if settle is not None:
+                settle()
+        self._elapsed = target
+        return fired
+
+_clock = SystemClock()
+
+def get_clock():
+    """Return the clock in use."""
+    return _clock
+
+def set_clock(clock):
+    """
+    Set the clock in use; None restores the system clock. Timer queues
+    bind to the clock in use when they are created, so the clock should
+    be set before creating schedulers.
+
+    """
+    global _clock
+    if clock is None:
+        clock = SystemClock()
+    _clock = clock
+
+def utcnow():
+    """Return the current UTC time on the clock in use."""
+    return _clock.utcnow()
+
+def monotonic():
+    """Return seconds on the monotonic clock in use."""
+    return _clock.monotonic()
+
+def timestamp():
+    """Return seconds since the epoch on the clock in use."""
+    return _clock.timestamp()
@@ -27,15 +27,30 @@ import mplane.utils
 import mplane.model
 import mplane.azn
 import mplane.tls
+import mplane.metrics
+import mplane.profiling
+import mplane.shard
+import concurrent.futures
 import importlib
 import logging
 import tornado.web
 import tornado.httpserver
-from datetime import datetime
+import tornado.netutil
+import tornado.concurrent
+import tornado.ioloop
+import tornado.gen
+from datetime import datetime, timedelta, timezone
+import email.utils
+import multiprocessing.connection
+import multiprocessing
+import hashlib
+import pickle
+import copy
 import time
 from time import sleep
 import urllib3
 import threading
+import weakref
 import socket
 import random
 
@@ -53,7 +68,6 @@ import json
 logger = logging.getLogger(__name__)
 
 DEFAULT_MPLANE_PORT = 8890
-SLEEP_QUANTUM = 0.250
 RETRY_QUANTUM = 5
 CAPABILITY_PATH_ELEM = "capability"
 SPECIFICATION_PATH_ELEM = "/"
@@ -61,6 +75,8 @@ SPECIFICATION_PATH_ELEM = "/"
 DEFAULT_CAPABILITY_URL = "http://127.0.0.1:8889/register/capability"
 DEFAULT_SPECIFICATION_URL = "http://127.0.0.1:8889/show/specification"
 DEFAULT_RESULT_URL = "http://127.0.0.1:8889/register/result"
+DEFAULT_LONG_POLL = 30
+WORKER_RESTART_DELAY = 1
 
 class BaseComponent(object):
 
@@ -79,7 +95,48 @@ class BaseComponent(object):
 
         mplane.model.initialize_registry(registry_uri)
         self.tls = mplane.tls.TlsState(self.config)
-        self.scheduler = mplane.scheduler.Scheduler(config)
+
+        # number of HTTP worker processes, and of scheduler shard processes
+        # (0 runs jobs in this process). Shards cannot call back into the
+        # component, so only the client-initiated workflow can use them;
+        # several workers share the shards, or this process's scheduler.
+        self._workers = 1
+        self._shards = 0
+        if config is not None and "Component" in config:
+            if "Listener" in config["Component"]:
+                self._workers = int(config["Component"]["Listener"].get("workers", 1))
+                if "scheduler_shards" in config["Component"]:
+                    self._shards = int(config["Component"]["scheduler_shards"])
+            elif "scheduler_shards" in config["Component"]:
+                logger.warning("scheduler_shards ignored: shards require the Listener workflow")
+
+        # with shards, the scheduler is started once the services are loaded
+        if self._shards:
+            self.scheduler = None
+        else:
+            self.scheduler = mplane.scheduler.Scheduler(config)
+
+        # metrics, if enabled, describing this component's scheduler
+        self._metrics_path = mplane.metrics.configure(config)
+        # (replacing those of any previous component in this process,
+        # without keeping its scheduler alive)
+        if self._metrics_path is not None and not self._shards:
+            scheduler = weakref.ref(self.scheduler)
+            mplane.metrics.Gauge("mplane_scheduler_jobs",
+                                 "Jobs held by the scheduler",
+                                 lambda: len(scheduler().jobs))
+            mplane.metrics.Gauge("mplane_scheduler_timers",
+                                 "Timers waiting to fire",
+                                 lambda: scheduler().timers.backlog())
+            mplane.metrics.Gauge("mplane_scheduler_queued_runs",
+                                 "Job runs waiting for a worker",
+                                 lambda: scheduler().pool.queue_depth())
+            mplane.metrics.Gauge("mplane_scheduler_workers",
+                                 "Worker threads started by the scheduler",
+                                 lambda: scheduler().pool.stats()["workers"])
+
+        # profiling hooks, if enabled
+        self._diagnostics_path = mplane.profiling.configure(config)
 
         self._ipaddresses = None  # list of IPs to listen on, if the component is Listener
 
@@ -105,10 +162,21 @@ class BaseComponent(object):
                     for service in services:
                         service.set_capability_link(link)
 
-        # Now add all the services to the scheduler
+        # Now move the services to shard processes, which re-arm their
+        # own pending jobs, or add them to the scheduler
+        if self._shards:
+            self.scheduler = mplane.shard.ShardedScheduler(config, services,
+                                                           self._shards)
+            return
+
         for service in services:
             self.scheduler.add_service(service)
 
+        # and re-arm jobs pending when the component last stopped
+        restored = self.scheduler.restore_jobs()
+        if restored:
+            logger.info("Restored "+str(restored)+" pending jobs")
+
     def _load_services(self):
         services = []
         if self.config is not None:
@@ -130,7 +198,61 @@ class BaseComponent(object):
                 return
         logger.warning("Component: no service to remove for capability "+repr(capability))
 
+def _listener_application(config, scheduler, tls, cache, metrics_path=None,
+                          diagnostics_path=None):
+    handlers = [
+        (r"/", MessagePostHandler, {'scheduler': scheduler,
+                                    'tlsState': tls,
+                                    'cache': cache}),
+        (r"/" + CAPABILITY_PATH_ELEM, DiscoveryHandler, {'scheduler': scheduler,
+                                                         'tlsState': tls,
+                                                         'config': config,
+                                                         'cache': cache}),
+        (r"/" + CAPABILITY_PATH_ELEM + "/.*", DiscoveryHandler, {'scheduler': scheduler,
+                                                                 'tlsState': tls,
+                                                                 'config': config,
+                                                                 'cache': cache}),
+    ]
+    if metrics_path is not None:
+        handlers.append((metrics_path, mplane.metrics.MetricsHandler,
+                         {'tlsState': tls,
+                          'access': mplane.azn.EndpointAccess(config, "Metrics")}))
+    if diagnostics_path is not None:
+        # diagnostics expose code and memory: closed unless configured
+        handlers.append((diagnostics_path, mplane.profiling.DiagnosticsHandler,
+                         {'tlsState': tls,
+                          'access': mplane.azn.EndpointAccess(config, "Profiling",
+                                                              open_default=False)}))
+    return tornado.web.Application(handlers)
+
+def _listener_worker_main(config, scheduler_pickle, port, addresses, index):
+    # the scheduler is unpickled once the registry its capabilities need exists
+    mplane.shard.initialize_registry(config)
+    scheduler = pickle.loads(scheduler_pickle)
+    tls = mplane.tls.TlsState(config)
+
+    # metrics and diagnostics describe this worker only
+    application = _listener_application(config, scheduler, tls,
+                                        DiscoveryCache(scheduler),
+                                        mplane.metrics.configure(config),
+                                        mplane.profiling.configure(config))
+    http_server = tornado.httpserver.HTTPServer(application,
+                                                ssl_options=tls.get_ssl_options())
+    for ip in addresses:
+        http_server.add_sockets(tornado.netutil.bind_sockets(port, ip, reuse_port=True))
+    logger.info("ListenerHttpComponent worker " + str(index) +
+                " running on port " + str(port))
+    tornado.ioloop.IOLoop.current().start()
+
 class ListenerHttpComponent(BaseComponent):
+    """
+    A component (or the component side of a supervisor) answering
+    requests from clients over HTTP. With a single worker, the component
+    serves from this process once created. With several, :meth:`serve`
+    starts the worker processes, which share this process's scheduler
+    (or its shards).
+
+    """
     def __init__(self, config, io_loop=None, as_daemon=False):
         self._port = DEFAULT_MPLANE_PORT
         if config is not None and "Component" in config and "Listener" in config["Component"]:
@@ -141,36 +263,168 @@ class ListenerHttpComponent(BaseComponent):
 
         super(ListenerHttpComponent, self).__init__(config)
 
-        application = tornado.web.Application([
-            (r"/", MessagePostHandler, {'scheduler': self.scheduler, 'tlsState': self.tls}),
-            (r"/" + CAPABILITY_PATH_ELEM, DiscoveryHandler, {'scheduler': self.scheduler,
-                                                             'tlsState': self.tls,
-                                                             'config': config}),
-            (r"/" + CAPABILITY_PATH_ELEM + "/.*", DiscoveryHandler, {'scheduler': self.scheduler,
-                                                                     'tlsState': self.tls,
-                                                                     'config': config}),
-        ])
+        self.discovery_cache = DiscoveryCache(self.scheduler)
+
+        if self._ipaddresses is not None:
+            self._addresses = self._ipaddresses
+        else:
+            self._addresses = [None]
+        self._as_daemon = as_daemon
+        self._worker_processes = None
+        self._workers_lock = threading.Lock()
+        self._stopping = False
+        self._listen_thread = None
+
+        if self._workers > 1:
+            return
 
+        application = _listener_application(config, self.scheduler, self.tls,
+                                            self.discovery_cache,
+                                            self._metrics_path,
+                                            self._diagnostics_path)
         http_server = tornado.httpserver.HTTPServer(
                                 application,
                                 ssl_options=self.tls.get_ssl_options())
 
         # run the server
-        if self._ipaddresses is not None:
-            for ip in self._ipaddresses:
-                http_server.listen(self._port, ip)
-        else:
-            http_server.listen(self._port)
-
+        for ip in self._addresses:
+            http_server.listen(self._port, ip)
         logger.info("ListenerHttpComponent running on port " + str(self._port))
+
+        # the server is registered with this thread's IOLoop, which the
+        # background thread runs
+        self._io_loop = tornado.ioloop.IOLoop.current()
         comp_t = Thread(target=self.listen_in_background, args=(io_loop,))
         comp_t.setDaemon(as_daemon)
         comp_t.start()
+        self._listen_thread = comp_t
 
     def listen_in_background(self, io_loop):
         """ The component listens for requests in background """
         if io_loop is None:
-            tornado.ioloop.IOLoop.instance().start()
+            self._io_loop.start()
+
+    def serve(self):
+        """
+        Start the HTTP worker processes, if there are several workers;
+        otherwise the component is already serving.
+
+        The workers are spawned, rather than forked from this process,
+        which runs threads, and each binds the listening sockets with
+        SO_REUSEPORT, so that the kernel spreads connections between
+        them. They reach the scheduler shards, if any, or else this
+        process's scheduler, over local connections; a worker which
+        exits is restarted.
+
+        """
+        if self._workers == 1 or self._worker_processes is not None:
+            return
+
+        if self._shards:
+            scheduler = self.scheduler
+        else:
+            self._scheduler_server = mplane.shard.SchedulerServer(self.config,
+                                                                  self.scheduler)
+            scheduler = self._scheduler_server.remote()
+        self._worker_args = (self.config, pickle.dumps(scheduler),
+                             self._port, self._addresses)
+
+        self._worker_processes = [self._start_worker(i) for i in range(self._workers)]
+        comp_t = Thread(target=self._watch_workers, name="mplane-worker-watch")
+        comp_t.daemon = self._as_daemon
+        comp_t.start()
+        self._listen_thread = comp_t
+
+    def _start_worker(self, index):
+        context = multiprocessing.get_context("spawn")
+        process = context.Process(target=_listener_worker_main,
+                                  args=self._worker_args + (index,),
+                                  name="mplane-http-worker-"+str(index))
+        process.daemon = True
+        process.start()
+        return process
+
+    def _watch_workers(self):
+        while True:
+            with self._workers_lock:
+                processes = list(self._worker_processes)
+            multiprocessing.connection.wait([p.sentinel for p in processes])
+            sleep(WORKER_RESTART_DELAY)
+            with self._workers_lock:
+                if self._stopping:
+                    return
+                for (i, process) in enumerate(self._worker_processes):
+                    if not process.is_alive():
+                        logger.warning("ListenerHttpComponent worker " + str(i) +
+                                       " exited with code " + str(process.exitcode) +
+                                       ", restarting")
+                        self._worker_processes[i] = self._start_worker(i)
+
+    def stop_workers(self):
+        """Stop the HTTP worker processes started by serve()."""
+        with self._workers_lock:
+            self._stopping = True
+            processes = self._worker_processes or []
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    def join(self):
+        """
+        Wait for the component to stop listening. Programs running a
+        component should not leave their main thread before then, as
+        the handlers' thread pools stop accepting work when it ends.
+
+        """
+        self._listen_thread.join()
+
+class DiscoveryCache(object):
+    """
+    Caches the rendered discovery pages of a scheduler, by page and by
+    identity class (see :meth:`mplane.azn.Authorization.identity_class`),
+    as all identities in a class are shown the same capabilities. The
+    cache is emptied whenever the scheduler's capabilities change.
+
+    """
+    # filtered and paged listings make for many possible pages; beyond
+    # this many, pages are rendered on every request
+    max_pages = 256
+
+    def __init__(self, scheduler):
+        super(DiscoveryCache, self).__init__()
+        self.scheduler = scheduler
+        self._version = None
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, page, identity, render):
+        """
+        Return (body, etag, last_modified) for a page as seen by an
+        identity, calling render() to build the body if it is not cached.
+        last_modified is the end of the second in which the capabilities
+        last changed, as HTTP dates have a resolution of one second.
+
+        """
+        version = self.scheduler.capability_version
+        modified = self.scheduler.capabilities_modified
+        key = (page, self.scheduler.azn.identity_class(identity))
+        with self._lock:
+            if self._version != version:
+                self._pages.clear()
+                self._version = version
+            entry = self._pages.get(key)
+        if entry is not None:
+            return entry
+
+        body = render()
+        etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+        entry = (body, etag, datetime.utcfromtimestamp(int(modified) + 1))
+        with self._lock:
+            # don't cache a page rendered while the capabilities changed
+            if self._version == version and len(self._pages) < self.max_pages:
+                self._pages[key] = entry
+        return entry
 
 class MPlaneHandler(tornado.web.RequestHandler):
     """
@@ -178,12 +432,68 @@ class MPlaneHandler(tornado.web.RequestHandler):
     handler to respond with an mPlane Message or an Exception.
 
     """
-    def _respond_message(self, msg):
+    async def _respond_message(self, msg):
         self.set_status(200)
         self.set_header("Content-Type", "application/x-mplane+json")
-        self.write(mplane.model.unparse_json(msg))
+        unparse_start = time.monotonic()
+        body = await mplane.model.unparse_json_async(msg)
+        mplane.metrics.serialization_seconds.observe(time.monotonic() - unparse_start)
+        self.write(body)
+        self.finish()
+
+    def prepare(self):
+        self._profiling_span = mplane.profiling.span(mplane.profiling.HTTP,
+                                                     self.__class__.__name__)
+        self._profiling_span.__enter__()
+
+    def on_finish(self):
+        mplane.metrics.http_request_seconds.observe(self.request.request_time(),
+                                                    self.__class__.__name__)
+        span = getattr(self, "_profiling_span", None)
+        if span is not None:
+            span.__exit__(None, None, None)
+
+    def _respond_page(self, page, content_type, render):
+        # render(identity) builds the page; with a cache, repeat requests
+        # carrying its ETag or modification time are answered with a 304
+        identity = self.tls.extract_peer_identity(self.request)
+        if self.cache is None:
+            body = render(identity)
+        else:
+            (body, etag, modified) = self.cache.get(page, identity,
+                                                    lambda: render(identity))
+            self.set_header("ETag", etag)
+            self.set_header("Cache-Control", "no-cache")
+            # until the second of the last change is over, a further change
+            # in that second would not move Last-Modified: send only the ETag
+            if datetime.utcnow() < modified:
+                modified = None
+            else:
+                self.set_header("Last-Modified", modified)
+            if self._not_modified(modified):
+                self.set_status(304)
+                self.finish()
+                return
+
+        self.set_status(200)
+        self.set_header("Content-Type", content_type)
+        self.write(body)
         self.finish()
 
+    def _not_modified(self, modified):
+        if "If-None-Match" in self.request.headers:
+            return self.check_etag_header()
+        since = self.request.headers.get("If-Modified-Since")
+        if since is not None and modified is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is not None:
+                since = since.astimezone(timezone.utc).replace(tzinfo=None)
+            return modified <= since
+        return False
+
     def _respond_error(self, errmsg=None, exception=None, token=None, status=400):
         if exception:
             if len(exception.args) == 1:
@@ -200,61 +510,152 @@ class MPlaneHandler(tornado.web.RequestHandler):
         self.write(mplane.model.unparse_json(mex))
         self.finish()
 
+def _accept_quality(accept, media_type, wildcards=True):
+    """
+    Return the quality an Accept header gives a media type, from the
+    most specific media range matching it (or, without wildcards, from
+    the media type itself), or None if no media range matches it.
+
+    """
+    major = media_type.split("/")[0]
+    best = (-1, None)
+    for media_range in accept.split(","):
+        params = media_range.split(";")
+        name = params[0].strip().lower()
+        if name == media_type:
+            specificity = 2
+        elif wildcards and name == major + "/*":
+            specificity = 1
+        elif wildcards and name == "*/*":
+            specificity = 0
+        else:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            (key, _, value) = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if specificity > best[0]:
+            best = (specificity, quality)
+    return best[1]
+
 class DiscoveryHandler(MPlaneHandler):
     """
     Exposes the capabilities registered with a given scheduler.
     URIs ending with "capability" will result in an HTML page
-    listing links to each capability.
+    listing links to each capability or, if the client accepts
+    application/x-mplane+json (or asks for format=json), in a single
+    Envelope containing the capabilities. The Envelope can be filtered
+    with label (repeatable) and schema (a prefix of the schema hash)
+    arguments, and paged with offset and limit arguments.
 
     """
 
-    def initialize(self, scheduler, tlsState, config):
+    def initialize(self, scheduler, tlsState, config, cache=None):
         self.scheduler = scheduler
         self.tls = tlsState
         self.config = config
+        self.cache = cache
 
-    def get(self):
+    async def get(self):
         # capabilities
         path = self.request.path.split("/")[1:]
         if path[0] == CAPABILITY_PATH_ELEM:
             if len(path) == 1 or path[1] is None:
                 self._respond_capability_links()
             else:
-                self._respond_capability(path[1])
+                await self._respond_capability(path[1])
         else:
             self._respond_error(errmsg="I only know how to handle /"+CAPABILITY_PATH_ELEM+" URLs via HTTP GET", status=405)
 
     def _respond_capability_links(self):
-        self.set_status(200)
-        self.set_header("Content-Type", "text/html")
-        self.write("<html><head><title>Capabilities</title></head><body>")
+        self.set_header("Vary", "Accept")
+        # an Envelope is only sent to clients naming its media type, and
+        # preferring it at least as much as HTML
+        accept = self.request.headers.get("Accept", "")
+        json_quality = _accept_quality(accept, "application/x-mplane+json", wildcards=False)
+        html_quality = _accept_quality(accept, "text/html") or 0
+        if (self.get_argument("format", None) == "json" or
+                (json_quality is not None and json_quality > 0 and
+                 json_quality >= html_quality)):
+            self._respond_capability_envelope()
+        else:
+            self._respond_page("links", "text/html", self._render_capability_links)
+
+    def _respond_capability_envelope(self):
+        labels = tuple(self.get_arguments("label"))
+        schema = self.get_argument("schema", None)
+        try:
+            offset = int(self.get_argument("offset", 0))
+            limit = self.get_argument("limit", None)
+            if limit is not None:
+                limit = int(limit)
+            if offset < 0 or (limit is not None and limit < 1):
+                raise ValueError("Bad capability listing offset or limit")
+        except ValueError as e:
+            self._respond_error(exception=e)
+            return
+
+        # capabilities are linked to the host the client asked for
+        self._respond_page(("envelope", self.request.host, labels, schema, offset, limit),
+                           "application/x-mplane+json",
+                           lambda identity: self._render_capability_envelope(
+                                identity, labels, schema, offset, limit))
+
+    def _render_capability_envelope(self, identity, labels, schema, offset, limit):
+        env = mplane.model.Envelope()
+        matched = 0
+        for key in self.scheduler.capability_keys():
+            cap = self.scheduler.capability_for_key(key)
+            if (isinstance(cap, mplane.model.Withdrawal) or
+                    (labels and cap.get_label() not in labels) or
+                    (schema and not cap._schema_hash().startswith(schema)) or
+                    not self.scheduler.azn.check(cap, identity)):
+                continue
+            matched += 1
+            if matched <= offset:
+                continue
+            if limit is not None and len(env) >= limit:
+                break
+            env.append_message(self._link_capability(cap))
+        return mplane.model.unparse_json(env)
+
+    def _render_capability_links(self, identity):
+        body = ["<html><head><title>Capabilities</title></head><body>"]
         no_caps_exposed = True
         for key in self.scheduler.capability_keys():
             if (not isinstance(self.scheduler.capability_for_key(key), mplane.model.Withdrawal) and
-                    self.scheduler.azn.check(self.scheduler.capability_for_key(key),
-                                             self.tls.extract_peer_identity(self.request))):
+                    self.scheduler.azn.check(self.scheduler.capability_for_key(key), identity)):
                 no_caps_exposed = False
-                self.write("<a href='/capability/" + key + "'>" + key + "</a><br/>")
-        self.write("</body></html>")
+                body.append("<a href='/capability/" + key + "'>" + key + "</a><br/>")
+        body.append("</body></html>")
 
         if no_caps_exposed is True:
             logger.warning("Discovery: no capabilities available to "+ 
-                            self.tls.extract_peer_identity(self.request)+
+                            identity+
                             ", check authorizations")
-        self.finish()
+        return "".join(body)
 
-    def _respond_capability(self, key):
+    async def _respond_capability(self, key):
         cap = self.scheduler.capability_for_key(key)
-
-        # if the 'link' field is empty, compose it using the host requested by the client/supervisor
-        if not cap.get_link():
-            if self.config is not None and "TLS" in self.config:
-                link = "https://"
-            else:
-                link = "http://"
-            link = link + self.request.host + SPECIFICATION_PATH_ELEM
-            cap.set_link(link)
-        self._respond_message(cap)
+        await self._respond_message(self._link_capability(cap))
+
+    def _link_capability(self, cap):
+        # if the 'link' field is empty, compose it using the host requested
+        # by the client/supervisor, on a copy: the scheduler's capability
+        # is shared by requests for every host
+        if cap.get_link():
+            return cap
+        if self.config is not None and "TLS" in self.config:
+            link = "https://"
+        else:
+            link = "http://"
+        cap = copy.copy(cap)
+        cap.set_link(link + self.request.host + SPECIFICATION_PATH_ELEM)
+        return cap
 
 class MessagePostHandler(MPlaneHandler):
     """
@@ -263,65 +664,96 @@ class MessagePostHandler(MPlaneHandler):
     if a Result is immediately available, returns a receipt for future
     redemption.
 
+    Large messages are decoded and encoded on the codec thread pool, and
+    the scheduler is called on a thread of its own, so that the IOLoop
+    keeps serving other requests meanwhile.
+
     """
-    def initialize(self, scheduler, tlsState, immediate_ms = 5000):
+    def initialize(self, scheduler, tlsState, immediate_ms = 5000, cache=None):
         self.scheduler = scheduler
         self.tls = tlsState
         self.immediate_ms = immediate_ms
+        self.cache = cache
 
     def get(self):
         # message
-        self.set_status(200)
-        self.set_header("Content-Type", "text/html")
-        self.write("<html><head><title>mplane.httpsrv</title></head><body>")
-        self.write("This is a client-initiated mPlane component. POST mPlane messages to this URL to use.<br/>")
-        self.write("<a href='/"+CAPABILITY_PATH_ELEM+"'>Capabilities</a> provided by this server:<br/>")
+        self._respond_page("index", "text/html", self._render_index)
+
+    def _render_index(self, identity):
+        body = ["<html><head><title>mplane.httpsrv</title></head><body>"]
+        body.append("This is a client-initiated mPlane component. POST mPlane messages to this URL to use.<br/>")
+        body.append("<a href='/"+CAPABILITY_PATH_ELEM+"'>Capabilities</a> provided by this server:<br/>")
         for key in self.scheduler.capability_keys():
             if (not isinstance(self.scheduler.capability_for_key(key), mplane.model.Withdrawal) and
-                    self.scheduler.azn.check(self.scheduler.capability_for_key(key),
-                                             self.tls.extract_peer_identity(self.request))):
-                self.write("<br/><pre>")
-                self.write(mplane.model.unparse_json(self.scheduler.capability_for_key(key)))
-        self.write("</body></html>")
-        self.finish()
+                    self.scheduler.azn.check(self.scheduler.capability_for_key(key), identity)):
+                body.append("<br/><pre>")
+                body.append(mplane.model.unparse_json(self.scheduler.capability_for_key(key)))
+        body.append("</body></html>")
+        return "".join(body)
 
-    def post(self):
+    async def post(self):
         # unwrap json message from body
         if (self.request.headers["Content-Type"] == "application/x-mplane+json"):
             try:
-                msg = mplane.model.parse_json(self.request.body.decode("utf-8"))
+                msg = await mplane.model.parse_json_async(self.request.body.decode("utf-8"))
             except Exception as e:
                 self._respond_error(exception=e)
+                return
         else:
-            self._respond_error(errmsg="I only know how to handle mPlane JSON messages via HTTP POST", status="406")
+            self._respond_error(errmsg="I only know how to handle mPlane JSON messages via HTTP POST", status=406)
+            return
 
-        # check if requested capability is withdrawn
-        is_withdrawn = False
-        if isinstance(msg, mplane.model.Specification):
-            for key in self.scheduler.capability_keys():
-                cap = self.scheduler.capability_for_key(key)
-                if msg.fulfills(cap) and isinstance(cap, mplane.model.Withdrawal):
-                    is_withdrawn = True
-                    self._respond_message(cap)
-
-        if not is_withdrawn:
-            # hand message to scheduler
-            reply = self.scheduler.process_message(self.tls.extract_peer_identity(self.request), msg)
-
-            # wait for immediate delay
-            if self.immediate_ms > 0 and \
-               isinstance(msg, mplane.model.Specification) and \
-               isinstance(reply, mplane.model.Receipt):
-                job = self.scheduler.job_for_message(reply)
-                wait_start = datetime.utcnow()
-                while (datetime.utcnow() - wait_start).total_seconds() * 1000 < self.immediate_ms:
-                    time.sleep(SLEEP_QUANTUM)
-                    if job.failed() or job.finished():
-                        reply = job.get_reply()
-                        break
+        # hand message to scheduler; specifications for withdrawn
+        # capabilities are answered with the Withdrawal
+        user = self.tls.extract_peer_identity(self.request)
+        reply = await _call_scheduler(self.scheduler.process_message, user, msg)
 
-            # return reply
-            self._respond_message(reply)
+        # wait for immediate delay, without blocking the IOLoop
+        if self.immediate_ms > 0 and \
+           isinstance(msg, mplane.model.Specification) and \
+           isinstance(reply, mplane.model.Receipt):
+            try:
+                job = self.scheduler.job_for_message(reply)
+            except KeyError:
+                # already finished, and moved to the scheduler's job store
+                job = None
+            if job is None:
+                reply = await _call_scheduler(self.scheduler.process_message, user,
+                                              mplane.model.Redemption(receipt=reply))
+            else:
+                done = tornado.concurrent.Future()
+                io_loop = tornado.ioloop.IOLoop.current()
+                job.add_done_callback(lambda job: io_loop.add_callback(_set_future_done, done))
+                try:
+                    await tornado.gen.with_timeout(timedelta(milliseconds=self.immediate_ms), done)
+                    reply = await _call_scheduler(job.get_reply_for, user)
+                except tornado.gen.TimeoutError:
+                    pass
+
+        # return reply
+        await self._respond_message(reply)
+
+def _set_future_done(future):
+    if not future.done():
+        future.set_result(None)
+
+# calls from handlers into the scheduler run one at a time, as they did
+# on the IOLoop, but on a thread of their own. The scheduler locks its
+# services, capabilities and jobs, so that quick lookups (e.g. capability
+# discovery) may still be made from the IOLoop, and a supervisor may add
+# services from it.
+_scheduler_executor = None
+_scheduler_executor_lock = threading.Lock()
+
+def _call_scheduler(function, *args):
+    global _scheduler_executor
+    with _scheduler_executor_lock:
+        if _scheduler_executor is None:
+            _scheduler_executor = concurrent.futures.ThreadPoolExecutor(
+                                        max_workers=1,
+                                        thread_name_prefix="mplane-scheduler-calls")
+    return tornado.ioloop.IOLoop.current().run_in_executor(_scheduler_executor,
+                                                           function, *args)
 
 class InitiatorHttpComponent(BaseComponent):
 
@@ -353,6 +785,13 @@ class InitiatorHttpComponent(BaseComponent):
             self.specification_url = urllib3.util.parse_url(DEFAULT_SPECIFICATION_URL)
             self.result_url = urllib3.util.parse_url(DEFAULT_RESULT_URL)
 
+        # seconds the Client/Supervisor may hold a specification poll
+        # until specifications are queued for us; 0 polls periodically
+        self._long_poll = DEFAULT_LONG_POLL
+        if self.config is not None and "Component" in self.config and "Initiator" in self.config["Component"]:
+            if "long-poll" in self.config["Component"]["Initiator"]:
+                self._long_poll = int(self.config["Component"]["Initiator"]["long-poll"])
+
         self.pool = self.tls.pool_for(self.registration_url.scheme,
                                       self.registration_url.host,
                                       self.registration_url.port)
@@ -372,7 +811,7 @@ class InitiatorHttpComponent(BaseComponent):
         """
         env = mplane.model.Envelope()
 
-        logger.info("Component: registering my capabilities to "+self.registration_url)
+        logger.info("Component: registering my capabilities to "+str(self.registration_url))
 
         # try to register capabilities, if URL is unreachable keep trying every 5 seconds
         connected = False
@@ -417,7 +856,7 @@ class InitiatorHttpComponent(BaseComponent):
         # handle response message
 
         if res.status == 200:
-            logger.info("Component: successfully registered to "+self.registration_url)
+            logger.info("Component: successfully registered to "+str(self.registration_url))
             # FIXME this does not appear to have anything 
             # to do with the protocol specification, see issue #4
             # body = json.loads(res.data.decode("utf-8"))
@@ -429,36 +868,61 @@ class InitiatorHttpComponent(BaseComponent):
             #         print(key + ": Failed (" + body[key]['reason'] + ")")
             # print("")
         else:
-            logger.critical("Capability registration to "+self.registration_url+" failed:"+
+            logger.critical("Capability registration to "+str(self.registration_url)+" failed:"+
                              str(res.status) + " - " + res.data.decode("utf-8"))
 
     def check_for_specs(self):
         """
-        Poll the client for specifications
+        Poll the client for specifications. With long polls, the client
+        answers once specifications are queued for this component (or
+        the poll times out), and the component polls again at once;
+        clients answering at once are polled every idle_time seconds.
 
         """
+        # long polls hold their connection, so they get a pool of their own
+        if self._long_poll > 0:
+            poll_uri = self.specification_url.request_uri
+            poll_uri += ("&" if self.specification_url.query else "?") + "wait=" + str(self._long_poll)
+            poll_pool = self.tls.pool_for(self.specification_url.scheme,
+                                          self.specification_url.host,
+                                          self.specification_url.port)
+
         while True:
             # FIXME configurable default idle time.
             self.idle_time = 5
+            poll_again = False
 
             # try to send a request for specifications. If URL is unreachable means that the Supervisor (or Client) has
             # most probably died, so we need to re-register capabilities
             try:
-                logger.info("Polling for specifications at " + self.specification_url)
-                res = self.send_message(self.specification_url, "GET")
+                logger.info("Polling for specifications at " + str(self.specification_url))
+                poll_start = time.monotonic()
+                if self._long_poll > 0:
+                    res = poll_pool.request('GET', poll_uri)
+                else:
+                    res = self.send_message(self.specification_url, "GET")
             except Exception as e:
-                logger.warning("Specification poll at " + self.specification_url + "failed :" + repr(e))
+                logger.warning("Specification poll at " + str(self.specification_url) + "failed :" + repr(e))
                 logger.warning("Attempting reregistration")
                 self.register_to_client()
+                continue
 
             if res.status == 200:
                 # specs retrieved: split them if there is more than one
                 env = mplane.model.parse_json(res.data.decode("utf-8"))
+
+                # an empty answer well before the poll timeout comes from
+                # a client not holding polls
+                poll_again = self._long_poll > 0 and \
+                             (len(env) > 0 or
+                              time.monotonic() - poll_start >= self._long_poll / 2)
+
                 for spec in env.messages():
                     # handle callbacks
                     # FIXME NO NO NO see issue #3
                     if spec.get_label() == "callback":
                         self.idle_time = spec.when().timer_delays()[1]
+                        poll_again = False
                         break
 
                     # hand spec to scheduler, making sure the callback is called after
@@ -477,10 +941,11 @@ class InitiatorHttpComponent(BaseComponent):
                 self.register_to_client()
 
             else:
-                logger.critical("Specification poll to "+self.specification_url+" failed:"+
+                logger.critical("Specification poll to "+str(self.specification_url)+" failed:"+
                                  str(res.status) + " - " + res.data.decode("utf-8"))
  
-            sleep(self.idle_time)
+            if not poll_again:
+                sleep(self.idle_time)
  
     def return_results(self,receipt):
         """
@@ -490,15 +955,27 @@ class InitiatorHttpComponent(BaseComponent):
         #wait for scheduling process above
         with self._callback_lock:
             pass
-        job = self.scheduler.job_for_message(receipt)
-        reply = job.get_reply()
-
-        # check if job is completed
-        if (job.finished() is not True and
-                job.failed() is not True):
-            logger.debug("Component: not returning partial result (%s len: %d, label: %s)" 
-                          % (type(reply).__name__, len(reply), reply.get_label()))
-            return
+        try:
+            job = self.scheduler.job_for_message(receipt)
+        except KeyError:
+            # finished, and moved to the scheduler's job store
+            job = None
+
+        if job is None:
+            reply = self.scheduler.process_message(self._client_identity,
+                                                   mplane.model.Redemption(receipt=receipt))
+        else:
+            reply = job.get_reply_for(self._client_identity)
+
+            # check if job is completed, or has rows to return
+            if (job.finished() is not True and
+                    job.failed() is not True and
+                    not isinstance(job, mplane.scheduler.Job)):
+                logger.debug("Component: not returning partial result (%s len: %d, label: %s)" 
+                              % (type(reply).__name__, len(reply), reply.get_label()))
+                return
+            if isinstance(reply, mplane.model.Receipt):
+                return
 
         # send result to the Client/Supervisor
         res = self.send_message(self._result_url[reply.get_token()], "POST", reply)
@@ -0,0 +1,243 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Streaming result export
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Streaming export of mPlane Results to delimited text (CSV/TSV) and
+newline-delimited JSON.
+
+A ResultWriter consumes Results (or Envelopes containing them) one
+at a time and appends their rows to an open stream, so a result set
+never has to be rendered as a single message before it hits the disk.
+Writers can be attached to a client with
+:func:`mplane.client.BaseClient.add_result_sink` to record results
+while they are still arriving.
+
+"""
+
+import csv
+import gzip
+import json
+import logging
+import mplane.model
+
+logger = logging.getLogger(__name__)
+
+FORMAT_CSV = "csv"
+FORMAT_TSV = "tsv"
+FORMAT_NDJSON = "ndjson"
+
+GZIP_SUFFIX = ".gz"
+
+_format_suffixes = { ".csv": FORMAT_CSV,
+                     ".tsv": FORMAT_TSV,
+                     ".ndjson": FORMAT_NDJSON,
+                     ".jsonl": FORMAT_NDJSON }
+
+def format_for_path(path):
+    """
+    Determine the export format for a given file path from its
+    extension (ignoring a trailing .gz), or None if the path does
+    not name an export format.
+
+    """
+    if path.endswith(GZIP_SUFFIX):
+        path = path[:-len(GZIP_SUFFIX)]
+    for (suffix, fmt) in _format_suffixes.items():
+        if path.endswith(suffix):
+            return fmt
+    return None
+
+def _unparse_value(prim, val):
+    sval = prim.unparse(val)
+    if isinstance(sval, list):
+        return " ".join(sval)
+    return sval
+
+class ResultWriter(object):
+    """
+    Writes the rows of Results to a text stream in CSV, TSV or
+    newline-delimited JSON format.
+
+    For delimited formats, a header row naming the parameters and
+    result columns is written before the first row, and again
+    whenever the schema of the written results changes.
+
+    Only the rows of a Result beyond those already written for its
+    token are written, so a writer can be fed the same growing Result
+    (e.g. the rows of a running measurement merged by a client), or
+    repeated-measurement Envelope, several times, and will append only
+    the new rows.
+
+    """
+    def __init__(self, stream, fmt=FORMAT_CSV):
+        super(ResultWriter, self).__init__()
+        if fmt not in (FORMAT_CSV, FORMAT_TSV, FORMAT_NDJSON):
+            raise ValueError("Unsupported export format "+repr(fmt))
+        self._stream = stream
+        self._fmt = fmt
+        self._schema = None
+        # number of rows written by token
+        self._written = {}
+        self.rows_written = 0
+
+        if fmt == FORMAT_CSV:
+            self._csv = csv.writer(stream)
+        elif fmt == FORMAT_TSV:
+            self._csv = csv.writer(stream, dialect=csv.excel_tab)
+        else:
+            self._csv = None
+
+    def __repr__(self):
+        return "<ResultWriter "+self._fmt+" ("+str(self.rows_written)+" rows)>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_message(self, msg):
+        """
+        Write the rows of a message. Results are written directly,
+        Envelopes are descended into; other messages are ignored.
+        Returns the number of rows written.
+
+        """
+        if isinstance(msg, mplane.model.Envelope):
+            count = 0
+            for imsg in msg.messages():
+                count += self.write_message(imsg)
+            return count
+        elif isinstance(msg, mplane.model.Result):
+            return self.write_result(msg)
+        else:
+            logger.debug("ResultWriter: skipping "+repr(msg))
+            return 0
+
+    def write_result(self, res):
+        """
+        Write the rows of a single Result beyond those already written
+        for its token. Returns the number of rows written.
+
+        """
+        token = res.get_token()
+        start = self._written.get(token, 0)
+        nrows = res.count_result_rows()
+        if nrows <= start:
+            return 0
+        self._written[token] = nrows
+
+        if self._csv is not None:
+            count = self._write_delimited(res, start, nrows)
+        else:
+            count = self._write_ndjson(res, start, nrows)
+
+        self.rows_written += count
+        return count
+
+    def _write_delimited(self, res, start, nrows):
+        pnames = list(res.parameter_names())
+        rnames = list(res.result_column_names())
+        schema = pnames + rnames
+        if schema != self._schema:
+            self._csv.writerow(schema)
+            self._schema = schema
+
+        # parameters are constant across rows; unparse them once
+        pvals = [_unparse_value(res._params[k]._prim, res._params[k].get_value())
+                 for k in pnames]
+
+        # unparse each column as a whole, then interleave into rows
+        cols = self._unparse_columns(res, rnames, start, nrows)
+
+        self._csv.writerows(pvals + list(row) for row in zip(*cols))
+        return nrows - start
+
+    def _unparse_columns(self, res, rnames, start, nrows):
+        cols = []
+        for k in rnames:
+            col = res._resultcolumns[k]
+            svals = [_unparse_value(col._prim, v) for v in col._vals[start:nrows]]
+            if len(svals) < nrows - start:
+                svals.extend([mplane.model.VALUE_NONE] * (nrows - start - len(svals)))
+            cols.append(svals)
+        return cols
+
+    def _write_ndjson(self, res, start, nrows):
+        pnames = list(res.parameter_names())
+        rnames = list(res.result_column_names())
+
+        base = {k: _unparse_value(res._params[k]._prim, res._params[k].get_value())
+                for k in pnames}
+        token = res.get_token()
+        label = res.get_label()
+
+        cols = self._unparse_columns(res, rnames, start, nrows)
+
+        for row in zip(*cols):
+            d = dict(base)
+            d.update(zip(rnames, row))
+            d[mplane.model.KEY_TOKEN] = token
+            if label is not None:
+                d[mplane.model.KEY_LABEL] = label
+            self._stream.write(json.dumps(d, sort_keys=True))
+            self._stream.write("\n")
+        return nrows - start
+
+    def flush(self):
+        """Flush the underlying stream."""
+        self._stream.flush()
+
+    def close(self):
+        """Close the underlying stream."""
+        self._stream.close()
+
+def open_writer(path, fmt=None):
+    """
+    Open a file for export, and return a ResultWriter writing to it.
+    The format is determined from the path's extension unless given;
+    paths ending in .gz are written gzip-compressed.
+
+    """
+    if fmt is None:
+        fmt = format_for_path(path)
+        if fmt is None:
+            raise ValueError("Cannot determine export format for "+path)
+
+    if path.endswith(GZIP_SUFFIX):
+        stream = gzip.open(path, "wt", newline="")
+    else:
+        stream = open(path, "w", newline="")
+
+    return ResultWriter(stream, fmt)
+
+def export_messages(path, msgs, fmt=None):
+    """
+    Export the rows of each given message to a file,
+    returning the number of rows written.
+
+    """
+    with open_writer(path, fmt) as writer:
+        for msg in msgs:
+            writer.write_message(msg)
+        return writer.rows_written
@@ -0,0 +1,271 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Persistent job store
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Persistent storage of a scheduler's jobs and their results in an
+SQLite database.
+
+Each accepted Specification is stored with the users subscribed to its
+results until the results have been redeemed by every subscriber.
+Specifications whose results are still pending when a component stops
+can be re-armed when it restarts. Finished results are held only in the
+store, and read back when they are redeemed, so that the memory used by
+a component does not depend on the number of results outstanding. The
+results of repeated specifications are appended to the store as each
+run completes.
+
+"""
+
+import collections
+import threading
+import sqlite3
+import logging
+import json
+import mplane.model
+import mplane.clock
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    token TEXT PRIMARY KEY,
+    specification TEXT NOT NULL,
+    subscribers TEXT NOT NULL,
+    finished INTEGER NOT NULL DEFAULT 0,
+    reply TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    ended_at REAL,
+    used_at REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    token TEXT NOT NULL,
+    reply TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_token ON results (token, seq);
+"""
+
+def _encode(msg):
+    return json.dumps(msg.to_dict(), separators=(',',':'))
+
+def _decode(text):
+    return mplane.model.message_from_dict(json.loads(text))
+
+class JobStore(object):
+    """
+    Stores jobs and results in the SQLite database at path, which is
+    created if necessary. The store may be used from any thread.
+
+    """
+    def __init__(self, path):
+        super(JobStore, self).__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def __repr__(self):
+        return "<JobStore "+self.path+">"
+
+    def close(self):
+        """Close the underlying database."""
+        with self._lock:
+            self._db.close()
+
+    def add_job(self, token, specification, subscribers):
+        """
+        Store a newly scheduled job for a Specification, given a mapping
+        of subscribed users to subscription counts; replaces any previous
+        job and results stored under the same token.
+
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM results WHERE token = ?", (token,))
+            self._db.execute("INSERT OR REPLACE INTO jobs (token, specification, subscribers) "
+                             "VALUES (?, ?, ?)",
+                             (token, _encode(specification), json.dumps(dict(subscribers))))
+
+    def subscribe(self, token, user):
+        """
+        Subscribe a user to the results stored under a token. Returns
+        True if the results are finished, False if they are pending, and
+        None if there is no such job.
+
+        """
+        with self._lock, self._db:
+            row = self._db.execute("SELECT subscribers, finished FROM jobs WHERE token = ?",
+                                   (token,)).fetchone()
+            if row is None:
+                return None
+            subscribers = collections.Counter(json.loads(row[0]))
+            subscribers[user] += 1
+            self._db.execute("UPDATE jobs SET subscribers = ? WHERE token = ?",
+                             (json.dumps(subscribers), token))
+            return bool(row[1])
+
+    def append_result(self, token, reply):
+        """Append the result of one run of a repeated job."""
+        text = _encode(reply)
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO results (token, reply) VALUES (?, ?)",
+                             (token, text))
+            self._db.execute("UPDATE jobs SET size = size + ? WHERE token = ?",
+                             (len(text), token))
+
+    def finish(self, token, reply=None):
+        """
+        Mark a job finished, with its reply (a Result or Exception); the
+        reply of a repeated job is made up of its appended results.
+
+        """
+        now = mplane.clock.timestamp()
+        with self._lock, self._db:
+            if reply is None:
+                self._db.execute("UPDATE jobs SET finished = 1, ended_at = ?, used_at = ? "
+                                 "WHERE token = ?", (now, now, token))
+            else:
+                text = _encode(reply)
+                self._db.execute("UPDATE jobs SET finished = 1, reply = ?, size = ?, "
+                                 "ended_at = ?, used_at = ? WHERE token = ?",
+                                 (text, len(text), now, now, token))
+
+    def reply(self, token, max_results=0):
+        """
+        Return the reply stored under a token: a Result or Exception, or
+        an Envelope holding the latest max_results (if nonzero) results
+        of a repeated job. Returns None if there is no such reply.
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT specification, reply FROM jobs WHERE token = ?",
+                                   (token,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None:
+                return _decode(row[1])
+            if max_results > 0:
+                results = self._db.execute("SELECT reply FROM (SELECT seq, reply FROM results "
+                                           "WHERE token = ? ORDER BY seq DESC LIMIT ?) "
+                                           "ORDER BY seq", (token, max_results)).fetchall()
+            else:
+                results = self._db.execute("SELECT reply FROM results WHERE token = ? "
+                                           "ORDER BY seq", (token,)).fetchall()
+
+        if len(results) == 0:
+            return None
+        spec = _decode(row[0])
+        env = mplane.model.Envelope(token=token, label=spec.get_label(), when=spec.when())
+        for (text,) in results:
+            env.append_message(_decode(text))
+        return env
+
+    def redeem(self, token, user, max_results=0):
+        """
+        Redeem the finished results stored under a token for a user,
+        removing them once no subscriber is waiting for them. Returns the
+        reply, or None if there are no finished results.
+
+        """
+        reply = self.reply(token, max_results)
+        if reply is None:
+            return None
+
+        with self._lock, self._db:
+            row = self._db.execute("SELECT subscribers, finished FROM jobs WHERE token = ?",
+                                   (token,)).fetchone()
+            if row is None or not row[1]:
+                return None
+            subscribers = collections.Counter(json.loads(row[0]))
+            if subscribers[user] > 0:
+                subscribers[user] -= 1
+            subscribers += collections.Counter()
+            if len(subscribers) == 0:
+                self._delete(token)
+            else:
+                self._db.execute("UPDATE jobs SET subscribers = ?, used_at = ? WHERE token = ?",
+                                 (json.dumps(subscribers), mplane.clock.timestamp(), token))
+        return reply
+
+    def remove(self, token):
+        """Remove the job and results stored under a token."""
+        with self._lock, self._db:
+            self._delete(token)
+
+    def _delete(self, token):
+        self._db.execute("DELETE FROM jobs WHERE token = ?", (token,))
+        self._db.execute("DELETE FROM results WHERE token = ?", (token,))
+
+    def pending(self):
+        """
+        Return a list of (token, specification, subscribers) tuples for
+        the jobs whose results are not finished.
+
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT token, specification, subscribers FROM jobs "
+                                    "WHERE finished = 0").fetchall()
+        return [(token, _decode(spec), collections.Counter(json.loads(subscribers)))
+                for (token, spec, subscribers) in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def finished_count(self):
+        """Return the number of jobs with finished results."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE finished = 1").fetchone()[0]
+
+    def prune(self, ttl=0, max_finished=0, budget=0):
+        """
+        Remove finished results: those finished more than ttl seconds
+        ago, then the least recently used beyond max_finished results,
+        then the least recently used until the rest fit in budget bytes.
+        A zero limit is not applied. Returns a tuple of the numbers of
+        results removed by each limit.
+
+        """
+        evicted_ttl = evicted_count = evicted_budget = 0
+        with self._lock, self._db:
+            if ttl > 0:
+                expired = self._db.execute("SELECT token FROM jobs WHERE finished = 1 "
+                                           "AND ended_at < ?", (mplane.clock.timestamp() - ttl,)).fetchall()
+                for (token,) in expired:
+                    self._delete(token)
+                evicted_ttl = len(expired)
+
+            rows = self._db.execute("SELECT token, size FROM jobs WHERE finished = 1 "
+                                    "ORDER BY used_at").fetchall()
+            if max_finished > 0:
+                while len(rows) > max_finished:
+                    self._delete(rows.pop(0)[0])
+                    evicted_count += 1
+            if budget > 0:
+                total = sum(size for (token, size) in rows)
+                while total > budget and len(rows):
+                    (token, size) = rows.pop(0)
+                    self._delete(token)
+                    total -= size
+                    evicted_budget += 1
+        return (evicted_ttl, evicted_count, evicted_budget)
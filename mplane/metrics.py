@@ -0,0 +1,271 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Runtime metrics
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Counters, gauges and histograms describing the runtime behaviour of
+the scheduler, jobs and HTTP handlers, rendered in the Prometheus
+text exposition format.
+
+Metrics are declared at module level by the code they instrument, and
+are disabled by default: while disabled, updating a metric returns
+immediately without recording anything. Metrics are enabled from the
+"Metrics" section of a component, client or supervisor configuration
+by :func:`configure`, and then served by :class:`MetricsHandler`.
+
+"""
+
+import threading
+import logging
+import math
+import tornado.web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PATH = "/metrics"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_enabled = False
+# metrics by name, in order of declaration
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def enabled():
+    """Return True if metrics are being recorded."""
+    return _enabled
+
+def enable(state=True):
+    """Enable (or, with state=False, disable) recording of metrics."""
+    global _enabled
+    _enabled = state
+
+def configure(config):
+    """
+    Enable metrics if the configuration has a "Metrics" section whose
+    "enabled" key is true. Returns the path metrics should be served on,
+    or None if metrics are disabled.
+
+    """
+    if config is None or "Metrics" not in config:
+        return None
+    if not config["Metrics"].get("enabled", False):
+        return None
+
+    enable()
+    return config["Metrics"].get("path", DEFAULT_METRICS_PATH)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _label_str(names, values, extra=None):
+    pairs = ["%s=\"%s\"" % (n, _escape(v)) for (n, v) in zip(names, values)]
+    if extra is not None:
+        pairs.append("%s=\"%s\"" % extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def _number_str(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class _Metric(object):
+    """
+    Base class for metrics; registers the metric for rendering. A
+    metric declared with the name of a registered one replaces it, so
+    that e.g. a gauge bound to a new scheduler supersedes the gauge of
+    the previous one.
+
+    """
+    kind = None
+
+    def __init__(self, name, helptext, labels=()):
+        super(_Metric, self).__init__()
+        self.name = name
+        self.helptext = helptext
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with _metrics_lock:
+            _metrics.pop(name, None)
+            _metrics[name] = self
+
+    def __repr__(self):
+        return "<"+self.__class__.__name__+" "+self.name+">"
+
+    def render(self):
+        """Return this metric in Prometheus text format."""
+        lines = ["# HELP " + self.name + " " + self.helptext,
+                 "# TYPE " + self.name + " " + self.kind]
+        lines.extend(self._render_samples())
+        return "\n".join(lines) + "\n"
+
+class Counter(_Metric):
+    """A monotonically increasing count, optionally by label values."""
+    kind = "counter"
+
+    def __init__(self, name, helptext, labels=()):
+        super(Counter, self).__init__(name, helptext, labels)
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        """Increment the count for the given label values."""
+        if not _enabled:
+            return
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        """Return the count for the given label values."""
+        return self._values.get(labelvalues, 0)
+
+    def _render_samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [self.name + _label_str(self.labels, k) + " " + _number_str(v)
+                for (k, v) in items]
+
+class Gauge(_Metric):
+    """
+    A value which can go up and down. A gauge can be given a function
+    which is called at rendering time to read the current value.
+
+    """
+    kind = "gauge"
+
+    def __init__(self, name, helptext, function=None):
+        super(Gauge, self).__init__(name, helptext)
+        self._function = function
+        self._value = 0
+
+    def set(self, value):
+        """Set the value of the gauge."""
+        if not _enabled:
+            return
+        self._value = value
+
+    def value(self):
+        """Return the current value of the gauge."""
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def _render_samples(self):
+        try:
+            return [self.name + " " + _number_str(self.value())]
+        except Exception as e:
+            logger.warning("Metrics: cannot read gauge "+self.name+": "+str(e))
+            return []
+
+class Histogram(_Metric):
+    """
+    A distribution of observed values (e.g. latencies or sizes),
+    counted in cumulative buckets, optionally by label values.
+
+    """
+    kind = "histogram"
+
+    def __init__(self, name, helptext, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, helptext, labels)
+        self._bounds = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, *labelvalues):
+        """Record an observed value for the given label values."""
+        if not _enabled:
+            return
+        with self._lock:
+            entry = self._values.get(labelvalues, None)
+            if entry is None:
+                entry = [[0] * len(self._bounds), 0.0, 0]
+                self._values[labelvalues] = entry
+            for (i, bound) in enumerate(self._bounds):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labelvalues):
+        """Return the number of observations for the given label values."""
+        entry = self._values.get(labelvalues, None)
+        return entry[2] if entry is not None else 0
+
+    def _render_samples(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for (k, v) in self._values.items())
+        lines = []
+        for (k, (buckets, total, count)) in items:
+            cumulative = 0
+            for (bound, n) in zip(self._bounds, buckets):
+                cumulative += n
+                lines.append(self.name + "_bucket" +
+                             _label_str(self.labels, k, ("le", _number_str(bound))) +
+                             " " + str(cumulative))
+            lines.append(self.name + "_sum" + _label_str(self.labels, k) + " " + _number_str(total))
+            lines.append(self.name + "_count" + _label_str(self.labels, k) + " " + str(count))
+        return lines
+
+threads = Gauge("mplane_threads", "Number of live threads", threading.active_count)
+
+# shared by the component and client HTTP handlers
+http_request_seconds = Histogram("mplane_http_request_seconds",
+                    "HTTP request latency, by handler", ("handler",))
+serialization_seconds = Histogram("mplane_serialization_seconds",
+                    "Time to serialise mPlane messages to JSON")
+
+def remove(metric):
+    """Stop rendering a metric (e.g. a gauge bound to a discarded object)."""
+    with _metrics_lock:
+        if _metrics.get(metric.name) is metric:
+            del _metrics[metric.name]
+
+def render():
+    """Return all metrics in Prometheus text format."""
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return "".join(m.render() for m in metrics)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Serves all metrics in Prometheus text format, to the peers allowed
+    by an :class:`mplane.azn.EndpointAccess`, if one is given.
+
+    """
+    def initialize(self, tlsState=None, access=None):
+        self.tls = tlsState
+        self.access = access
+
+    def prepare(self):
+        if self.access is not None and not self.access.check(
+                self.tls.extract_peer_identity(self.request), self.request.remote_ip):
+            raise tornado.web.HTTPError(403)
+
+    def get(self):
+        self.set_status(200)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render())
+        self.finish()
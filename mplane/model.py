@@ -315,10 +315,13 @@ except ImportError:
 
 from datetime import datetime, timedelta, timezone
 from copy import copy, deepcopy
+import concurrent.futures
 import urllib.request
 import urllib.parse
 import collections
 import functools
+import threading
+import asyncio
 import operator
 import hashlib
 import logging
@@ -328,6 +331,7 @@ import re
 import os
 
 from mplane.utils import normalize_path
+import mplane.clock
 
 #######################################################################
 # logging
@@ -823,7 +827,7 @@ class When(object):
         """
 
         if tzero is None:
-            tzero = datetime.utcnow()
+            tzero = mplane.clock.utcnow()
 
         if self._a is time_now:
             start = tzero
@@ -870,7 +874,7 @@ class When(object):
         """
         Returns a tuple with delays for timers to signal the start and end of
         a temporal scope, given a specified time zero, which defaults to the
-        current system time.
+        current time (see :mod:`mplane.clock`).
 
         The start delay is defined to be zero if the scheduled start time has
         already passed or the temporal scope is immediate (i.e., starts now).
@@ -889,7 +893,7 @@ class When(object):
         """
         # default to current time
         if tzero is None:
-            tzero = datetime.utcnow()
+            tzero = mplane.clock.utcnow()
 
         # get datetimes
         (start, end) = self.datetimes(tzero=tzero)
@@ -928,7 +932,7 @@ class When(object):
                 return 0
             else:
                 if tzero is None:
-                    tzero = datetime.utcnow()
+                    tzero = mplane.clock.utcnow()
                 t = tzero
 
         # Get concrete time range
@@ -974,7 +978,7 @@ class When(object):
 
         # default to now, zero microseconds, initialize minus one second
         if tzero is None:
-            t = datetime.utcnow().replace(microsecond=0)
+            t = mplane.clock.utcnow().replace(microsecond=0)
         else:
             t = tzero
 
@@ -2385,6 +2389,12 @@ class Statement(object):
         argument of the appropriate statement constructor.
 
         """
+        if _codec_span is None:
+            return self._to_dict(token_only)
+        with _codec_span("to_dict"):
+            return self._to_dict(token_only)
+
+    def _to_dict(self, token_only):
         self.validate()
         d = collections.OrderedDict()
         d[self.kind_str()] = self._verb
@@ -2592,6 +2602,16 @@ class Specification(Statement):
         if self._schema_hash() != capability._schema_hash():
             return False
 
+        return self._fulfills_schema_match(capability)
+
+    def _fulfills_schema_match(self, capability):
+        """
+        Returns True if this Specification fulfills a Capability already
+        known to have the same schema; i.e., checks only temporal scope
+        and parameter constraints. Used by the scheduler to avoid
+        recomputing schema hashes within a schema index bucket.
+
+        """
         # Verify that the specification is within the capability's temporal scope
         if not self._when.follows(capability.when()):
             return False
@@ -2743,6 +2763,49 @@ class Result(Statement):
                 d[k] = self._resultcolumns[k][i]
             yield d
 
+    def append_rows(self, result):
+        """
+        Appends the result rows of another Result with the same result
+        columns (e.g. a batch of rows from a running measurement) to
+        this Result, extending its temporal scope to cover both.
+
+        """
+        start_index = self.count_result_rows()
+        end_index = start_index + result.count_result_rows()
+        for (name, col) in self._resultcolumns.items():
+            vals = col._vals
+            # pad short columns, so that rows line up
+            if len(vals) < start_index:
+                vals.extend([None] * (start_index - len(vals)))
+            if name in result._resultcolumns:
+                vals.extend(result._resultcolumns[name]._vals)
+            if len(vals) < end_index:
+                vals.extend([None] * (end_index - len(vals)))
+
+        if start_index == 0 and not self._when.is_definite():
+            self._when = result._when
+        elif result._when.is_definite():
+            (start, end) = self._when.datetimes()
+            (rstart, rend) = result._when.datetimes()
+            self._when = When(a=min(start, rstart), b=max(end, rend))
+
+    def slice_rows(self, start, stop=None):
+        """
+        Returns a new Result with the same parameters, metadata and
+        temporal scope as this one, holding the result rows from start
+        up to (but not including) stop.
+
+        """
+        res = Result(verb=self._verb, label=self._label, token=self._token,
+                     when=self._when)
+        res._reguri = self._reguri
+        res._metadata = self._metadata
+        res._params = deepcopy(self._params)
+        for (name, col) in self._resultcolumns.items():
+            res._resultcolumns[name] = ResultColumn(col)
+            res._resultcolumns[name]._vals = col._vals[start:stop]
+        return res
+
 
 #######################################################################
 # Notifications
@@ -2931,11 +2994,13 @@ class Envelope(object):
 
     """
 
-    def __init__(self, dictval=None, content_type=ENVELOPE_MESSAGE, token=None, label=None, when=None):
+    def __init__(self, dictval=None, content_type=ENVELOPE_MESSAGE, token=None, label=None, when=None,
+                 max_messages=None):
         super().__init__()
 
         self._version = MPLANE_VERSION
-        self._messages = []
+        # with max_messages, a ring buffer keeping only the latest messages
+        self._messages = collections.deque(maxlen=max_messages or None)
         self._content_type = content_type
         self._token = token
         self._label = label
@@ -2964,10 +3029,16 @@ class Envelope(object):
 
     def trim(self, n):
         """ Removes everything except the last n elements """
-        del self._messages[:-n]
+        if n > 0:
+            while len(self._messages) > n:
+                self._messages.popleft()
 
     def append_message(self, msg):
-        """ Appends a message to an Envelope """
+        """
+        Appends a message to an Envelope; if the Envelope holds
+        max_messages already, the oldest message is dropped.
+
+        """
         self._messages.append(msg)
 
     def last_message(self): 
@@ -2977,7 +3048,8 @@ class Envelope(object):
 
     def messages(self):
         """ Returns an iterator to iterate over all messages in an Envelope """
-        return iter(self._messages)
+        # iterate over a snapshot, as messages may be appended concurrently
+        return iter(list(self._messages))
 
     def kind_str(self):
         return KIND_ENVELOPE
@@ -3062,12 +3134,29 @@ def message_from_dict(d):
             return classmap[k](dictval = d)
     raise ValueError("Cannot determine message type from "+repr(d))
 
+# Context manager factory wrapped around encoding and decoding, called
+# with the name of the codec function; set by mplane.profiling.
+_codec_span = None
+
+def set_codec_span(fn):
+    """
+    Set a function returning a context manager to enter around each
+    parse_json(), unparse_json() and Statement.to_dict(), given the
+    name of the function; None removes it.
+
+    """
+    global _codec_span
+    _codec_span = fn
+
 def parse_json(jstr):
     """
     Parse a JSON object in a string and return the associated mPlane message.
 
     """
-    return message_from_dict(json.loads(jstr))
+    if _codec_span is None:
+        return message_from_dict(json.loads(jstr))
+    with _codec_span("parse_json"):
+        return message_from_dict(json.loads(jstr))
 
 def unparse_json(msg, token_only=False):
     """
@@ -3076,8 +3165,65 @@ def unparse_json(msg, token_only=False):
     appropriate (i.e. Reciepts, Redemptions, Withdrawals, and Interrupts).
 
     """
-    return json.dumps(msg.to_dict(token_only=token_only),
-                      sort_keys=True, indent=2, separators=(',',': '))
+    if _codec_span is None:
+        return json.dumps(msg.to_dict(token_only=token_only),
+                          sort_keys=True, indent=2, separators=(',',': '))
+    with _codec_span("unparse_json"):
+        return json.dumps(msg.to_dict(token_only=token_only),
+                          sort_keys=True, indent=2, separators=(',',': '))
+
+# Messages at least this large, in characters of JSON or rows of results,
+# are decoded or encoded on the codec thread pool by the async codecs.
+CODEC_OFFLOAD_BYTES = 65536
+CODEC_OFFLOAD_ROWS = 1000
+CODEC_THREADS = 4
+
+_codec_executor = None
+_codec_executor_lock = threading.Lock()
+
+def codec_executor():
+    """
+    Return the thread pool on which parse_json_async() and
+    unparse_json_async() run large messages.
+
+    """
+    global _codec_executor
+    with _codec_executor_lock:
+        if _codec_executor is None:
+            _codec_executor = concurrent.futures.ThreadPoolExecutor(
+                                    max_workers=CODEC_THREADS,
+                                    thread_name_prefix="mplane-codec")
+        return _codec_executor
+
+def _message_rows(msg):
+    if isinstance(msg, Envelope):
+        return sum(_message_rows(m) for m in msg.messages())
+    if isinstance(msg, Result):
+        return msg.count_result_rows()
+    return 0
+
+async def parse_json_async(jstr):
+    """
+    Coroutine version of parse_json(), for event loop handlers. Large
+    strings are parsed on the codec thread pool, so that the event loop
+    can serve other requests meanwhile.
+
+    """
+    if len(jstr) < CODEC_OFFLOAD_BYTES:
+        return parse_json(jstr)
+    return await asyncio.get_running_loop().run_in_executor(
+                    codec_executor(), parse_json, jstr)
+
+async def unparse_json_async(msg, token_only=False):
+    """
+    Coroutine version of unparse_json(), for event loop handlers.
+    Messages with many result rows are encoded on the codec thread pool.
+
+    """
+    if _message_rows(msg) < CODEC_OFFLOAD_ROWS:
+        return unparse_json(msg, token_only)
+    return await asyncio.get_running_loop().run_in_executor(
+                    codec_executor(), functools.partial(unparse_json, msg, token_only))
 
 def parse_yaml(ystr):
     return message_from_dict(yaml.load(ystr))
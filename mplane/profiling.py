@@ -0,0 +1,408 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Profiling hooks
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Pluggable profiling hooks around job runs, message encoding and
+decoding, and HTTP handlers.
+
+Instrumented code wraps its work in :func:`span`, naming a hook point
+(one of :data:`JOB`, :data:`JOB_COROUTINE`, :data:`CODEC` or
+:data:`HTTP`) and a name within it (the capability label, codec
+function or handler class). A hook is a callable taking the point and
+the name and returning a context manager, which is entered around the
+work; hooks are added to a point with :func:`add_hook`. While no hook
+is registered on a point, :func:`span` returns a shared no-op context
+manager.
+
+:func:`configure` installs the built-in hooks from the "Profiling"
+section of a configuration: wall and CPU timing of jobs, codecs and
+handlers (:class:`TimingHook`), sampled cProfile capture of job runs
+by service (:class:`ProfileSampler`), and optionally tracemalloc
+allocation snapshots. Results are written to a spool directory, and
+summarised by :class:`DiagnosticsHandler`.
+
+"""
+
+import collections
+import tracemalloc
+import threading
+import cProfile
+import logging
+import pstats
+import random
+import queue
+import json
+import time
+import io
+import os
+import tornado.web
+import mplane.model
+
+logger = logging.getLogger(__name__)
+
+JOB = "job"
+JOB_COROUTINE = "job_coroutine"
+CODEC = "codec"
+HTTP = "http"
+
+POINTS = (JOB, JOB_COROUTINE, CODEC, HTTP)
+
+DEFAULT_DIAGNOSTICS_PATH = "/diagnostics"
+DEFAULT_TRACEMALLOC_FRAMES = 1
+DIAGNOSTICS_ALLOCATIONS = 25
+PROFILE_SUMMARY_LINES = 30
+
+# CPU time is only meaningful for points which run on one thread without
+# yielding to other work; coroutine jobs and handlers share their thread.
+_CPU_POINTS = (JOB, CODEC)
+
+# point -> tuple of hooks; replaced, never mutated, so span() needs no lock
+_hooks = {}
+_hooks_lock = threading.Lock()
+
+_timing = None
+_sampler = None
+_diagnostics_path = None
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _SpanGroup(object):
+    def __init__(self, spans):
+        self._spans = spans
+
+    def __enter__(self):
+        for s in self._spans:
+            s.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for s in reversed(self._spans):
+            s.__exit__(exc_type, exc_value, traceback)
+        return False
+
+def span(point, name):
+    """
+    Return a context manager to wrap around work at the given hook
+    point, entering the contexts of all hooks registered on the point.
+
+    """
+    hooks = _hooks.get(point, None)
+    if not hooks:
+        return _NULL_SPAN
+    if len(hooks) == 1:
+        return hooks[0](point, name)
+    return _SpanGroup([hook(point, name) for hook in hooks])
+
+def _codec_span(name):
+    return span(CODEC, name)
+
+def add_hook(point, hook):
+    """
+    Register a hook on a hook point. hook(point, name) is called at each
+    span of the point, and must return a context manager.
+
+    """
+    if point not in POINTS:
+        raise ValueError("Unknown profiling hook point "+repr(point))
+    with _hooks_lock:
+        _hooks[point] = _hooks.get(point, ()) + (hook,)
+        if point == CODEC:
+            mplane.model.set_codec_span(_codec_span)
+
+def remove_hook(point, hook):
+    """Remove a hook previously registered on a hook point."""
+    with _hooks_lock:
+        hooks = tuple(h for h in _hooks.get(point, ()) if h is not hook)
+        if len(hooks):
+            _hooks[point] = hooks
+        else:
+            _hooks.pop(point, None)
+            if point == CODEC:
+                mplane.model.set_codec_span(None)
+
+class _TimingSpan(object):
+    def __init__(self, hook, point, name):
+        self._hook = hook
+        self._point = point
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        if self._point in _CPU_POINTS:
+            self._cpu = time.thread_time()
+        else:
+            self._cpu = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = None
+        if self._cpu is not None:
+            cpu = time.thread_time() - self._cpu
+        self._hook.record(self._point, self._name, wall, cpu)
+        return False
+
+class TimingHook(object):
+    """
+    Accumulates wall and (where meaningful) CPU time by hook point and
+    name. If a spool directory is given, each job's timing is also
+    appended to jobs.ndjson there, by a writer thread so that no file
+    I/O happens while the timings are locked.
+
+    """
+    def __init__(self, spool=None):
+        super(TimingHook, self).__init__()
+        self._spool = spool
+        self._lock = threading.Lock()
+        self._timings = collections.defaultdict(dict)
+        self._records = None
+        if spool is not None:
+            self._records = queue.Queue()
+            threading.Thread(target=self._write_records, daemon=True,
+                             name="mplane-profiling-spool").start()
+
+    def __call__(self, point, name):
+        return _TimingSpan(self, point, name)
+
+    def record(self, point, name, wall, cpu=None):
+        """Record one span of the given point and name."""
+        with self._lock:
+            entry = self._timings[point].get(name, None)
+            if entry is None:
+                entry = {"count": 0, "wall_total": 0.0, "wall_max": 0.0}
+                if cpu is not None:
+                    entry["cpu_total"] = 0.0
+                self._timings[point][name] = entry
+            entry["count"] += 1
+            entry["wall_total"] += wall
+            entry["wall_max"] = max(entry["wall_max"], wall)
+            if cpu is not None:
+                entry["cpu_total"] += cpu
+
+        if self._records is not None and point in (JOB, JOB_COROUTINE):
+            self._records.put({"time": time.time(), "service": name,
+                               "wall": wall, "cpu": cpu})
+
+    def _write_records(self):
+        path = os.path.join(self._spool, "jobs.ndjson")
+        while True:
+            # write everything queued so far in one go
+            records = [self._records.get()]
+            try:
+                while True:
+                    records.append(self._records.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                with open(path, "a") as f:
+                    f.write("".join(json.dumps(r) + "\n" for r in records))
+            except OSError as e:
+                logger.warning("Profiling: cannot write "+path+": "+str(e))
+            finally:
+                for r in records:
+                    self._records.task_done()
+
+    def flush(self):
+        """Wait until all job timings recorded so far are spooled."""
+        if self._records is not None:
+            self._records.join()
+
+    def stats(self):
+        """Return accumulated timings as point -> name -> totals."""
+        with self._lock:
+            return {point: {name: dict(entry) for (name, entry) in names.items()}
+                    for (point, names) in self._timings.items()}
+
+class _ProfileSpan(object):
+    def __init__(self, sampler, name):
+        self._sampler = sampler
+        self._name = name
+        self._profile = cProfile.Profile()
+
+    def __enter__(self):
+        try:
+            self._profile.enable()
+        except ValueError as e:
+            # another profiler is already active on this interpreter
+            logger.debug("Profiling: cannot sample "+self._name+": "+str(e))
+            self._profile = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._profile is not None:
+            self._profile.disable()
+            self._sampler._sampled(self._name, self._profile)
+        return False
+
+class ProfileSampler(object):
+    """
+    Runs cProfile over a sampled fraction of job runs, optionally only
+    for the given capability labels. The profile of the most recent
+    sample of each service is kept in summary; if a spool directory is
+    given, every sample is dumped there as a pstats file (and, while
+    tracemalloc is tracing, with an allocation snapshot).
+
+    """
+    def __init__(self, sample_rate, services=None, spool=None):
+        super(ProfileSampler, self).__init__()
+        self._sample_rate = sample_rate
+        self._services = None if services is None else frozenset(services)
+        self._spool = spool
+        self._lock = threading.Lock()
+        self._serial = 0
+        self._summaries = {}
+
+    def __call__(self, point, name):
+        if self._services is not None and name not in self._services:
+            return _NULL_SPAN
+        if random.random() >= self._sample_rate:
+            return _NULL_SPAN
+        return _ProfileSpan(self, name)
+
+    def _sampled(self, name, profile):
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+        with self._lock:
+            self._summaries[name] = out.getvalue()
+            self._serial += 1
+            serial = self._serial
+
+        if self._spool is not None:
+            stem = os.path.join(self._spool, "%s-%d-%d-%d" %
+                                (name, os.getpid(), int(time.time()), serial))
+            profile.dump_stats(stem + ".prof")
+            if tracemalloc.is_tracing():
+                tracemalloc.take_snapshot().dump(stem + ".tracemalloc")
+
+    def summaries(self):
+        """Return the most recent profile summary of each sampled service."""
+        with self._lock:
+            return dict(self._summaries)
+
+def configure(config):
+    """
+    Install the built-in hooks if the configuration has a "Profiling"
+    section whose "enabled" key is true. Returns the path diagnostics
+    should be served on, or None if profiling is disabled. Only the
+    first enabling configuration in a process takes effect.
+
+    """
+    global _timing, _sampler, _diagnostics_path
+
+    if config is None or "Profiling" not in config:
+        return None
+    pconfig = config["Profiling"]
+    if not pconfig.get("enabled", False):
+        return None
+
+    with _hooks_lock:
+        if _diagnostics_path is not None:
+            return _diagnostics_path
+        _diagnostics_path = pconfig.get("path", DEFAULT_DIAGNOSTICS_PATH)
+
+    spool = pconfig.get("spool", None)
+    if spool is not None:
+        os.makedirs(spool, exist_ok=True)
+
+    if pconfig.get("timing", True):
+        _timing = TimingHook(spool)
+        for point in POINTS:
+            add_hook(point, _timing)
+
+    sample_rate = float(pconfig.get("sample_rate", 0))
+    if sample_rate > 0:
+        _sampler = ProfileSampler(sample_rate, pconfig.get("services", None), spool)
+        add_hook(JOB, _sampler)
+
+    if pconfig.get("tracemalloc", False) and not tracemalloc.is_tracing():
+        tracemalloc.start(int(pconfig.get("tracemalloc_frames", DEFAULT_TRACEMALLOC_FRAMES)))
+
+    logger.info("Profiling enabled, diagnostics on "+_diagnostics_path)
+    return _diagnostics_path
+
+def flush():
+    """Wait until all job timings recorded so far are spooled."""
+    timing = _timing
+    if timing is not None:
+        timing.flush()
+
+def reset():
+    """
+    Remove all hooks, after spooling any pending job timings, and stop
+    tracemalloc tracing.
+
+    """
+    global _timing, _sampler, _diagnostics_path
+    flush()
+    with _hooks_lock:
+        _hooks.clear()
+        mplane.model.set_codec_span(None)
+        _timing = None
+        _sampler = None
+        _diagnostics_path = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def diagnostics():
+    """
+    Return a dictionary of timings, the most recent profile summary by
+    service and, while tracemalloc is tracing, the largest allocations.
+
+    """
+    d = collections.OrderedDict()
+    if _timing is not None:
+        d["timings"] = _timing.stats()
+    if _sampler is not None:
+        d["profiles"] = _sampler.summaries()
+    if tracemalloc.is_tracing():
+        stats = tracemalloc.take_snapshot().statistics("lineno")
+        d["allocations"] = [str(s) for s in stats[:DIAGNOSTICS_ALLOCATIONS]]
+    return d
+
+class DiagnosticsHandler(tornado.web.RequestHandler):
+    """
+    Serves profiling diagnostics as JSON, to the peers allowed by an
+    :class:`mplane.azn.EndpointAccess`, if one is given.
+
+    """
+    def initialize(self, tlsState=None, access=None):
+        self.tls = tlsState
+        self.access = access
+
+    def prepare(self):
+        if self.access is not None and not self.access.check(
+                self.tls.extract_peer_identity(self.request), self.request.remote_ip):
+            raise tornado.web.HTTPError(403)
+
+    def get(self):
+        self.set_status(200)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(diagnostics(), sort_keys=True, indent=2))
+        self.finish()
@@ -28,14 +28,47 @@ results within the mPlane reference component.
 
 """
 
-from datetime import datetime
+import concurrent.futures
+import concurrent.futures.process
+import asyncio
+import inspect
+import multiprocessing
 import threading
+import collections
+import itertools
 import logging
+import heapq
+import json
+import time
 import mplane.model
+import mplane.clock
 import mplane.azn
+import mplane.utils
+import mplane.metrics
+import mplane.profiling
+import mplane.jobstore
 
 logger = logging.getLogger(__name__)
 
+_submissions = mplane.metrics.Counter("mplane_scheduler_submissions_total",
+                    "Specifications submitted to the scheduler, by outcome",
+                    ("outcome",))
+_match_seconds = mplane.metrics.Histogram("mplane_scheduler_match_seconds",
+                    "Time to match a specification to a service")
+_queue_wait_seconds = mplane.metrics.Histogram("mplane_job_queue_wait_seconds",
+                    "Time jobs waited in the run queue for a worker")
+_run_seconds = mplane.metrics.Histogram("mplane_job_run_seconds",
+                    "Time jobs spent running, by capability label",
+                    ("capability",))
+_result_bytes = mplane.metrics.Histogram("mplane_job_result_bytes",
+                    "Approximate size of job results",
+                    buckets=mplane.metrics.SIZE_BUCKETS)
+_jobs_ended = mplane.metrics.Counter("mplane_jobs_ended_total",
+                    "Jobs ended, by outcome", ("outcome",))
+
+EXECUTION_THREAD = "thread"
+EXECUTION_PROCESS = "process"
+
 class Service(object):
     """
     A Service binds some runnable code to an
@@ -45,7 +78,25 @@ class Service(object):
     mplane.scheduler.Service or one of its subclasses
     and implement run().
 
+    Services run in a worker thread by default. CPU-bound services
+    can set execution_mode to EXECUTION_PROCESS to have run() called
+    in a pool of worker processes instead; such services must be
+    picklable, and their classes importable by module name, as they
+    are sent to the (spawned) worker process for each run.
+
+    I/O-bound services can implement run() as a coroutine (async def);
+    it is then run as a task on the scheduler's event loop thread, and
+    interrupted by cancelling the task.
+
+    Long-running services can implement run() as a generator, yielding
+    Results each holding a batch of rows as they are measured. The rows
+    are accumulated by the Job running the service, and made available
+    to clients before the service has finished. Generator services run
+    in a worker thread, whatever their execution_mode.
+
     """
+    execution_mode = EXECUTION_THREAD
+
     def __init__(self, capability):
         super(Service, self).__init__()
         self._capability = capability
@@ -84,6 +135,589 @@ class Service(object):
     def __repr__(self):
         return "<Service for "+repr(self._capability)+">"
 
+    def __getstate__(self):
+        # capabilities cross process boundaries in dictionary form
+        state = self.__dict__.copy()
+        state["_capability"] = self._capability.to_dict()
+        return state
+
+    def __setstate__(self, state):
+        state["_capability"] = mplane.model.message_from_dict(state["_capability"])
+        self.__dict__.update(state)
+
+
+class Timer(object):
+    """
+    A handle for a function call scheduled on a TimerQueue.
+    Cancel the call with cancel().
+
+    """
+    def __init__(self, queue, deadline, function, args):
+        super(Timer, self).__init__()
+        self._queue = queue
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def __repr__(self):
+        return "<Timer for "+repr(self.function)+" at "+str(self.deadline)+">"
+
+    def cancel(self):
+        """Cancel this timer, if it has not yet fired."""
+        self._queue.cancel(self)
+
+
+class TimerQueue(object):
+    """
+    Runs scheduled function calls from a single thread, using a heap
+    of deadlines on the monotonic clock. Replaces one threading.Timer
+    (and therefore one OS thread) per scheduled start and interrupt.
+
+    Scheduled functions run on the timer thread, and should
+    therefore return quickly. A queue on a simulated clock (by default,
+    the clock in use when the queue is created) has no thread; its
+    timers are fired as the clock is advanced.
+
+    """
+    def __init__(self, clock=None):
+        super(TimerQueue, self).__init__()
+        if clock is None:
+            clock = mplane.clock.get_clock()
+        self._clock = clock
+        self._clock.attach(self)
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._cancelled = 0
+
+        # firing statistics
+        self.fired = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    def call_later(self, delay, function, *args):
+        """
+        Call function(*args) after delay seconds.
+        Returns a Timer which can be used to cancel the call.
+
+        """
+        timer = Timer(self, self._clock.monotonic() + delay, function, args)
+        with self._cond:
+            heapq.heappush(self._heap, (timer.deadline, next(self._seq), timer))
+            if self._thread is None and not self._clock.simulated:
+                self._thread = threading.Thread(target=self._run,
+                                                name="mplane-timers")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a pending timer. Cancelled timers are dropped
+        lazily as they reach the head of the queue.
+
+        """
+        with self._cond:
+            if not timer.cancelled and not timer.fired:
+                timer.cancelled = True
+                self._cancelled += 1
+
+                # compact the heap if it is mostly cancelled timers
+                if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                    self._heap = [e for e in self._heap if not e[2].cancelled]
+                    heapq.heapify(self._heap)
+                    self._cancelled = 0
+
+    def backlog(self):
+        """Return the number of timers waiting to fire."""
+        with self._cond:
+            return len(self._heap) - self._cancelled
+
+    def stats(self):
+        """
+        Return a dictionary of timer statistics: the backlog of pending
+        timers, the number of timers fired, and the mean and maximum
+        firing lag (delay between deadline and call) in seconds.
+
+        """
+        with self._cond:
+            return { "backlog": len(self._heap) - self._cancelled,
+                     "fired": self.fired,
+                     "lag_mean": self.lag_total / self.fired if self.fired else 0.0,
+                     "lag_max": self.lag_max }
+
+    def next_deadline(self):
+        """
+        Return the deadline of the next timer to fire on this queue's
+        clock, or None if no timers are waiting.
+
+        """
+        with self._cond:
+            self._drop_cancelled()
+            if len(self._heap) == 0:
+                return None
+            return self._heap[0][0]
+
+    def fire_due(self):
+        """
+        Fire the timers whose deadlines have passed on the calling
+        thread, as a simulated clock does when advanced. Returns the
+        number of timers fired.
+
+        """
+        fired = 0
+        while True:
+            with self._cond:
+                timer = self._pop_due()
+            if timer is None:
+                return fired
+            self._fire(timer)
+            fired += 1
+
+    def _drop_cancelled(self):
+        # drop cancelled timers at the head of the queue
+        while len(self._heap) and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def _pop_due(self):
+        # called with the condition held
+        self._drop_cancelled()
+        if len(self._heap) == 0 or self._heap[0][0] > self._clock.monotonic():
+            return None
+
+        timer = heapq.heappop(self._heap)[2]
+        timer.fired = True
+        lag = self._clock.monotonic() - timer.deadline
+        self.fired += 1
+        self.lag_total += lag
+        if lag > self.lag_max:
+            self.lag_max = lag
+        return timer
+
+    def _fire(self, timer):
+        try:
+            timer.function(*timer.args)
+        except Exception as e:
+            logger.exception("Timer "+repr(timer)+" failed: "+str(e))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                timer = self._pop_due()
+                while timer is None:
+                    if len(self._heap) == 0:
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(self._heap[0][0] - self._clock.monotonic())
+                    timer = self._pop_due()
+
+            self._fire(timer)
+
+_default_timers = None
+_default_timers_lock = threading.Lock()
+
+def default_timer_queue():
+    """
+    Return the process-wide TimerQueue used by Jobs
+    which were not given one explicitly.
+
+    """
+    global _default_timers
+    with _default_timers_lock:
+        if _default_timers is None:
+            _default_timers = TimerQueue()
+        return _default_timers
+
+
+DEFAULT_WORKERS = 256
+DEFAULT_QUEUE_LIMIT = 4096
+
+class WorkerPool(object):
+    """
+    Runs job functions on a bounded set of worker threads, fed from a
+    bounded run queue. Worker threads are started as needed up to the
+    configured number, and then reused.
+
+    Concurrency can additionally be limited per service, by capability
+    label; queued work for a service at its limit waits until one of
+    that service's runs finishes, without blocking other services.
+
+    Queued work is divided into flows (e.g. by priority class and
+    identity), served by weighted fair queuing: each flow gets a share
+    of the runs started proportional to its weight, so that a flow with
+    a deep queue cannot starve others. Work within a flow runs in order.
+
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, queue_limit=DEFAULT_QUEUE_LIMIT,
+                 service_limits=None):
+        super(WorkerPool, self).__init__()
+        self._max_workers = int(workers)
+        self._queue_limit = int(queue_limit)
+        self._service_limits = {}
+        if service_limits is not None:
+            for label in service_limits:
+                self._service_limits[label] = int(service_limits[label])
+
+        # flow -> deque of (finish tag, queued at, label, function, args)
+        self._flows = collections.OrderedDict()
+        self._finish_tags = {}
+        self._vtime = 0.0
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._workers = 0
+        self._idle = 0
+        self._running = 0
+        self._running_by_label = {}
+
+        # queueing statistics
+        self.submitted = 0
+        self.rejected = 0
+        self.started = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __repr__(self):
+        return "<WorkerPool "+str(self._workers)+"/"+str(self._max_workers)+\
+               " workers, "+str(self._queued)+" queued>"
+
+    def saturated(self):
+        """Return True if the run queue is full."""
+        with self._cond:
+            return self._queued >= self._queue_limit
+
+    def submit(self, label, function, *args, flow=None, weight=1):
+        """
+        Queue function(*args) to run on a worker thread, counting
+        against the concurrency limit of the service with the given
+        label, in the given flow with the given weight. Returns False,
+        without queueing, if the run queue is full.
+
+        """
+        with self._cond:
+            if self._queued >= self._queue_limit:
+                self.rejected += 1
+                return False
+
+            # each run costs 1/weight of virtual time in its flow
+            start = max(self._vtime, self._finish_tags.get(flow, 0.0))
+            tag = start + 1.0 / weight
+            self._finish_tags[flow] = tag
+            if flow not in self._flows:
+                self._flows[flow] = collections.deque()
+            self._flows[flow].append((tag, time.monotonic(), label, function, args))
+            self._queued += 1
+            self.submitted += 1
+
+            if self._idle == 0 and self._workers < self._max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name="mplane-worker-"+str(self._workers))
+                worker.daemon = True
+                worker.start()
+            else:
+                self._cond.notify()
+            return True
+
+    def join(self, timeout=None):
+        """
+        Wait until no runs are queued or running, for at most timeout
+        seconds if given. Returns True if the pool is idle.
+
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._queued == 0 and self._running == 0,
+                                       timeout)
+
+    def queue_depth(self):
+        """Return the number of runs waiting for a worker."""
+        with self._cond:
+            return self._queued
+
+    def stats(self):
+        """
+        Return a dictionary of pool statistics: worker threads, running
+        and queued runs, flows with queued runs, runs submitted and
+        rejected, and the mean and maximum time in seconds runs have
+        waited in the queue.
+
+        """
+        with self._cond:
+            return { "workers": self._workers,
+                     "running": self._running,
+                     "queued": self._queued,
+                     "flows": len(self._flows),
+                     "submitted": self.submitted,
+                     "rejected": self.rejected,
+                     "wait_mean": self.wait_total / self.started if self.started else 0.0,
+                     "wait_max": self.wait_max }
+
+    def _next_task(self):
+        # of the first task in each flow whose service is below its
+        # limit, take the one with the earliest finish tag
+        best = None
+        for (flow, tasks) in self._flows.items():
+            for (i, task) in enumerate(tasks):
+                limit = self._service_limits.get(task[2], None)
+                if limit is None or self._running_by_label.get(task[2], 0) < limit:
+                    if best is None or task[0] < best[0][0]:
+                        best = (task, flow, i)
+                    break
+        if best is None:
+            return None
+
+        (task, flow, i) = best
+        tasks = self._flows[flow]
+        del tasks[i]
+        if len(tasks) == 0:
+            # an idle flow starts again at the current virtual time
+            del self._flows[flow]
+            del self._finish_tags[flow]
+        self._queued -= 1
+        self._vtime = max(self._vtime, task[0])
+        return task[1:]
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    task = self._next_task()
+
+                (queued_at, label, function, args) = task
+                wait = time.monotonic() - queued_at
+                _queue_wait_seconds.observe(wait)
+                self.started += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+                self._running += 1
+                self._running_by_label[label] = self._running_by_label.get(label, 0) + 1
+
+            try:
+                function(*args)
+            except Exception as e:
+                logger.exception("Worker task "+repr(function)+" failed: "+str(e))
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._running_by_label[label] -= 1
+                    if self._running_by_label[label] == 0:
+                        del self._running_by_label[label]
+                    # a service slot is free; queued work may now run
+                    if self._queued:
+                        self._cond.notify()
+                    elif self._running == 0:
+                        # wake join()
+                        self._cond.notify_all()
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def default_worker_pool():
+    """
+    Return the process-wide WorkerPool used by Jobs
+    which were not given one explicitly.
+
+    """
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = WorkerPool()
+        return _default_pool
+
+
+DEFAULT_PROCESS_SLOTS = 1024
+PROCESS_POLL_INTERVAL = 0.1
+
+# interrupt flags shared with the parent, set in each worker process
+_process_interrupts = None
+
+def _process_init(interrupts, registry_uri):
+    global _process_interrupts
+    _process_interrupts = interrupts
+    if mplane.model.registry_for_uri(None) is None:
+        mplane.model.initialize_registry(registry_uri)
+
+def _process_run(service, specdict, slot):
+    specification = mplane.model.message_from_dict(specdict)
+
+    def check_interrupt():
+        return _process_interrupts[slot] != 0
+
+    return service.run(specification, check_interrupt).to_dict()
+
+class ProcessRunner(object):
+    """
+    Runs services in a pool of worker processes, for Services whose
+    execution_mode is EXECUTION_PROCESS. Specifications and results
+    cross the process boundary in dictionary form; interrupts are
+    signaled to the worker through a flag in shared memory.
+
+    run() blocks the calling (worker) thread until the run completes.
+    The process pool is started on first use.
+
+    """
+    def __init__(self, processes=None, slots=DEFAULT_PROCESS_SLOTS):
+        super(ProcessRunner, self).__init__()
+        if processes is not None:
+            processes = int(processes)
+        self._processes = processes
+        # spawn, rather than fork a process which may be running threads
+        self._context = multiprocessing.get_context("spawn")
+        self._interrupts = self._context.Array('b', slots, lock=False)
+        self._free_slots = list(range(slots))
+        self._slot_cond = threading.Condition()
+        self._executor = None
+        self.runs = 0
+
+    def __repr__(self):
+        return "<ProcessRunner ("+str(self.runs)+" runs)>"
+
+    def _get_executor(self):
+        with self._slot_cond:
+            if self._executor is None:
+                base_registry = mplane.model.registry_for_uri(None)
+                registry_uri = base_registry.uri() if base_registry is not None else None
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self._processes,
+                        mp_context=self._context,
+                        initializer=_process_init,
+                        initargs=(self._interrupts, registry_uri))
+            return self._executor
+
+    def run(self, service, specification, interrupt):
+        """
+        Run a service on the given specification in a worker process,
+        propagating the given interrupt Event, and return its Result.
+        Exceptions raised by the service are raised here.
+
+        """
+        executor = self._get_executor()
+
+        with self._slot_cond:
+            while len(self._free_slots) == 0:
+                self._slot_cond.wait()
+            slot = self._free_slots.pop()
+            self._interrupts[slot] = 0
+            self.runs += 1
+
+        try:
+            future = executor.submit(_process_run, service,
+                                     specification.to_dict(), slot)
+            while True:
+                try:
+                    resdict = future.result(timeout=PROCESS_POLL_INTERVAL)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if interrupt.is_set():
+                        self._interrupts[slot] = 1
+            return mplane.model.message_from_dict(resdict)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker process died: fail this run, and start a new pool
+            # for the next ones
+            with self._slot_cond:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+            raise
+        finally:
+            with self._slot_cond:
+                self._free_slots.append(slot)
+                self._slot_cond.notify()
+
+    def shutdown(self):
+        """Stop the worker processes, if started."""
+        with self._slot_cond:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown()
+
+_default_processes = None
+_default_processes_lock = threading.Lock()
+
+def default_process_runner():
+    """
+    Return the process-wide ProcessRunner used by Jobs
+    which were not given one explicitly.
+
+    """
+    global _default_processes
+    with _default_processes_lock:
+        if _default_processes is None:
+            _default_processes = ProcessRunner()
+        return _default_processes
+
+
+class EventLoopRunner(object):
+    """
+    Runs coroutines as tasks on an asyncio event loop in a single
+    thread, for Services implementing run() as a coroutine.
+    The loop thread is started on first use.
+
+    """
+    def __init__(self):
+        super(EventLoopRunner, self).__init__()
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<EventLoopRunner>"
+
+    def loop(self):
+        """Return the event loop, starting its thread if necessary."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever,
+                                          name="mplane-asyncio")
+                thread.daemon = True
+                thread.start()
+            return self._loop
+
+    def start(self, coro):
+        """Start a task for the given coroutine on the event loop."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    def cancel(self, task):
+        """Cancel a task running on the event loop."""
+        self.loop().call_soon_threadsafe(task.cancel)
+
+    def call_in_thread(self, function, *args):
+        """
+        Call function(*args) on a thread of the loop's default
+        executor, keeping blocking calls off the loop thread.
+
+        """
+        self.loop().run_in_executor(None, function, *args)
+
+_default_loop = None
+_default_loop_lock = threading.Lock()
+
+def default_event_loop():
+    """
+    Return the process-wide EventLoopRunner used by Jobs
+    which were not given one explicitly.
+
+    """
+    global _default_loop
+    with _default_loop_lock:
+        if _default_loop is None:
+            _default_loop = EventLoopRunner()
+        return _default_loop
+
+
+JOB_WAITING = "waiting"
+JOB_STARTED = "started"
+JOB_ENDED = "ended"
 
 class Job(object):
     """
@@ -92,10 +726,13 @@ class Job(object):
     instance of a Service presently running, or ready to run at some
     point in the future.
 
-    Each Job will result in a single Result.
+    Each Job will result in a single Result. The rows of a Result
+    produced in batches by a generator service are accumulated as
+    they arrive, and can be redeemed incrementally.
     """
     result = None
     exception = None
+    _rows = None
     _thread = None
     _started_at = None
     _ended_at = None
@@ -106,8 +743,16 @@ class Job(object):
     specification = None
     receipt = None
     _interrupt = None
-
-    def __init__(self, service, specification, session=None, callback=None):
+    _start_timer = None
+    _end_timer = None
+    _task = None
+    _result_size = None
+    # None, then JOB_WAITING while the start timer runs, then JOB_STARTED;
+    # or JOB_ENDED if the job fails before it starts
+    _start_state = None
+
+    def __init__(self, service, specification, session=None, callback=None,
+                 timers=None, pool=None, processes=None, loop=None, priority=None):
         super(Job, self).__init__()
         self.service = service
         self.session = session
@@ -115,32 +760,196 @@ class Job(object):
         self.receipt = mplane.model.Receipt(specification=specification)
         self._interrupt = threading.Event()
         self._callback = callback
+        self._callbacks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._subscribers = collections.Counter()
+        if timers is None:
+            timers = default_timer_queue()
+        self._timers = timers
+        if pool is None:
+            pool = default_worker_pool()
+        self._pool = pool
+        self._processes = processes
+        self._loop = loop
+        # (flow, weight) of this job's runs in the worker pool
+        if priority is None:
+            priority = (None, 1)
+        self._priority = priority
+        self._done = False
+        self._done_callbacks = []
+        self._done_lock = threading.Lock()
+        self._cursors = {}
 
     def __repr__(self):
         return "<Job for "+repr(self.specification)+">"
 
     def _run(self):
-        self._started_at = datetime.utcnow()
+        self._started_at = mplane.clock.utcnow()
         try:
-            self.result = self.service.run(self.specification,
-                                           self._check_interrupt)
+            with mplane.profiling.span(mplane.profiling.JOB,
+                                       self.service.capability().get_label()):
+                if inspect.isgeneratorfunction(self.service.run):
+                    self.result = self._run_batches()
+                elif self.service.execution_mode == EXECUTION_PROCESS:
+                    if self._processes is None:
+                        self._processes = default_process_runner()
+                    self.result = self._processes.run(self.service,
+                                                      self.specification,
+                                                      self._interrupt)
+                else:
+                    self.result = self.service.run(self.specification,
+                                                   self._check_interrupt)
         except Exception as e:
-            self.exception = mplane.model.Exception(
-                            token=self.specification.get_token(),
-                            errmsg=str(e))
-            logger.warning("Got exception in _run(), returning "+str(self.exception))
-            self._exception_at = datetime.utcnow()
-        self._ended_at = datetime.utcnow()
+            self._set_exception(e)
+        self._call_back(self._run_finished())
+
+    def _run_batches(self):
+        for batch in self.service.run(self.specification, self._check_interrupt):
+            with self._done_lock:
+                if self._rows is None:
+                    self._rows = batch.slice_rows(0)
+                else:
+                    self._rows.append_rows(batch)
+                callbacks = list(self._callbacks)
+            # tell subscribers rows are available
+            self._call_back(callbacks)
+
+        if self._rows is None:
+            raise ValueError("Service returned no results")
+        return self._rows
+
+    async def _run_coroutine(self):
+        self._task = asyncio.current_task()
+        self._started_at = mplane.clock.utcnow()
+        try:
+            if self._interrupt.is_set():
+                raise asyncio.CancelledError()
+            with mplane.profiling.span(mplane.profiling.JOB_COROUTINE,
+                                       self.service.capability().get_label()):
+                self.result = await self.service.run(self.specification,
+                                                     self._check_interrupt)
+        except asyncio.CancelledError:
+            self._set_exception("Interrupted")
+        except Exception as e:
+            self._set_exception(e)
+        self._task = None
+        callbacks = self._run_finished()
+
+        # callbacks may block; keep them off the loop thread
+        if len(callbacks):
+            self._loop.call_in_thread(self._call_back, callbacks)
+
+    def _set_exception(self, e):
+        self.exception = mplane.model.Exception(
+                        token=self.specification.get_token(),
+                        errmsg=str(e))
+        logger.warning("Got exception in _run(), returning "+str(self.exception))
+        self._exception_at = mplane.clock.utcnow()
+
+    def _run_finished(self):
+        self._ended_at = mplane.clock.utcnow()
+
+        if mplane.metrics.enabled():
+            if self._started_at is not None:
+                _run_seconds.observe((self._ended_at - self._started_at).total_seconds(),
+                                     self.service.capability().get_label())
+            if self.result is not None:
+                _result_bytes.observe(self.result_size())
+            _jobs_ended.inc("failed" if self.exception is not None else "finished")
+
+        # no need to interrupt a job that has already ended
+        if self._end_timer is not None:
+            self._end_timer.cancel()
+
+        with self._done_lock:
+            self._done = True
+            done_callbacks = self._done_callbacks
+            self._done_callbacks = []
+            callbacks = list(self._callbacks)
+        for fn in done_callbacks:
+            fn(self)
+
+        # subscriber callbacks for the caller to call
+        return callbacks
+
+    def _call_back(self, callbacks):
+        for callback in callbacks:
+            callback(self.receipt)
+
+    def add_done_callback(self, fn):
+        """
+        Arrange for fn(job) to be called once this job has finished or
+        failed; calls it immediately if the job already has. fn is called
+        on the thread completing the job, and should return quickly.
 
-        if self._callback:
-            self._callback(self.receipt)
+        """
+        with self._done_lock:
+            if not self._done:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def subscribe(self, user, callback=None):
+        """
+        Subscribe a user to the results of this job: the job's results
+        are retained until the user has redeemed them. If a callback is
+        given, it is called with the job's receipt when results are
+        available; immediately, if they already are.
+
+        """
+        with self._done_lock:
+            self._subscribers[user] += 1
+            if self._subscribers[user] > 1:
+                # redemptions do not tell a user's subscriptions apart,
+                # so none of them can keep a cursor: see get_reply_for()
+                self._cursors[user] = None
+            done = self._done
+            if callback is not None and not done:
+                self._callbacks.append(callback)
+        if callback is not None and done:
+            callback(self.receipt)
+
+    def redeem(self, user):
+        """
+        Record the redemption of this job's results by a user.
+        Returns True if no subscriber is still waiting to redeem them.
+
+        """
+        with self._done_lock:
+            if self._subscribers[user] > 0:
+                self._subscribers[user] -= 1
+            if self._subscribers[user] == 0:
+                del self._subscribers[user]
+            return len(self._subscribers) == 0
 
     def _check_interrupt(self):
         return self._interrupt.is_set()
 
     def _schedule_now(self):
-        # spawn a thread to run the service
-        threading.Thread(target=self._run).start()
+        with self._done_lock:
+            self._start_timer = None
+            if self._interrupt.is_set():
+                # interrupted while the start timer was firing
+                return
+            self._start_state = JOB_STARTED
+
+        # coroutine services run as tasks on the event loop
+        if inspect.iscoroutinefunction(self.service.run):
+            if self._loop is None:
+                self._loop = default_event_loop()
+            self._loop.start(self._run_coroutine())
+            return
+
+        # hand the run to a worker thread
+        (flow, weight) = self._priority
+        if not self._pool.submit(self.service.capability().get_label(), self._run,
+                                 flow=flow, weight=weight):
+            logger.warning("Run queue full, failing "+repr(self))
+            self.exception = mplane.model.Exception(
+                            token=self.specification.get_token(),
+                            errmsg="Scheduler busy: run queue full")
+            self._call_back(self._run_finished())
 
     def schedule(self):
         """
@@ -152,25 +961,58 @@ class Job(object):
         else:
             (start_delay, end_delay) = (0, None)
 
+        # a job interrupted already has failed in interrupt()
+        if self._interrupt.is_set():
+            return
         if start_delay is None:
+            self._fail_unstarted("Temporal scope passed before start")
             return
 
         # start interrupt timer
         if end_delay is not None and not hasattr(self.service, 'relay'):
             logger.info("Scheduler will interrupt "+repr(self)+" after "+str(end_delay)+" sec")
-            threading.Timer(end_delay, self.interrupt).start()
+            self._end_timer = self._timers.call_later(end_delay, self.interrupt)
 
         # start start timer
         if start_delay > 0:
             logger.info("Scheduling "+repr(self)+" after "+str(start_delay)+" sec")
-            threading.Timer(start_delay, self._schedule_now).start()
+            with self._done_lock:
+                self._start_state = JOB_WAITING
+                self._start_timer = self._timers.call_later(start_delay, self._schedule_now)
         else:
             logger.info("Scheduling "+repr(self)+" immediately")
             self._schedule_now()
 
     def interrupt(self):
-        """Interrupt this job."""
-        self._interrupt.set()
+        """
+        Interrupt this job. A job interrupted before it
+        has started will not run, and fails instead.
+
+        """
+        # decide, together with _schedule_now, whether the job runs
+        with self._done_lock:
+            self._interrupt.set()
+            start_timer = self._start_timer
+            self._start_timer = None
+
+        if start_timer is not None:
+            start_timer.cancel()
+        self._fail_unstarted("Interrupted before start")
+
+        task = self._task
+        if task is not None:
+            self._loop.cancel(task)
+
+    def _fail_unstarted(self, errmsg):
+        # fail the job, unless it has started (or failed) already
+        with self._done_lock:
+            if self._start_state not in (None, JOB_WAITING):
+                return
+            self._start_state = JOB_ENDED
+        self.exception = mplane.model.Exception(
+                        token=self.specification.get_token(),
+                        errmsg=errmsg)
+        self._call_back(self._run_finished())
 
     def failed(self):
         """A job only fails if it is finished and has no results"""
@@ -191,7 +1033,7 @@ class Job(object):
         the Specification and return that.
 
         """
-        self._replied_at = datetime.utcnow()
+        self._replied_at = mplane.clock.utcnow()
         if self.failed():
             return self.exception
         elif self.finished():
@@ -199,36 +1041,132 @@ class Job(object):
         else:
             return self.receipt
 
+    def get_reply_for(self, user):
+        """
+        Like get_reply(), but for a job whose service produces rows in
+        batches, return only the rows the given user has not yet been
+        given. While the job is running, these are returned as an
+        Envelope holding a Result with the new rows followed by the
+        Receipt (or the Receipt alone if there are no new rows); once
+        it has finished, as a Result with the remaining rows.
+
+        A user who has subscribed to the job more than once is given
+        all rows so far at each redemption instead.
+
+        """
+        if self._rows is None or self.failed():
+            return self.get_reply()
+
+        self._replied_at = mplane.clock.utcnow()
+        with self._done_lock:
+            finished = self.finished()
+            total = self._rows.count_result_rows()
+            cursor = self._cursors.get(user, 0)
+            if cursor is None:
+                cursor = 0
+            else:
+                self._cursors[user] = total
+            rows = self._rows.slice_rows(cursor, total)
+
+        if finished:
+            return rows
+        if cursor == total:
+            return self.receipt
+
+        env = mplane.model.Envelope(token=self.receipt.get_token(),
+                                    label=self.specification.get_label(),
+                                    when=self.specification.when())
+        env.append_message(rows)
+        env.append_message(self.receipt)
+        return env
+
+    def ended_at(self):
+        """Return the time this job finished or failed, or None if it has not."""
+        if self.finished() or self.failed():
+            return self._ended_at
+        return None
+
+    def last_used_at(self):
+        """Return the time this job was last replied to, or ended."""
+        if self._replied_at is not None and self._replied_at > self._ended_at:
+            return self._replied_at
+        return self._ended_at
+
+    def row_count(self):
+        """Return the number of result rows this job has produced."""
+        if self.result is None:
+            return 0
+        return self.result.count_result_rows()
+
+    def result_size(self):
+        """Return the approximate size in bytes of this job's result."""
+        if self.result is None:
+            return 0
+        if self._result_size is None:
+            self._result_size = len(json.dumps(self.result.to_dict()))
+        return self._result_size
+
 
 class MultiJob(object):
     """
     A MultiJob spawns multiple jobs determined by its schedule.
 
     Each MultiJob will result in multiple result rows, one for each sub-job.
+    Results are collected as each sub-job completes, into an Envelope
+    holding at most max_results of the latest results (if nonzero), or
+    appended to a JobStore if one is given.
     """
 
-    jobs = []
+    jobs = None
     results = None
     service = None
     session = None
     specification = None
     receipt = None
     _replied_at = None
+    _ended_at = None
+    _result_size = None
+    _result_size_count = 0
+    _results_collected = 0
+    _rows_collected = 0
     _scheduling_finished = False
     _subspec_iterator = None
+    _next_timer = None
+    _end_timer = None
+    _interrupted = False
 
-    def __init__(self, service, specification, session=None, max_results=0, callback=None):
+    def __init__(self, service, specification, session=None, max_results=0, callback=None,
+                 timers=None, pool=None, processes=None, loop=None, store=None,
+                 priority=None):
         super(MultiJob, self).__init__()
         self.service = service
         self.session = session
         self.specification = specification
         self.receipt = mplane.model.Receipt(specification=specification)
+        self._max_results = int(max_results)
         self.results = mplane.model.Envelope(token=specification.get_token(),
                                              label=specification.get_label(),
-                                             when=specification.when())
+                                             when=specification.when(),
+                                             max_messages=self._max_results)
+        self.jobs = set()
+        self._jobs_lock = threading.Lock()
         self._subspec_iterator = specification.subspec_iterator()
-        self._max_results = int(max_results)
         self._callback = callback
+        self._callbacks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+        self._subscribers = collections.Counter()
+        if timers is None:
+            timers = default_timer_queue()
+        self._timers = timers
+        self._pool = pool
+        self._processes = processes
+        self._loop = loop
+        self._store = store
+        self._priority = priority
+        self._done = False
+        self._done_callbacks = []
+        self._done_lock = threading.Lock()
 
     def __repr__(self):
         return "<MultiJob for "+repr(self.specification)+">"
@@ -240,9 +1178,20 @@ class MultiJob(object):
         new_job = Job(service=self.service,
                       specification=self._subspec,
                       session=self.session,
-                      callback=self._job_callback)
-
-        self.jobs.append(new_job)
+                      timers=self._timers,
+                      pool=self._pool,
+                      processes=self._processes,
+                      loop=self._loop,
+                      priority=self._priority)
+
+        # decide, together with interrupt(), whether the job runs; an
+        # interrupt() seeing the job in jobs also sees its done callback
+        with self._jobs_lock:
+            self._next_timer = None
+            if self._interrupted:
+                return
+            self.jobs.add(new_job)
+            new_job.add_done_callback(self._job_done)
         new_job.schedule()
 
         self._next_job()
@@ -255,6 +1204,7 @@ class MultiJob(object):
             self._subspec = next(self._subspec_iterator)
         except StopIteration:
             self._scheduling_finished = True
+            self._check_done()
             return
 
         (start_delay, end_delay) = self._subspec.when().timer_delays()
@@ -262,12 +1212,16 @@ class MultiJob(object):
         # if no start_delay for the next run was found we should stop this MultiJob
         if start_delay is None:
             self._scheduling_finished = True
+            self._check_done()
             return
 
         # start start timer
         if start_delay > 0:
             logger.info("Scheduling "+repr(self._subspec)+" from "+repr(self)+" after "+str(start_delay)+" sec")
-            threading.Timer(start_delay, self._schedule_job).start()
+            with self._jobs_lock:
+                if self._interrupted:
+                    return
+                self._next_timer = self._timers.call_later(start_delay, self._schedule_job)
         else:
             logger.info("Scheduling "+repr(self._subspec)+" from "+repr(self)+" immediately")
             self._schedule_job()
@@ -284,24 +1238,37 @@ class MultiJob(object):
         # if no start_delay for the next run was found we should stop this MultiJob
         if start_delay is None:
             self._scheduling_finished = True
+            self._check_done()
             return
 
         # start interrupt timer
         if end_delay is not None:
-            threading.Timer(end_delay, self.interrupt).start()
+            self._end_timer = self._timers.call_later(end_delay, self.interrupt)
             logger.info("Scheduler will interrupt "+repr(self)+" after "+str(end_delay)+" sec")
 
         # begin scheduling of all jobs
         self._next_job()
 
     def interrupt(self):
-        """Interrupt all jobs."""
-        for job in self.jobs:
+        """Interrupt all jobs, and stop scheduling new ones."""
+        with self._jobs_lock:
+            self._interrupted = True
+            self._scheduling_finished = True
+            next_timer = self._next_timer
+            self._next_timer = None
+            jobs = list(self.jobs)
+
+        if next_timer is not None:
+            next_timer.cancel()
+        if self._end_timer is not None:
+            self._end_timer.cancel()
+        for job in jobs:
             job.interrupt()
+        self._check_done()
 
     def failed(self):
         """A multijob will only fail if it is finished and has no results"""
-        if self.finished() and len(self.results) == 0:
+        if self.finished() and self._results_collected == 0:
             return True
 
         return False
@@ -316,33 +1283,175 @@ class MultiJob(object):
 
         return True
 
-    def _collect_results(self):
-        """Stores the last self.max_results results."""
-        for job in self.jobs[:]:
-            if job.failed() or job.finished():
-                self.results.append_message(job.get_reply())
-                self.jobs.remove(job)
-
-        self.results.trim(self._max_results)
-
     def get_reply(self):
         """
         If results are available for this MultiJob, return them.
         Otherwise, create a receipt from the Specification and return that.
 
         """
-        self._collect_results()
-        self._replied_at = datetime.utcnow()
-        if len(self.results) > 0:
-            return self.results
-        else:
+        self._replied_at = mplane.clock.utcnow()
+        if self._results_collected == 0:
             return self.receipt
+        elif self._store is not None:
+            return self._store.reply(self.receipt.get_token(), self._max_results)
+        else:
+            return self.results
 
-    def _job_callback(self, arg):
-        self.collect_results()        
-        if self._callback:
-            self._callback(self.receipt)
+    def get_reply_for(self, user):
+        """Return the latest results of this MultiJob, whoever asks."""
+        return self.get_reply()
 
+    def add_done_callback(self, fn):
+        """
+        Arrange for fn(multijob) to be called once all of this multijob's
+        jobs have finished; calls it immediately if they already have.
+
+        """
+        with self._done_lock:
+            if not self._done:
+                self._done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def _check_done(self):
+        if not self.finished():
+            return
+        with self._done_lock:
+            if self._done:
+                return
+            self._done = True
+            done_callbacks = self._done_callbacks
+            self._done_callbacks = []
+        for fn in done_callbacks:
+            fn(self)
+
+    def ended_at(self):
+        """Return the time this multijob was first seen finished, or None."""
+        if self._ended_at is None and self.finished():
+            self._ended_at = mplane.clock.utcnow()
+        return self._ended_at
+
+    def last_used_at(self):
+        """Return the time this multijob was last replied to, or ended."""
+        if self._replied_at is not None and self._replied_at > self._ended_at:
+            return self._replied_at
+        return self._ended_at
+
+    def row_count(self):
+        """Return the number of result rows this multijob's jobs have produced."""
+        return self._rows_collected
+
+    def result_size(self):
+        """Return the approximate size in bytes of this multijob's results."""
+        if self._result_size is None or self._result_size_count != self._results_collected:
+            self._result_size_count = self._results_collected
+            self._result_size = len(json.dumps(self.results.to_dict()))
+        return self._result_size
+
+    def _job_done(self, job):
+        # collect the result of a finished or failed sub-job
+        with self._jobs_lock:
+            self.jobs.discard(job)
+            self._rows_collected += job.row_count()
+            if self._store is not None:
+                self._store.append_result(self.receipt.get_token(), job.get_reply())
+            else:
+                self.results.append_message(job.get_reply())
+            self._results_collected += 1
+        self._check_done()
+        with self._done_lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(self.receipt)
+
+    def subscribe(self, user, callback=None):
+        """
+        Subscribe a user to the results of this multijob: the results
+        are retained until the user has redeemed them once the multijob
+        has finished. If a callback is given, it is called with the
+        receipt each time a result is available, or immediately if the
+        multijob has already finished.
+
+        """
+        with self._done_lock:
+            self._subscribers[user] += 1
+            done = self._done
+            if callback is not None and not done:
+                self._callbacks.append(callback)
+        if callback is not None and done:
+            callback(self.receipt)
+
+    def redeem(self, user):
+        """
+        Record the redemption of this multijob's results by a user.
+        Returns True if no subscriber is still waiting to redeem them.
+
+        """
+        with self._done_lock:
+            if self._subscribers[user] > 0:
+                self._subscribers[user] -= 1
+            if self._subscribers[user] == 0:
+                del self._subscribers[user]
+            return len(self._subscribers) == 0
+
+
+DEFAULT_QUERY_CACHE_TTL = 60
+DEFAULT_QUERY_CACHE_SIZE = 1000
+
+class QueryCache(object):
+    """
+    Caches the Results of query Specifications (those which are not
+    schedulable) by specification token, for a limited time and up to
+    a limited number of entries, evicting the least recently used.
+
+    """
+    def __init__(self, ttl=DEFAULT_QUERY_CACHE_TTL, size=DEFAULT_QUERY_CACHE_SIZE):
+        super(QueryCache, self).__init__()
+        self._ttl = float(ttl)
+        self._size = int(size)
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, token):
+        """Return the cached Result for a token, or None."""
+        with self._lock:
+            entry = self._results.get(token, None)
+            if entry is not None and entry[0] < mplane.clock.monotonic():
+                del self._results[token]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token, result):
+        """Cache a Result under a token."""
+        with self._lock:
+            self._results[token] = (mplane.clock.monotonic() + self._ttl, result)
+            self._results.move_to_end(token)
+            while len(self._results) > self._size:
+                self._results.popitem(last=False)
+
+    def stats(self):
+        """Return a dictionary of cache size, hits and misses."""
+        with self._lock:
+            return { "size": len(self._results),
+                     "hits": self.hits,
+                     "misses": self.misses }
+
+DEFAULT_JOB_TTL = 86400
+DEFAULT_MAX_FINISHED_JOBS = 10000
+DEFAULT_RESULT_BUDGET = 256 * 1024 * 1024
+DEFAULT_PRUNE_INTERVAL = 60
+# worker pool label of the periodic pruning runs
+PRUNE_LABEL = "mplane-prune"
 
 class Scheduler(object):
     """
@@ -357,19 +1466,93 @@ class Scheduler(object):
 
         if config:
             self.azn = mplane.azn.Authorization(config)
+            self.priorities = mplane.azn.Priorities(config)
+            self.limits = mplane.azn.Limits(config)
 
             if "Component" not in config or "scheduler_max_results" not in config["Component"]:
                 self._max_results = 0
             else:
                 self._max_results = int(config["Component"]["scheduler_max_results"])
+
+            pool_args = {}
+            if "Component" in config:
+                if "scheduler_workers" in config["Component"]:
+                    pool_args["workers"] = config["Component"]["scheduler_workers"]
+                if "scheduler_queue_limit" in config["Component"]:
+                    pool_args["queue_limit"] = config["Component"]["scheduler_queue_limit"]
+                if "scheduler_service_limits" in config["Component"]:
+                    pool_args["service_limits"] = config["Component"]["scheduler_service_limits"]
+            self.pool = WorkerPool(**pool_args)
+
+            if "Component" in config and "scheduler_processes" in config["Component"]:
+                self.processes = ProcessRunner(config["Component"]["scheduler_processes"])
+            else:
+                self.processes = ProcessRunner()
         else:
             self._max_results = 0
             self.azn = mplane.azn.Authorization()
-
+            self.priorities = mplane.azn.Priorities()
+            self.limits = mplane.azn.Limits()
+            self.pool = WorkerPool()
+            self.processes = ProcessRunner()
+
+        # job retention policy
+        self._job_ttl = DEFAULT_JOB_TTL
+        self._max_finished_jobs = DEFAULT_MAX_FINISHED_JOBS
+        self._result_budget = DEFAULT_RESULT_BUDGET
+        self._prune_interval = DEFAULT_PRUNE_INTERVAL
+        if config and "Component" in config:
+            if "scheduler_job_ttl" in config["Component"]:
+                self._job_ttl = float(config["Component"]["scheduler_job_ttl"])
+            if "scheduler_max_finished_jobs" in config["Component"]:
+                self._max_finished_jobs = int(config["Component"]["scheduler_max_finished_jobs"])
+            if "scheduler_result_budget" in config["Component"]:
+                self._result_budget = int(config["Component"]["scheduler_result_budget"])
+            if "scheduler_prune_interval" in config["Component"]:
+                self._prune_interval = float(config["Component"]["scheduler_prune_interval"])
+        self._prune_timer = None
+
+        # query result caches by capability label
+        self._query_caches = {}
+        if config and "Component" in config and "scheduler_query_cache" in config["Component"]:
+            cache_conf = config["Component"]["scheduler_query_cache"]
+            for label in cache_conf:
+                self._query_caches[label] = QueryCache(**cache_conf[label])
+
+        # persistent store of jobs and finished results, if any
+        self._store = None
+        if config and "Component" in config and "scheduler_store" in config["Component"]:
+            self._store = mplane.jobstore.JobStore(config["Component"]["scheduler_store"])
+
+        # counters of jobs evicted by each retention policy
+        self.evicted_ttl = 0
+        self.evicted_count = 0
+        self.evicted_budget = 0
+
+        # services, capabilities and jobs are changed from handler,
+        # timer and worker threads (and by a supervisor's IOLoop)
+        self._lock = threading.RLock()
         self.services = []
         self.jobs = {}
+        # identity and capability of each job counted against limits
+        self._limited_jobs = {}
         self._capability_cache = {}
 
+        # changed, with the time of the change, whenever services are
+        # added or removed, so that discovery responses can be cached
+        self.capability_version = 0
+        self.capabilities_modified = time.time()
+
+        # single thread running all job start and interrupt timers
+        self.timers = TimerQueue()
+
+        # event loop running coroutine services
+        self.loop = EventLoopRunner()
+
+        # services and withdrawn capabilities indexed by schema hash
+        self._services_by_schema = {}
+        self._withdrawn_by_schema = {}
+
     def process_message(self, user, msg, session=None, callback=None):
         """
         Process a message. If msg is a mplane.model.Specification and
@@ -384,24 +1567,40 @@ class Scheduler(object):
             reply = self.submit_job(user, specification=msg, session=session, callback=callback)
         elif isinstance(msg, mplane.model.Redemption):
             job_key = msg.get_token()
-            if job_key in self.jobs:
-                job = self.jobs[job_key]
-                reply = job.get_reply()
-                if job.finished():
-                    self.jobs.pop(job_key, None)
+            with self._lock:
+                job = self.jobs.get(job_key, None)
+            if job is not None:
+                reply = job.get_reply_for(user)
+                # keep results until every subscriber has redeemed them
+                if job.finished() and job.redeem(user):
+                    if self._evict_job(job_key, job) and self._store is not None:
+                        self._store.remove(job_key)
             else:
-                reply = mplane.model.Exception(token=job_key,
-                errmsg="Unknown job")
+                # finished results are held in the store
+                if self._store is not None:
+                    reply = self._store.redeem(job_key, user, self._max_results)
+                # a shared query may have been redeemed by another client
+                if reply is None:
+                    reply = self._cached_result(job_key)
+                if reply is None:
+                    reply = mplane.model.Exception(token=job_key,
+                    errmsg="Unknown job")
         elif isinstance(msg, mplane.model.Interrupt):
             job_key = msg.get_token()
-            if job_key in self.jobs:
-                job = self.jobs[job_key]
+            with self._lock:
+                job = self.jobs.get(job_key, None)
+            if job is not None:
                 logger.info("Scheduler: interrupting " + job.specification.get_label())
                 job.interrupt()
+                # a service may take a while to notice the interrupt
+                self._end_limits(job)
                 reply = job.get_reply()
             else:
-                reply = mplane.model.Exception(token=job_key,
-                errmsg="Unknown job")
+                if self._store is not None:
+                    reply = self._store.reply(job_key, self._max_results)
+                if reply is None:
+                    reply = mplane.model.Exception(token=job_key,
+                    errmsg="Unknown job")
         else:
             reply = mplane.model.Exception(token=msg.get_token(),
                 errmsg="Unexpected message type")
@@ -411,15 +1610,37 @@ class Scheduler(object):
     def add_service(self, service):
         """Add a service to this Scheduler"""
         logger.info("Scheduler: added "+repr(service))
-        self.services.append(service)
         cap = service.capability()
-        self._capability_cache[cap.get_token()] = cap
+        schema = cap._schema_hash()
+        with self._lock:
+            self.services.append(service)
+            self._capability_cache[cap.get_token()] = cap
+            mplane.utils.add_value_to(self._services_by_schema, schema, service)
+
+            # a re-added capability is no longer withdrawn
+            withdrawn = self._withdrawn_by_schema.get(schema, ())
+            for withdrawn_cap in withdrawn:
+                if withdrawn_cap.get_token() == cap.get_token():
+                    withdrawn.remove(withdrawn_cap)
+                    break
+            self._capabilities_changed()
 
     def remove_service(self, service):
         """Remove a service from this Scheduler"""
-        self.services.remove(service)
+        schema = service.capability()._schema_hash()
         withdrawn_cap = mplane.model.Withdrawal(capability=service.capability())
-        self._capability_cache[withdrawn_cap.get_token()] = withdrawn_cap
+        with self._lock:
+            self.services.remove(service)
+            self._services_by_schema[schema].remove(service)
+            if len(self._services_by_schema[schema]) == 0:
+                del self._services_by_schema[schema]
+            self._capability_cache[withdrawn_cap.get_token()] = withdrawn_cap
+            mplane.utils.add_value_to(self._withdrawn_by_schema, schema, withdrawn_cap)
+            self._capabilities_changed()
+
+    def _capabilities_changed(self):
+        self.capabilities_modified = time.time()
+        self.capability_version += 1
 
     def capability_keys(self):
         """
@@ -427,13 +1648,54 @@ class Scheduler(object):
         provided by this scheduler's services.
 
         """
-        return self._capability_cache.keys()
+        with self._lock:
+            return list(self._capability_cache.keys())
 
     def capability_for_key(self, key):
         """
         Return a capability for a given key.
         """
-        return self._capability_cache[key]
+        with self._lock:
+            return self._capability_cache[key]
+
+    def match_service(self, specification):
+        """
+        Return the first Service whose capability the given
+        Specification fulfills, or None if there is no such Service.
+
+        Only services whose capabilities share the specification's
+        schema hash are checked for temporal scope and constraints.
+
+        """
+        schema = specification._schema_hash()
+        with self._lock:
+            services = list(self._services_by_schema.get(schema, ()))
+        for service in services:
+            if specification._fulfills_schema_match(service.capability()):
+                return service
+        return None
+
+    def match_specification(self, specification):
+        """
+        Resolve a Specification to the capability it fulfills in a
+        single indexed lookup. Returns a tuple (capability, service):
+        the capability and its Service if an active service matches;
+        the Withdrawal and None if only a withdrawn capability matches;
+        (None, None) if nothing matches.
+
+        """
+        service = self.match_service(specification)
+        if service is not None:
+            return (service.capability(), service)
+
+        schema = specification._schema_hash()
+        with self._lock:
+            withdrawn = list(self._withdrawn_by_schema.get(schema, ()))
+        for withdrawn_cap in withdrawn:
+            if specification._fulfills_schema_match(withdrawn_cap):
+                return (withdrawn_cap, None)
+
+        return (None, None)
 
     def submit_job(self, user, specification, session=None, callback=None):
         """
@@ -441,50 +1703,243 @@ class Scheduler(object):
         service the given Specification, then create and schedule
         a new Job to execute the statement.
 
+        If the Specification matches a withdrawn capability,
+        returns the Withdrawal instead.
+
         """
-        # linearly search the available services
-        for service in self.services:
-            if specification.fulfills(service.capability()):
-                if self.azn.check(service.capability(), user):
-                    # Found. Create a new job.
-                    logger.info("Scheduler: "+repr(service)+" matches "+repr(specification))
-                    if (specification.when().is_repeated() and
-                        # the service is not a RelayService from supervisor.py,
-                        # handle it as a normal multijob
-                        not hasattr(service, 'relay')):
-                        new_job = MultiJob(service=service,
-                                           specification=specification,
-                                           session=session,
-                                           max_results=self._max_results,
-                                           callback=callback)
-                    else:
-                        new_job = Job(service=service,
-                                      specification=specification,
-                                      session=session,
-                                      callback=callback)
-
-                    # Key by the receipt's token, and return
-                    job_key = new_job.receipt.get_token()
-                    if job_key in self.jobs:
-                        # Job already running. Return receipt
-                        logger.info("Scheduler: "+repr(self.jobs[job_key])+" already running")
-                        return self.jobs[job_key].receipt
-
-                    # Keep track of the job and return receipt
-                    self.jobs[job_key] = new_job
-                    new_job.schedule()
-                    logger.info("Scheduler: Returning "+repr(new_job.receipt))
-                    return new_job.receipt
-
-                # user not authorized to request the capability
-                logger.warning("Capability not authorized: " + repr(specification))
-                return mplane.model.Exception(token=specification.get_token(),
-                            errmsg="Capability not authorized")
-
-        # fall-through, no job
-        logger.warning("No service registered for "+repr(specification))
-        return mplane.model.Exception(token=specification.get_token(),
-                    errmsg="No service registered for specification")
+        # reject identities over their limits before any matching
+        reason = self.limits.admit_identity(user)
+        if reason is not None:
+            logger.warning(reason+", rejecting "+repr(specification))
+            _submissions.inc("limited")
+            return mplane.model.Exception(token=specification.get_token(),
+                        errmsg=reason)
+
+        match_start = time.monotonic()
+        (cap, service) = self.match_specification(specification)
+        _match_seconds.observe(time.monotonic() - match_start)
+
+        if isinstance(cap, mplane.model.Withdrawal):
+            logger.warning("Capability withdrawn for "+repr(specification))
+            _submissions.inc("withdrawn")
+            return cap
+
+        if service is None:
+            # fall-through, no job
+            logger.warning("No service registered for "+repr(specification))
+            _submissions.inc("unmatched")
+            return mplane.model.Exception(token=specification.get_token(),
+                        errmsg="No service registered for specification")
+
+        if not self.azn.check(service.capability(), user):
+            # user not authorized to request the capability
+            logger.warning("Capability not authorized: " + repr(specification))
+            _submissions.inc("unauthorized")
+            return mplane.model.Exception(token=specification.get_token(),
+                        errmsg="Capability not authorized")
+
+        reason = self.limits.admit_capability(service.capability())
+        if reason is not None:
+            logger.warning(reason+", rejecting "+repr(specification))
+            _submissions.inc("limited")
+            return mplane.model.Exception(token=specification.get_token(),
+                        errmsg=reason)
+
+        # answer cached queries immediately
+        query_cache = None
+        if not specification.is_schedulable():
+            query_cache = self._query_caches.get(service.capability().get_label(), None)
+            if query_cache is not None:
+                result = query_cache.get(specification.get_token())
+                if result is not None:
+                    logger.info("Scheduler: query cache hit for "+repr(specification))
+                    _submissions.inc("cached")
+                    return result
+
+        if self.pool.saturated():
+            # shed load rather than queue without bound
+            logger.warning("Run queue full, rejecting " + repr(specification))
+            _submissions.inc("busy")
+            return mplane.model.Exception(token=specification.get_token(),
+                        errmsg="Scheduler busy: run queue full")
+
+        # Found. Create a new job.
+        logger.info("Scheduler: "+repr(service)+" matches "+repr(specification))
+        new_job = self._new_job(service, specification, session, user)
+
+        # Key by the receipt's token; the job is looked up and registered
+        # under the lock, so that identical specifications share one job.
+        # The job store, scheduling and callbacks are left until the lock
+        # is released, as they may block or call back into the scheduler.
+        job_key = new_job.receipt.get_token()
+        with self._lock:
+            job = self.jobs.get(job_key, None)
+            if job is None:
+                self.jobs[job_key] = new_job
+
+        if job is not None:
+            # Job already running. Subscribe to it and return receipt
+            logger.info("Scheduler: "+repr(job)+" already running")
+            _submissions.inc("subscribed")
+            job.subscribe(user, callback)
+            if self._store is not None:
+                self._store.subscribe(job_key, user)
+            return job.receipt
+
+        if self._store is not None and self._store.subscribe(job_key, user):
+            # Job already finished, results in the store
+            logger.info("Scheduler: results for "+repr(specification)+" already stored")
+            _submissions.inc("subscribed")
+            self._evict_job(job_key, new_job)
+            # fail the unstarted job, calling back anyone who subscribed
+            # to it meanwhile: they find the results in the store too
+            new_job.interrupt()
+            if callback is not None:
+                callback(new_job.receipt)
+            return new_job.receipt
+
+        # Keep track of the job and return receipt
+        _submissions.inc("scheduled")
+        new_job.subscribe(user, callback)
+        self._start_limits(new_job, user, cap)
+        self._start_job(job_key, new_job, query_cache)
+
+        logger.info("Scheduler: Returning "+repr(new_job.receipt))
+        return new_job.receipt
+
+    def _new_job(self, service, specification, session=None, user=None):
+        # runs are queued fairly by priority class and identity
+        (priority_class, weight) = self.priorities.classify(service.capability(), user)
+        priority = ((priority_class, user), weight)
+
+        if (specification.when().is_repeated() and
+            # the service is not a RelayService from supervisor.py,
+            # handle it as a normal multijob
+            not hasattr(service, 'relay')):
+            return MultiJob(service=service,
+                            specification=specification,
+                            session=session,
+                            max_results=self._max_results,
+                            timers=self.timers,
+                            pool=self.pool,
+                            processes=self.processes,
+                            loop=self.loop,
+                            store=self._store,
+                            priority=priority)
+        else:
+            return Job(service=service,
+                       specification=specification,
+                       session=session,
+                       timers=self.timers,
+                       pool=self.pool,
+                       processes=self.processes,
+                       loop=self.loop,
+                       priority=priority)
+
+    def _start_job(self, job_key, job, query_cache=None):
+        # called without the lock, once the job is registered in jobs
+        if self._store is not None:
+            self._store.add_job(job_key, job.specification, job._subscribers)
+        if query_cache is not None:
+            job.add_done_callback(
+                lambda job: self._cache_query_result(query_cache, job))
+        if self._store is not None:
+            job.add_done_callback(
+                lambda job: self._store_job(job_key, job))
+        job.schedule()
+
+        # start pruning once there are jobs to prune
+        if self._prune_timer is None and self._prune_interval > 0:
+            self._prune_timer = self.timers.call_later(self._prune_interval,
+                                                       self._periodic_prune)
+
+    def _store_job(self, job_key, job):
+        # move the results of a finished job out of memory
+        if isinstance(job, MultiJob) and not job.failed():
+            self._store.finish(job_key)
+        else:
+            self._store.finish(job_key, job.get_reply())
+        # unless some of its rows have been redeemed already: the store
+        # does not keep track of which
+        if not getattr(job, "_cursors", None):
+            self._evict_job(job_key, job)
+
+    def restore_jobs(self):
+        """
+        Re-arm the jobs whose results were pending in the job store when
+        the component last stopped, for the subscribers which were then
+        waiting for them. Call once all services have been added. Jobs
+        which no longer match a service, or whose temporal scope has
+        passed, are stored as failed.
+
+        Returns the number of jobs re-armed.
+
+        """
+        if self._store is None:
+            return 0
+
+        restored = 0
+        for (job_key, specification, subscribers) in self._store.pending():
+            with self._lock:
+                if job_key in self.jobs:
+                    continue
+            service = self.match_service(specification)
+            if service is None:
+                errmsg = "No service registered for specification after restart"
+            elif (specification.is_schedulable() and
+                  specification.when().timer_delays()[0] is None):
+                errmsg = "Specification expired before restart"
+            else:
+                errmsg = None
+            if errmsg is not None:
+                logger.warning("Scheduler: not restoring "+repr(specification)+": "+errmsg)
+                self._store.finish(job_key, mplane.model.Exception(token=job_key,
+                                                                   errmsg=errmsg))
+                continue
+
+            job = self._new_job(service, specification, user=next(iter(subscribers), None))
+            for (user, count) in subscribers.items():
+                for i in range(count):
+                    job.subscribe(user)
+            with self._lock:
+                if job_key in self.jobs:
+                    continue
+                self.jobs[job_key] = job
+            logger.info("Scheduler: restoring "+repr(job))
+            self._start_job(job_key, job)
+            restored += 1
+        return restored
+
+    def _cache_query_result(self, query_cache, job):
+        if job.finished() and not job.failed():
+            query_cache.put(job.specification.get_token(), job.result)
+
+    def _cached_result(self, token):
+        for query_cache in self._query_caches.values():
+            result = query_cache.get(token)
+            if result is not None:
+                return result
+        return None
+
+    def stats(self):
+        """
+        Return a dictionary of scheduler statistics: the number of
+        jobs held (and stored, if there is a job store), the state of
+        admission limits, the number of jobs evicted by each retention
+        policy, and the statistics of the timer queue, worker pool and
+        query result caches.
+
+        """
+        return { "jobs": len(self.jobs),
+                 "stored": len(self._store) if self._store is not None else 0,
+                 "limits": self.limits.stats(),
+                 "evicted_ttl": self.evicted_ttl,
+                 "evicted_count": self.evicted_count,
+                 "evicted_budget": self.evicted_budget,
+                 "timers": self.timers.stats(),
+                 "pool": self.pool.stats(),
+                 "query_caches": {label: cache.stats()
+                                  for (label, cache) in self._query_caches.items()} }
 
     def job_for_message(self, msg):
         """
@@ -492,13 +1947,118 @@ class Scheduler(object):
         return the Job matching its token.
 
         """
-        return self.jobs[msg.get_token()]
+        with self._lock:
+            return self.jobs[msg.get_token()]
 
     def prune_jobs(self):
         """
-        Currently does nothing. Will remove Jobs which are
-        finished and whose Results have been retrieved
-        from the scheduler in a future version.
+        Remove finished Jobs according to the retention policy: jobs
+        finished longer ago than the time-to-live, then the least
+        recently used finished jobs beyond the maximum finished job
+        count, then the least recently used finished jobs until their
+        results fit the result byte budget. Jobs still running are
+        never removed.
+
+        Returns the number of jobs removed.
 
         """
-        pass
+        now = mplane.clock.utcnow()
+        finished = []
+        with self._lock:
+            jobs = list(self.jobs.items())
+        for (job_key, job) in jobs:
+            ended_at = job.ended_at()
+            if ended_at is not None:
+                finished.append((job_key, job))
+
+        evicted = 0
+
+        # time-to-live after completion
+        if self._job_ttl > 0:
+            live = []
+            for (job_key, job) in finished:
+                if (now - job.ended_at()).total_seconds() > self._job_ttl:
+                    if self._evict_job(job_key, job):
+                        evicted += 1
+                        self.evicted_ttl += 1
+                else:
+                    live.append((job_key, job))
+            finished = live
+
+        # least recently used first
+        finished.sort(key=lambda item: item[1].last_used_at())
+
+        # maximum finished job count
+        if self._max_finished_jobs > 0:
+            while len(finished) > self._max_finished_jobs:
+                (job_key, job) = finished.pop(0)
+                if self._evict_job(job_key, job):
+                    evicted += 1
+                    self.evicted_count += 1
+
+        # result byte budget
+        if self._result_budget > 0:
+            total = sum(job.result_size() for (job_key, job) in finished)
+            while total > self._result_budget and len(finished):
+                (job_key, job) = finished.pop(0)
+                total -= job.result_size()
+                if self._evict_job(job_key, job):
+                    evicted += 1
+                    self.evicted_budget += 1
+
+        # finished results in the store
+        if self._store is not None:
+            (evicted_ttl, evicted_count, evicted_budget) = \
+                self._store.prune(self._job_ttl, self._max_finished_jobs, self._result_budget)
+            self.evicted_ttl += evicted_ttl
+            self.evicted_count += evicted_count
+            self.evicted_budget += evicted_budget
+            evicted += evicted_ttl + evicted_count + evicted_budget
+
+        # limits of identities and capabilities no longer in use
+        self.limits.prune()
+
+        if evicted:
+            logger.info("Scheduler: pruned "+str(evicted)+" finished jobs")
+        return evicted
+
+    def _evict_job(self, job_key, job):
+        # don't remove a new job submitted under the same key
+        with self._lock:
+            if self.jobs.get(job_key) is not job:
+                return False
+            self.jobs.pop(job_key, None)
+        self._end_limits(job)
+        return True
+
+    def _start_limits(self, job, user, cap):
+        # count the job against its limits until it ends, is interrupted
+        # or is evicted, whichever comes first
+        self.limits.job_started(user, cap)
+        with self._lock:
+            self._limited_jobs[job] = (user, cap)
+        job.add_done_callback(self._end_limits)
+
+    def _end_limits(self, job):
+        with self._lock:
+            limited = self._limited_jobs.pop(job, None)
+        if limited is not None:
+            (user, cap) = limited
+            self.limits.job_ended(user, cap, job.row_count())
+
+    def _periodic_prune(self):
+        # pruning sizes results and may hit the job store, so it runs on
+        # the worker pool; timer functions must return quickly
+        if not self.pool.submit(PRUNE_LABEL, self._prune):
+            logger.warning("Run queue full, skipping pruning")
+            self._rearm_prune()
+
+    def _prune(self):
+        try:
+            self.prune_jobs()
+        finally:
+            self._rearm_prune()
+
+    def _rearm_prune(self):
+        self._prune_timer = self.timers.call_later(self._prune_interval,
+                                                   self._periodic_prune)
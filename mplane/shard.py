@@ -0,0 +1,506 @@
+#
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+# mPlane Protocol Reference Implementation
+# Sharded scheduler
+#
+# (c) 2016 mPlane Consortium (http://www.ict-mplane.eu)
+#          Author: Brian Trammell <brian@trammell.ch>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Sharded scheduling across worker processes.
+
+A :class:`ShardedScheduler` starts a number of shard processes, each
+running its own :class:`mplane.scheduler.Scheduler` with the same
+services, and stands in for a Scheduler in the process accepting HTTP
+traffic. Specifications, Redemptions and Interrupts are routed to a
+shard by a hash of their token, so that all messages about a job reach
+the shard which owns it; matching, job execution and the encoding of
+replies happen in the shard.
+
+Admission limits and query caches are kept by each shard: an identity
+may have as many jobs running in each shard as its limits allow, and
+identical queries are only shared within a shard (which they are, as
+their tokens are the same).
+
+Shards are reached over local (Unix domain socket) connections, with
+messages exchanged in their JSON dictionary form. A
+:class:`SchedulerServer` serves a scheduler running in the current
+process over such a connection in the same way, so that HTTP worker
+processes can share it through a :class:`RemoteScheduler`.
+
+Sharded and remote schedulers can be pickled, for HTTP worker processes:
+the copy in the worker uses the same shards or server, and does not
+own them.
+
+"""
+
+import multiprocessing.connection
+import multiprocessing
+import threading
+import tempfile
+import logging
+import pickle
+import copy
+import json
+import time
+import zlib
+import os
+import mplane.model
+import mplane.scheduler
+import mplane.azn
+
+logger = logging.getLogger(__name__)
+
+SHARD_START_TIMEOUT = 30
+
+# seconds a job in a shard is waited for: as long as a component's HTTP
+# handler waits for an immediate result
+JOB_WAIT_TIMEOUT = 5
+
+# seconds a remote scheduler's capabilities are used before checking
+# whether they have changed
+CAPABILITY_REFRESH = 1
+
+OP_MESSAGE = "message"
+OP_CAPABILITIES = "capabilities"
+OP_VERSION = "version"
+OP_STATS = "stats"
+OP_WAIT = "wait"
+OP_REPLY = "reply"
+
+def shard_for_token(token, shards):
+    """Return the index of the shard owning jobs with the given token."""
+    return zlib.crc32(token.encode("utf-8")) % shards
+
+def initialize_registry(config):
+    """
+    Initialize the registry as configured in a worker process, before
+    unpickling anything holding capabilities.
+
+    """
+    registry_uri = None
+    if config is not None and "Registries" in config:
+        if "preload" in config["Registries"]:
+            for reg in config["Registries"]["preload"]:
+                mplane.model.preload_registry(reg)
+        if "default" in config["Registries"]:
+            registry_uri = config["Registries"]["default"]
+    mplane.model.initialize_registry(registry_uri)
+
+def _shard_main(config, services_pickle, index, address, authkey):
+    # services are unpickled once the registry their capabilities need exists
+    initialize_registry(config)
+    services = pickle.loads(services_pickle)
+
+    # each shard keeps its own job store
+    if config is not None and "scheduler_store" in config.get("Component", {}):
+        config = copy.deepcopy(config)
+        config["Component"]["scheduler_store"] += "." + str(index)
+
+    scheduler = mplane.scheduler.Scheduler(config)
+    for service in services:
+        scheduler.add_service(service)
+    scheduler.restore_jobs()
+
+    listener = multiprocessing.connection.Listener(address, family="AF_UNIX",
+                                                   authkey=authkey)
+    logger.info("Scheduler shard "+str(index)+" listening on "+address)
+    _serve(scheduler, listener)
+
+def _serve(scheduler, listener):
+    while True:
+        conn = listener.accept()
+        t = threading.Thread(target=_serve_connection, args=(scheduler, conn),
+                             name="mplane-shard-conn")
+        t.daemon = True
+        t.start()
+
+def _serve_connection(scheduler, conn):
+    while True:
+        try:
+            request = json.loads(conn.recv_bytes().decode("utf-8"))
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        try:
+            if request["op"] == OP_MESSAGE:
+                msg = mplane.model.message_from_dict(request["message"])
+                reply = scheduler.process_message(request["user"], msg).to_dict()
+            elif request["op"] == OP_CAPABILITIES:
+                reply = [scheduler.capability_for_key(key).to_dict()
+                         for key in scheduler.capability_keys()]
+            elif request["op"] == OP_VERSION:
+                reply = [scheduler.capability_version,
+                         scheduler.capabilities_modified]
+            elif request["op"] == OP_STATS:
+                reply = scheduler.stats()
+            elif request["op"] == OP_WAIT:
+                msg = mplane.model.message_from_dict(request["message"])
+                reply = _wait_for_job(scheduler, msg, request["timeout"])
+            elif request["op"] == OP_REPLY:
+                msg = mplane.model.message_from_dict(request["message"])
+                try:
+                    reply = scheduler.job_for_message(msg).get_reply_for(request["user"])
+                except KeyError:
+                    # finished, and moved to the shard's job store
+                    reply = scheduler.process_message(request["user"],
+                                                      mplane.model.Redemption(receipt=msg))
+                reply = reply.to_dict()
+            else:
+                raise ValueError("Unknown shard operation "+repr(request["op"]))
+            response = {"reply": reply}
+        except Exception as e:
+            logger.exception("Scheduler shard request failed: "+str(e))
+            response = {"error": str(e)}
+
+        conn.send_bytes(json.dumps(response).encode("utf-8"))
+
+def _wait_for_job(scheduler, msg, timeout):
+    # True once the job for a message has finished, or is no longer held
+    try:
+        job = scheduler.job_for_message(msg)
+    except KeyError:
+        return True
+    done = threading.Event()
+    job.add_done_callback(lambda job: done.set())
+    return done.wait(timeout)
+
+class _ShardJob(object):
+    """
+    Stands in for a job held by a shard, for a component's HTTP handler
+    waiting for an immediate result.
+
+    """
+    def __init__(self, scheduler, index, receipt):
+        super(_ShardJob, self).__init__()
+        self._scheduler = scheduler
+        self._index = index
+        self.receipt = receipt
+
+    def __repr__(self):
+        return "<_ShardJob "+self.receipt.get_token()+" in shard "+str(self._index)+">"
+
+    def add_done_callback(self, fn):
+        """
+        Arrange for fn(job) to be called, on a thread of its own, if the
+        job finishes within JOB_WAIT_TIMEOUT seconds.
+
+        """
+        t = threading.Thread(target=self._wait, args=(fn,), name="mplane-shard-wait")
+        t.daemon = True
+        t.start()
+
+    def _wait(self, fn):
+        try:
+            done = self._scheduler._request(self._index, {"op": OP_WAIT,
+                                                          "message": self.receipt.to_dict(),
+                                                          "timeout": JOB_WAIT_TIMEOUT})
+        except (EOFError, OSError, RuntimeError) as e:
+            logger.error("Scheduler shard "+str(self._index)+" failed: "+str(e))
+            return
+        if done:
+            fn(self)
+
+    def get_reply_for(self, user):
+        """Return the job's reply for a user, as the shard's job would."""
+        return mplane.model.message_from_dict(
+                    self._scheduler._request(self._index, {"op": OP_REPLY,
+                                                           "user": user,
+                                                           "message": self.receipt.to_dict()}))
+
+class ShardedScheduler(object):
+    """
+    Runs services in a number of scheduler shard processes, and routes
+    messages to them. Exposes the parts of the Scheduler interface used
+    by the client-initiated component HTTP handlers.
+
+    The services must be picklable, as they are sent to each shard when
+    it starts. Shards cannot call back into this process, so callbacks
+    (used by the component-initiated workflow) are not supported, and
+    the set of capabilities is fixed once the shards have started: there
+    is no add_service() or remove_service(), so a supervisor, which adds
+    relay services as components register, cannot use shards.
+
+    """
+    def __init__(self, config, services, shards):
+        super(ShardedScheduler, self).__init__()
+        self.shards = int(shards)
+        if self.shards < 1:
+            raise ValueError("A sharded scheduler needs at least one shard")
+        self._config = config
+        self.azn = mplane.azn.Authorization(config) if config else mplane.azn.Authorization()
+        self.services = list(services)
+
+        self._authkey = os.urandom(32)
+        self._socket_dir = tempfile.mkdtemp(prefix="mplane-shards-")
+        self._addresses = [os.path.join(self._socket_dir, "shard-"+str(i))
+                           for i in range(self.shards)]
+        self._idle = [[] for i in range(self.shards)]
+        self._lock = threading.Lock()
+        self._owner = True
+
+        # spawn, rather than fork a process which may be running threads
+        context = multiprocessing.get_context("spawn")
+        services_pickle = pickle.dumps(self.services)
+        self._processes = []
+        for i in range(self.shards):
+            process = context.Process(target=_shard_main,
+                                      args=(config, services_pickle, i,
+                                            self._addresses[i], self._authkey),
+                                      name="mplane-shard-"+str(i))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        # every shard has the same capabilities, which do not change
+        self.capability_version = 0
+        self.capabilities_modified = time.time()
+        self._capability_cache = {}
+        for capdict in self._request(0, {"op": OP_CAPABILITIES}):
+            cap = mplane.model.message_from_dict(capdict)
+            self._capability_cache[cap.get_token()] = cap
+
+        logger.info("Scheduler: started "+str(self.shards)+" shards")
+
+    def __repr__(self):
+        return "<ShardedScheduler ("+str(self.shards)+" shards)>"
+
+    def __getstate__(self):
+        # a copy for another process: it reaches the same shards, but
+        # neither shares this process's connections nor owns the shards
+        state = self.__dict__.copy()
+        for name in ("azn", "services", "_processes", "_lock", "_idle"):
+            state.pop(name, None)
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        config = self._config
+        self.azn = mplane.azn.Authorization(config) if config else mplane.azn.Authorization()
+        self.services = []
+        self._processes = []
+        self._lock = threading.Lock()
+        self._idle = [[] for i in range(self.shards)]
+
+    def _connect(self, index):
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while True:
+            try:
+                return multiprocessing.connection.Client(self._addresses[index],
+                                                         family="AF_UNIX",
+                                                         authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # still starting
+                if time.monotonic() > deadline or \
+                        (self._owner and not self._processes[index].is_alive()):
+                    raise
+                time.sleep(0.05)
+
+    def _request(self, index, request):
+        # one request at a time on each connection; keep idle ones for reuse
+        with self._lock:
+            conn = self._idle[index].pop() if len(self._idle[index]) else None
+        if conn is None:
+            conn = self._connect(index)
+
+        try:
+            conn.send_bytes(json.dumps(request).encode("utf-8"))
+            response = json.loads(conn.recv_bytes().decode("utf-8"))
+        except Exception:
+            conn.close()
+            raise
+
+        with self._lock:
+            self._idle[index].append(conn)
+        if "error" in response:
+            raise RuntimeError("Scheduler shard "+str(index)+": "+response["error"])
+        return response["reply"]
+
+    def process_message(self, user, msg, session=None, callback=None):
+        """
+        Route a Specification, Redemption or Interrupt to the shard
+        owning its token, and return the shard's reply.
+
+        """
+        if callback is not None:
+            raise ValueError("Sharded schedulers do not support callbacks")
+
+        if not isinstance(msg, (mplane.model.Specification,
+                                mplane.model.Redemption,
+                                mplane.model.Interrupt)):
+            return mplane.model.Exception(token=msg.get_token(),
+                errmsg="Unexpected message type")
+
+        index = shard_for_token(msg.get_token(), self.shards)
+        try:
+            reply = self._request(index, {"op": OP_MESSAGE,
+                                          "user": user,
+                                          "message": msg.to_dict()})
+        except (EOFError, OSError, RuntimeError) as e:
+            logger.error("Scheduler shard "+str(index)+" failed: "+str(e))
+            return mplane.model.Exception(token=msg.get_token(),
+                errmsg="Scheduler shard unavailable")
+        return mplane.model.message_from_dict(reply)
+
+    def capability_keys(self):
+        """
+        Return keys (tokens) for the set of cached capabilities
+        provided by the shards' services.
+
+        """
+        return self._capability_cache.keys()
+
+    def capability_for_key(self, key):
+        """
+        Return a capability for a given key.
+        """
+        return self._capability_cache[key]
+
+    def job_for_message(self, msg):
+        """
+        Given a message (generally a Receipt), return a stand-in for the
+        job matching its token in the shard owning it, which can be
+        waited for and asked for its reply.
+
+        """
+        return _ShardJob(self, shard_for_token(msg.get_token(), self.shards), msg)
+
+    def stats(self):
+        """Return a dictionary with the statistics of each shard."""
+        return { "shards": [self._request(i, {"op": OP_STATS})
+                            for i in range(self.shards)] }
+
+    def shutdown(self):
+        """Stop the shard processes, if this process started them."""
+        with self._lock:
+            for conns in self._idle:
+                for conn in conns:
+                    conn.close()
+                conns.clear()
+        if not self._owner:
+            return
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+
+class SchedulerServer(object):
+    """
+    Serves a scheduler running in this process to other processes, as
+    a shard serves its own, over a local connection in a thread of its
+    own. Other processes reach it through the :class:`RemoteScheduler`
+    returned by :meth:`remote`.
+
+    """
+    def __init__(self, config, scheduler):
+        super(SchedulerServer, self).__init__()
+        self._config = config
+        self._authkey = os.urandom(32)
+        self.address = os.path.join(tempfile.mkdtemp(prefix="mplane-scheduler-"),
+                                    "scheduler")
+        listener = multiprocessing.connection.Listener(self.address, family="AF_UNIX",
+                                                       authkey=self._authkey)
+        t = threading.Thread(target=_serve, args=(scheduler, listener),
+                             name="mplane-scheduler-server")
+        t.daemon = True
+        t.start()
+        logger.info("Scheduler server listening on "+self.address)
+
+    def __repr__(self):
+        return "<SchedulerServer on "+self.address+">"
+
+    def remote(self):
+        """Return a RemoteScheduler for this server."""
+        return RemoteScheduler(self._config, self.address, self._authkey)
+
+class RemoteScheduler(ShardedScheduler):
+    """
+    Stands in for a scheduler served by a :class:`SchedulerServer` in
+    another process, as a ShardedScheduler with a single shard. The
+    served scheduler's capabilities may change (e.g. as components
+    register with a supervisor); they are fetched again when its
+    capability version has changed, checked at most every
+    CAPABILITY_REFRESH seconds.
+
+    """
+    def __init__(self, config, address, authkey):
+        # no super().__init__(): there are no shard processes to start
+        self.shards = 1
+        self._config = config
+        self.azn = mplane.azn.Authorization(config) if config else mplane.azn.Authorization()
+        self.services = []
+        self._authkey = authkey
+        self._addresses = [address]
+        self._idle = [[]]
+        self._lock = threading.Lock()
+        self._owner = False
+        self._processes = []
+
+        self._version = None
+        self._modified = time.time()
+        self._refreshed = None
+        self._capability_cache = {}
+
+    def __repr__(self):
+        return "<RemoteScheduler on "+self._addresses[0]+">"
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._refreshed is not None and now - self._refreshed < CAPABILITY_REFRESH:
+            return
+        self._refreshed = now
+        try:
+            (version, modified) = self._request(0, {"op": OP_VERSION})
+            if version != self._version:
+                cache = {}
+                for capdict in self._request(0, {"op": OP_CAPABILITIES}):
+                    cap = mplane.model.message_from_dict(capdict)
+                    cache[cap.get_token()] = cap
+                self._capability_cache = cache
+                self._version = version
+                self._modified = modified
+        except (EOFError, OSError, RuntimeError) as e:
+            # keep serving the capabilities last seen
+            logger.error("Remote scheduler unavailable: "+str(e))
+
+    @property
+    def capability_version(self):
+        self._refresh()
+        return self._version
+
+    @property
+    def capabilities_modified(self):
+        self._refresh()
+        return self._modified
+
+    def capability_keys(self):
+        """
+        Return keys (tokens) for the set of capabilities provided by
+        the remote scheduler's services.
+
+        """
+        self._refresh()
+        return list(self._capability_cache.keys())
+
+    def capability_for_key(self, key):
+        """
+        Return a capability for a given key.
+        """
+        return self._capability_cache[key]
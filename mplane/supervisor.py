@@ -140,6 +140,13 @@ class BaseSupervisor(object):
                                                                      io_loop=self._io_loop,
                                                                      as_daemon=True)
         else:
+            # relay services are added as components register, and forward
+            # to the client in this process: they cannot run in scheduler
+            # shards (several listener workers share this process's
+            # scheduler, and so the client, instead)
+            if self.config["Component"].get("scheduler_shards", 0):
+                raise ValueError("The supervisor component-side cannot use scheduler_shards")
+
             if ("Initiator" in self.config["Client"]
                     and "Listener" in self.config["Client"]):
                 raise ValueError("The supervisor client-side cannot be 'Initiator' and 'Listener' simultaneously. "
@@ -175,6 +182,7 @@ class BaseSupervisor(object):
                 self._component = mplane.component.ListenerHttpComponent(self.config,
                                                                          io_loop=self._io_loop,
                                                                          as_daemon=True)
+                self._component.serve()
             else:
                 raise ValueError("Need either a 'Initiator' or 'Listener' object under 'Component' in config file")
 
@@ -23,16 +23,22 @@
 
 
 from nose.tools import assert_equal, assert_true, assert_false, raises
+from datetime import datetime, timedelta
+import mplane.clock
 import mplane.azn
 import mplane.tls
 import mplane.utils
 import mplane.model
 import mplane.scheduler
+import mplane.component
 import tornado.httpserver
+import tornado.netutil
 import tornado.ioloop
 import tornado.web
+import concurrent.futures.process
 import json
 import threading
+import asyncio
 import urllib3
 import time
 import ssl
@@ -74,6 +80,88 @@ def test_AuthorizationOn():
     assert_false(res.check(cap, id_false_role))
 
 
+def test_Priorities():
+    config = mplane.utils.get_config(config_path)
+    config["Access"]["Priorities"] = {"classes": {"interactive": 8, "bulk": 1},
+                                      "capabilities": {"test-log_tcp_complete-core": "interactive"},
+                                      "identities": {"admin": "bulk"}}
+    res = mplane.azn.Priorities(config)
+    core = mplane.model.Capability(label="test-log_tcp_complete-core")
+    layer7 = mplane.model.Capability(label="test-log_tcp_complete-layer7")
+    assert_equal(res.classify(core, "unauthenticated"), ("interactive", 8))
+    assert_equal(res.classify(layer7, "unauthenticated"), ("bulk", 1))
+    assert_equal(res.classify(layer7, id_true_role), ("default", 1))
+    assert_equal(mplane.azn.Priorities().classify(core, None), ("default", 1))
+
+def test_TokenBucket():
+    bucket = mplane.azn.TokenBucket(rate=1000, burst=2)
+    assert_true(bucket.take())
+    assert_true(bucket.take())
+    assert_false(bucket.take())
+    time.sleep(0.01)
+    assert_true(bucket.take())
+    bucket.charge(100)
+    assert_true(bucket.level() < 0)
+
+def test_Limits():
+    config = {"Access": {"Roles": {"bulk": ["client-2"]},
+                         "Limits": {"default": {"rate": 1, "burst": 2},
+                                    "identities": {"bulk": {"jobs": 1}},
+                                    "capabilities": {"limited": {"rows_per_hour": 10}}}}}
+    limits = mplane.azn.Limits(config)
+    cap = mplane.model.Capability(label="limited")
+
+    # the default limits apply to each identity separately
+    assert_equal(limits.admit_identity("client-1"), None)
+    assert_equal(limits.admit_identity("client-1"), None)
+    assert_equal(limits.admit_identity("client-1"), "Limit exceeded: rate for identity client-1")
+    assert_equal(limits.admit_identity("client-3"), None)
+
+    # concurrent jobs, by role
+    limits.job_started("client-2", cap)
+    assert_equal(limits.admit_identity("client-2"), "Limit exceeded: jobs for identity client-2")
+
+    # rows per hour, by capability
+    assert_equal(limits.admit_capability(cap), None)
+    limits.job_ended("client-2", cap, 20)
+    assert_equal(limits.admit_identity("client-2"), None)
+    assert_equal(limits.admit_capability(cap), "Limit exceeded: rows_per_hour for capability limited")
+    assert_equal(limits.stats()["identity client-2"]["jobs"], 0)
+
+    # idle limits are dropped, busy ones kept
+    limits = mplane.azn.Limits({"Access": {"Limits": {"default": {"rate": 1000, "burst": 1,
+                                                                  "jobs": 1}}}})
+    for i in range(3):
+        assert_equal(limits.admit_identity("client-%u" % i), None)
+    limits.job_started("client-0", cap)
+    time.sleep(0.01)
+    assert_equal(limits.prune(), 1)
+    assert_equal(list(limits.stats().keys()), ["identity client-0"])
+
+def test_EndpointAccess():
+    config = {"TLS": {}, "Access": {"Roles": {"ops": ["org.mplane.Ops"]}},
+              "Metrics": {"roles": ["ops"]}}
+
+    # with TLS, only identities in the configured roles are served
+    access = mplane.azn.EndpointAccess(config, "Metrics")
+    assert_true(access.check("org.mplane.Ops", "10.0.0.1"))
+    assert_false(access.check(id_true_role, "127.0.0.1"))
+
+    # and without roles, every identity or none
+    assert_true(mplane.azn.EndpointAccess(config, "Profiling").check(id_true_role, "10.0.0.1"))
+    assert_false(mplane.azn.EndpointAccess(config, "Profiling", open_default=False).check(
+                    "org.mplane.Ops", "10.0.0.1"))
+
+    # without TLS, closed endpoints are served to the loopback interface only
+    access = mplane.azn.EndpointAccess(None, "Profiling", open_default=False)
+    assert_true(access.check(None, "127.0.0.1"))
+    assert_false(access.check(None, "10.0.0.1"))
+    assert_true(mplane.azn.EndpointAccess(None, "Metrics").check(None, "10.0.0.1"))
+
+@raises(ValueError)
+def test_EndpointAccess_unknown_role():
+    mplane.azn.EndpointAccess({"Access": {"Roles": {}}, "Metrics": {"roles": ["ops"]}}, "Metrics")
+
 def test_AuthorizationOff():
     mplane.model.initialize_registry()
     cap = mplane.model.Capability(label="test-log_tcp_complete-core")
@@ -252,6 +340,30 @@ class SchedulerTestService(mplane.scheduler.Service):
     def run(self, specification, check_interrupt):
         return st_res
 
+class ProcessTestService(mplane.scheduler.Service):
+    execution_mode = mplane.scheduler.EXECUTION_PROCESS
+
+    def run(self, specification, check_interrupt):
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2017-12-24 22:18:42.993000 ... " +
+                     "2017-12-24 22:19:42.991000")
+        # report the worker's pid, and whether we were interrupted
+        while not check_interrupt() and str(specification.get_parameter_value("destination.ip4")) == "10.0.0.1":
+            time.sleep(0.01)
+        # and this one makes the worker process die
+        if str(specification.get_parameter_value("destination.ip4")) == "10.0.0.2":
+            os._exit(1)
+        res.set_result_value("delay.twoway.icmp.count", os.getpid())
+        res.set_result_value("packets.lost", int(check_interrupt()))
+        return res
+
+class AsyncTestService(mplane.scheduler.Service):
+    async def run(self, specification, check_interrupt):
+        # this destination makes the service wait until cancelled
+        if str(specification.get_parameter_value("destination.ip4")) == "10.0.0.1":
+            await asyncio.sleep(60)
+        return st_res
+
 st_cap = create_test_capability()
 st_spec = create_test_specification()
 st_receipt = mplane.model.Receipt(specification=st_spec)
@@ -323,9 +435,11 @@ def test_Job_check_interrupt():
 
 
 def test_Job_set_interrupt():
-    # Set interrupt
-    job.interrupt()
-    assert_true(job._interrupt.is_set())
+    # Set interrupt; a job interrupted before it has started fails
+    interrupted = mplane.scheduler.Job(test_service, st_spec)
+    interrupted.interrupt()
+    assert_true(interrupted._interrupt.is_set())
+    assert_true(interrupted.failed())
 
 
 def test_Job_finished_false():
@@ -367,6 +481,985 @@ def test_Job_get_reply_failed():
     # Job has failed.
     assert_true(isinstance(job_failure.get_reply(), mplane.model.Exception))
 
+# Class Scheduler tests:
+
+def test_Scheduler_match_service():
+    scheduler = mplane.scheduler.Scheduler()
+    other_cap = mplane.model.Capability(label="test-other")
+    other_cap.add_parameter("destination.ip4")
+    other_cap.add_result_column("packets.lost")
+    other_service = SchedulerTestService(other_cap)
+
+    scheduler.add_service(other_service)
+    assert_equal(scheduler.match_service(st_spec), None)
+    scheduler.add_service(test_service)
+    assert_equal(scheduler.match_service(st_spec), test_service)
+    scheduler.remove_service(test_service)
+    assert_equal(scheduler.match_service(st_spec), None)
+    assert_false(st_cap._schema_hash() in scheduler._services_by_schema)
+
+def test_Scheduler_match_specification_withdrawn():
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(test_service)
+    (cap, service) = scheduler.match_specification(st_spec)
+    assert_equal(cap, st_cap)
+    assert_equal(service, test_service)
+
+    scheduler.remove_service(test_service)
+    (cap, service) = scheduler.match_specification(st_spec)
+    assert_true(isinstance(cap, mplane.model.Withdrawal))
+    assert_equal(service, None)
+    reply = scheduler.submit_job(None, st_spec)
+    assert_true(isinstance(reply, mplane.model.Withdrawal))
+
+    # re-adding the service makes the capability available again
+    scheduler.add_service(test_service)
+    assert_equal(scheduler.match_specification(st_spec)[1], test_service)
+    assert_equal(len(scheduler._withdrawn_by_schema[st_cap._schema_hash()]), 0)
+
+def test_TimerQueue():
+    timers = mplane.scheduler.TimerQueue()
+    fired = threading.Event()
+    calls = []
+
+    cancelled = timers.call_later(0.05, calls.append, "cancelled")
+    timers.call_later(0.1, calls.append, "fired")
+    timers.call_later(0.1, fired.set)
+    assert_equal(timers.backlog(), 3)
+    cancelled.cancel()
+    assert_equal(timers.backlog(), 2)
+
+    assert_true(fired.wait(5))
+    assert_equal(calls, ["fired"])
+    assert_equal(timers.backlog(), 0)
+    assert_equal(timers.stats()["fired"], 2)
+
+def test_SimulatedClock():
+    import mplane.clock
+    clock = mplane.clock.SimulatedClock(datetime(2036, 12, 24, 22, 18, 42))
+    mplane.clock.set_clock(clock)
+    try:
+        scheduler = mplane.scheduler.Scheduler()
+        scheduler.add_service(test_service)
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.45.1")
+        spec.set_when("repeat now + 1h / 1s { now + 0s / 1s }")
+        receipt = scheduler.submit_job(None, spec)
+        multijob = scheduler.job_for_message(receipt)
+
+        # an hour of runs, each started on time
+        clock.advance(3600, settle=scheduler.pool.join)
+        assert_equal(clock.utcnow(), datetime(2036, 12, 24, 23, 18, 42))
+        assert_equal(multijob._results_collected, 3600)
+        assert_false(multijob.failed())
+        assert_equal(scheduler.timers.stats()["lag_max"], 0.0)
+    finally:
+        mplane.clock.set_clock(None)
+
+def test_SimulatedClock_queues():
+    import mplane.clock
+    import mplane.jobstore
+    import tempfile
+    import weakref
+    import gc
+    clock = mplane.clock.SimulatedClock(datetime(2036, 12, 24, 22, 18, 42))
+    assert_equal(clock.timestamp(), 2113769922)
+
+    # the clock does not keep discarded timer queues alive
+    timers = mplane.scheduler.TimerQueue(clock)
+    ref = weakref.ref(timers)
+    del timers
+    gc.collect()
+    assert_true(ref() is None)
+
+    # a detached queue's timers are not fired
+    calls = []
+    timers = mplane.scheduler.TimerQueue(clock)
+    timers.call_later(1, calls.append, "fired")
+    clock.detach(timers)
+    assert_equal(clock.advance(2), 0)
+    assert_equal(calls, [])
+
+    # the job store ages results on the clock in use
+    mplane.clock.set_clock(clock)
+    try:
+        store = mplane.jobstore.JobStore(os.path.join(tempfile.mkdtemp(), "jobs.sqlite"))
+        store.add_job(st_res.get_token(), st_spec, {"client-1": 1})
+        store.finish(st_res.get_token(), st_res)
+        assert_equal(store.prune(ttl=60)[0], 0)
+        clock.advance(61)
+        assert_equal(store.prune(ttl=60)[0], 1)
+        store.close()
+    finally:
+        mplane.clock.set_clock(None)
+
+def test_Job_interrupt_before_start():
+    callbacks = []
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_when("2036-12-24 22:18:42 + 1m / 1s")
+    timers = mplane.scheduler.TimerQueue()
+    job = mplane.scheduler.Job(test_service, spec,
+                               callback=callbacks.append, timers=timers)
+    job.schedule()
+    assert_equal(timers.backlog(), 2)
+
+    job.interrupt()
+    assert_equal(timers.backlog(), 0)
+    assert_true(job.failed())
+    assert_equal(len(callbacks), 1)
+
+    # a start timer firing once the job was interrupted does not run it
+    job._schedule_now()
+    job.interrupt()
+    assert_equal(len(callbacks), 1)
+
+def test_Job_interrupt_after_start():
+    # the start timer fired just before the interrupt: the job runs once
+    callbacks = []
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_when("2036-12-24 22:18:42 + 1m / 1s")
+    timers = mplane.scheduler.TimerQueue()
+    pool = mplane.scheduler.WorkerPool(workers=1)
+    job = mplane.scheduler.Job(test_service, spec, callback=callbacks.append,
+                               timers=timers, pool=pool)
+    job._schedule_now()
+    job.interrupt()
+    pool.join()
+    assert_false(job.failed())
+    assert_true(job.finished())
+    assert_equal(len(callbacks), 1)
+
+def test_MultiJob_interrupt_before_next():
+    # a sub-job whose start timer fires after the interrupt is not run
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.29.1")
+    spec.set_when("now + 1h / 1s")
+    timers = mplane.scheduler.TimerQueue()
+    multijob = mplane.scheduler.MultiJob(test_service, spec, timers=timers,
+                                         pool=mplane.scheduler.WorkerPool(workers=1))
+    multijob._subspec = next(multijob._subspec_iterator)
+    multijob.interrupt()
+    multijob._schedule_job()
+    assert_equal(len(multijob.jobs), 0)
+    assert_true(multijob.finished())
+
+def test_MultiJob_interrupt_before_schedule():
+    # a sub-job interrupted once added to jobs, but before it is
+    # scheduled, fails, and the multijob finishes
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.29.2")
+    spec.set_when("now + 1h / 1s")
+    timers = mplane.scheduler.TimerQueue()
+    multijob = mplane.scheduler.MultiJob(test_service, spec, timers=timers,
+                                         pool=mplane.scheduler.WorkerPool(workers=1))
+    done = []
+    multijob.add_done_callback(done.append)
+    job = mplane.scheduler.Job(test_service, next(multijob._subspec_iterator), timers=timers)
+    with multijob._jobs_lock:
+        multijob.jobs.add(job)
+        job.add_done_callback(multijob._job_done)
+    multijob.interrupt()
+    job.schedule()
+    assert_true(job.failed())
+    assert_equal(len(multijob.jobs), 0)
+    assert_equal(done, [multijob])
+
+def test_Job_expired():
+    # jobs and multijobs whose temporal scope has passed fail at once
+    callbacks = []
+    cap = mplane.model.Capability(label="test-expired", when="past ... future / 1s")
+    service = SchedulerTestService(cap)
+    spec = mplane.model.Specification(capability=cap)
+    spec.set_when("2016-12-24 22:18:42 ... 2016-12-24 22:19:42 / 1s")
+    job = mplane.scheduler.Job(service, spec, callback=callbacks.append)
+    job.schedule()
+    assert_true(job.failed())
+    assert_equal(len(callbacks), 1)
+    job.interrupt()
+    assert_equal(len(callbacks), 1)
+
+    multijob = mplane.scheduler.MultiJob(service, spec)
+    done = []
+    multijob.add_done_callback(done.append)
+    multijob.schedule()
+    assert_equal(done, [multijob])
+
+def test_WorkerPool_limits():
+    pool = mplane.scheduler.WorkerPool(workers=4, queue_limit=2,
+                                       service_limits={"slow": 1})
+    release = threading.Event()
+    done = threading.Semaphore(0)
+
+    def block():
+        release.wait(5)
+        done.release()
+
+    assert_true(pool.submit("slow", block))
+    assert_true(pool.submit("slow", block))
+    time.sleep(0.1)
+    # the second slow run waits for the first, even with idle workers
+    assert_equal(pool.stats()["running"], 1)
+    assert_equal(pool.queue_depth(), 1)
+
+    assert_true(pool.submit("fast", done.release))
+    assert_true(done.acquire(timeout=5))
+
+    assert_true(pool.submit("slow", block))
+    assert_true(pool.saturated())
+    assert_false(pool.submit("slow", block))
+    assert_equal(pool.stats()["rejected"], 1)
+
+    release.set()
+    for i in range(3):
+        assert_true(done.acquire(timeout=5))
+    assert_equal(pool.queue_depth(), 0)
+
+def test_WorkerPool_fair_queuing():
+    pool = mplane.scheduler.WorkerPool(workers=1)
+    release = threading.Event()
+    order = []
+    done = threading.Semaphore(0)
+
+    def run(name):
+        order.append(name)
+        done.release()
+
+    # queue a deep bulk backlog behind a blocked worker, then two probes
+    assert_true(pool.submit("gate", release.wait, 5))
+    for i in range(10):
+        assert_true(pool.submit("bulk", run, "bulk", flow="bulk", weight=1))
+    for i in range(2):
+        assert_true(pool.submit("probe", run, "probe", flow="probe", weight=8))
+    release.set()
+    for i in range(12):
+        assert_true(done.acquire(timeout=5))
+
+    # the probes overtake every queued bulk run
+    assert_equal(order[:3], ["probe", "probe", "bulk"])
+    assert_equal(pool.stats()["flows"], 0)
+
+def test_ProcessRunner():
+    runner = mplane.scheduler.ProcessRunner(processes=1)
+    interrupt = threading.Event()
+    try:
+        res = runner.run(ProcessTestService(st_cap), st_spec, interrupt)
+        assert_true(isinstance(res, mplane.model.Result))
+        assert_equal(res.get_token(), st_spec.get_token())
+        row = next(res.schema_dict_iterator())
+        assert_false(row["delay.twoway.icmp.count"] == os.getpid())
+        assert_equal(row["packets.lost"], 0)
+
+        # this destination makes the service run until interrupted
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.0.1")
+        spec.set_when("now + 1s / 1s")
+        threading.Timer(0.2, interrupt.set).start()
+        res = runner.run(ProcessTestService(st_cap), spec, interrupt)
+        assert_equal(next(res.schema_dict_iterator())["packets.lost"], 1)
+
+        # a dead worker fails its run, and the pool is replaced
+        spec.set_parameter_value("destination.ip4", "10.0.0.2")
+        try:
+            runner.run(ProcessTestService(st_cap), spec, threading.Event())
+            assert_true(False)
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+        res = runner.run(ProcessTestService(st_cap), st_spec, threading.Event())
+        assert_equal(res.get_token(), st_spec.get_token())
+    finally:
+        runner.shutdown()
+
+def test_Job_coroutine_service():
+    done = threading.Semaphore(0)
+    callback = lambda receipt: done.release()
+    loop = mplane.scheduler.EventLoopRunner()
+
+    job = mplane.scheduler.Job(AsyncTestService(st_cap), st_spec,
+                               callback=callback, loop=loop)
+    job._schedule_now()
+    assert_true(done.acquire(timeout=5))
+    assert_equal(job.result, st_res)
+
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.0.1")
+    spec.set_when("now + 1m / 1s")
+    job = mplane.scheduler.Job(AsyncTestService(st_cap), spec,
+                               callback=callback, loop=loop)
+    job._schedule_now()
+    time.sleep(0.1)
+    job.interrupt()
+    assert_true(done.acquire(timeout=5))
+    assert_true(job.failed())
+
+def test_Job_add_done_callback():
+    done = threading.Event()
+    done_jobs = []
+    job = mplane.scheduler.Job(test_service, st_spec)
+    job.add_done_callback(done_jobs.append)
+    job.add_done_callback(lambda job: done.set())
+    job._schedule_now()
+    assert_true(done.wait(5))
+    assert_equal(done_jobs, [job])
+
+    # callbacks added after completion are called immediately
+    job.add_done_callback(done_jobs.append)
+    assert_equal(done_jobs, [job, job])
+
+def test_MultiJob_ring_buffer():
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    spec.set_when("repeat now + 2s / 1s { now + 0s / 1s }")
+    multijob = mplane.scheduler.MultiJob(test_service, spec, max_results=1)
+    other = mplane.scheduler.MultiJob(test_service, spec)
+    assert_false(multijob.jobs is other.jobs)
+
+    done = threading.Event()
+    multijob.add_done_callback(lambda multijob: done.set())
+    multijob.schedule()
+    assert_true(done.wait(5))
+    assert_true(multijob._results_collected > 1)
+    assert_equal(len(multijob.results), 1)
+    assert_equal(len(multijob.jobs), 0)
+    assert_true(isinstance(multijob.get_reply(), mplane.model.Envelope))
+
+class QueryTestService(mplane.scheduler.Service):
+    def __init__(self, capability):
+        super(QueryTestService, self).__init__(capability)
+        self.runs = 0
+
+    def run(self, specification, check_interrupt):
+        self.runs += 1
+        time.sleep(0.1)
+        res = mplane.model.Result(specification=specification)
+        res.set_when("2017-12-24 22:18:42.993000 ... " +
+                     "2017-12-24 22:19:42.991000")
+        res.set_result_value("packets.lost", self.runs)
+        return res
+
+class BatchTestService(mplane.scheduler.Service):
+    def __init__(self, capability):
+        super(BatchTestService, self).__init__(capability)
+        self.proceed = threading.Semaphore(0)
+
+    def run(self, specification, check_interrupt):
+        for i in range(2):
+            res = mplane.model.Result(specification=specification)
+            res.set_when("2017-12-24 22:18:4%d ... 2017-12-24 22:18:4%d" % (i, i + 1))
+            res.set_result_value("packets.lost", i)
+            yield res
+            self.proceed.acquire()
+
+def test_Scheduler_partial_results():
+    import mplane.client
+    import mplane.exporter
+    batch_service = BatchTestService(st_cap)
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(batch_service)
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.41.1")
+    spec.set_when("now + 1m / 1s")
+
+    available = threading.Semaphore(0)
+    receipt = scheduler.submit_job("client-1", spec, callback=lambda r: available.release())
+    redemption = mplane.model.Redemption(receipt=receipt)
+    client = mplane.client.BaseClient(None)
+    out = io.StringIO()
+    writer = mplane.exporter.ResultWriter(out, mplane.exporter.FORMAT_CSV)
+    client.add_result_sink(writer)
+    client.handle_message(receipt)
+
+    # rows are redeemable while the service runs, once each
+    assert_true(available.acquire(timeout=5))
+    reply = mplane.model.parse_json(mplane.model.unparse_json(
+                scheduler.process_message("client-1", redemption)))
+    assert_true(isinstance(reply, mplane.model.Envelope))
+    client.handle_message(reply)
+    assert_true(isinstance(scheduler.process_message("client-1", redemption),
+                           mplane.model.Receipt))
+
+    done = threading.Event()
+    scheduler.job_for_message(receipt).add_done_callback(lambda job: done.set())
+    batch_service.proceed.release()
+    batch_service.proceed.release()
+    assert_true(done.wait(5))
+
+    # the final reply holds the remaining rows, and the client merges them
+    final = scheduler.process_message("client-1", redemption)
+    assert_equal(final.count_result_rows(), 1)
+    client.handle_message(final)
+    merged = client.result_for(receipt.get_token())
+    assert_true(isinstance(merged, mplane.model.Result))
+    assert_equal([row["packets.lost"] for row in merged.schema_dict_iterator()], [0, 1])
+
+    # and a sink writes each row once, even when given them again
+    client.handle_message(final)
+    assert_equal(writer.rows_written, 2)
+    assert_equal(len(out.getvalue().splitlines()), 3)
+
+def test_Scheduler_partial_results_same_identity():
+    batch_service = BatchTestService(st_cap)
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(batch_service)
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.41.2")
+    spec.set_when("now + 1m / 1s")
+
+    # two subscriptions of one identity share the job
+    available = threading.Semaphore(0)
+    receipt = scheduler.submit_job("client-1", spec, callback=lambda r: available.release())
+    scheduler.submit_job("client-1", spec)
+    redemption = mplane.model.Redemption(receipt=receipt)
+    assert_true(available.acquire(timeout=5))
+
+    # each redemption of either subscriber gets every row so far
+    for i in range(2):
+        reply = scheduler.process_message("client-1", redemption)
+        assert_true(isinstance(reply, mplane.model.Envelope))
+
+    done = threading.Event()
+    scheduler.job_for_message(receipt).add_done_callback(lambda job: done.set())
+    batch_service.proceed.release()
+    batch_service.proceed.release()
+    assert_true(done.wait(5))
+
+    for i in range(2):
+        final = scheduler.process_message("client-1", redemption)
+        assert_equal(final.count_result_rows(), 2)
+
+def test_Scheduler_query_cache():
+    cap = mplane.model.Capability(label="test-query", verb=mplane.model.VERB_QUERY,
+                                  when="past ... now")
+    cap.add_parameter("destination.ip4")
+    cap.add_result_column("packets.lost")
+    query_service = QueryTestService(cap)
+    scheduler = mplane.scheduler.Scheduler({"Component": {
+                        "scheduler_query_cache": {"test-query": {"ttl": "60"}}}})
+    scheduler.add_service(query_service)
+
+    spec = mplane.model.Specification(capability=cap)
+    spec.set_parameter_value("destination.ip4", "10.0.37.2")
+    spec.set_when("2016-12-24 22:18:42 + 1m")
+
+    # identical queries in flight share one execution
+    done = threading.Event()
+    receipt = scheduler.submit_job(None, spec)
+    assert_true(isinstance(receipt, mplane.model.Receipt))
+    assert_equal(scheduler.submit_job(None, spec).get_token(), receipt.get_token())
+    scheduler.job_for_message(receipt).add_done_callback(lambda job: done.set())
+    assert_true(done.wait(5))
+
+    # later queries and redemptions are answered from the cache
+    result = scheduler.submit_job(None, spec)
+    assert_true(isinstance(result, mplane.model.Result))
+    redemption = mplane.model.Redemption(receipt=receipt)
+    assert_equal(scheduler.process_message(None, redemption), result)
+    assert_equal(scheduler.process_message(None, redemption), result)
+    assert_equal(query_service.runs, 1)
+
+def test_Scheduler_subscribers():
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(test_service)
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.39.1")
+    spec.set_when("now + 1m / 1s")
+
+    notified = threading.Semaphore(0)
+    callback = lambda receipt: notified.release()
+    receipt = scheduler.submit_job("client-1", spec, callback=callback)
+    scheduler.submit_job("client-2", spec, callback=callback)
+    assert_true(notified.acquire(timeout=5))
+    assert_true(notified.acquire(timeout=5))
+
+    # results are kept until both subscribers have redeemed them
+    redemption = mplane.model.Redemption(receipt=receipt)
+    assert_equal(scheduler.process_message("client-1", redemption), st_res)
+    assert_true(receipt.get_token() in scheduler.jobs)
+    assert_equal(scheduler.process_message("client-2", redemption), st_res)
+    assert_false(receipt.get_token() in scheduler.jobs)
+
+def test_Scheduler_limits():
+    scheduler = mplane.scheduler.Scheduler({"Access": {"Limits": {
+                        "default": {"rate": 0.001, "burst": 2}}}})
+    scheduler.add_service(test_service)
+
+    replies = []
+    for i in range(3):
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.43." + str(i))
+        spec.set_when("now + 1m / 1s")
+        replies.append(scheduler.submit_job("client-1", spec))
+    assert_true(isinstance(replies[1], mplane.model.Receipt))
+    assert_true(isinstance(replies[2], mplane.model.Exception))
+    assert_equal(len(scheduler.jobs), 2)
+
+def test_Scheduler_limits_released():
+    scheduler = mplane.scheduler.Scheduler({"Access": {"Limits": {
+                        "default": {"jobs": 1}}}})
+    scheduler.add_service(test_service)
+    specs = []
+    for i in range(2):
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.43.1" + str(i))
+        spec.set_when("now + 1h / 1s")
+        spec.set_label("test-limits-" + str(i))
+        specs.append(spec)
+
+    # an interrupted job gives up its slot at once
+    receipt = scheduler.submit_job("client-1", specs[0])
+    assert_true(isinstance(scheduler.submit_job("client-1", specs[1]), mplane.model.Exception))
+    scheduler.process_message("client-1", mplane.model.Interrupt(specification=specs[0]))
+    receipt = scheduler.submit_job("client-1", specs[1])
+    assert_true(isinstance(receipt, mplane.model.Receipt))
+
+    # as does an evicted one
+    job = scheduler.job_for_message(receipt)
+    assert_true(scheduler._evict_job(receipt.get_token(), job))
+    assert_equal(scheduler.limits.stats()["identity client-1"]["jobs"], 0)
+    job.interrupt()
+    assert_equal(scheduler.limits.stats()["identity client-1"]["jobs"], 0)
+
+def test_Scheduler_prune_jobs():
+    scheduler = mplane.scheduler.Scheduler({"Component": {
+                        "scheduler_job_ttl": "3600",
+                        "scheduler_max_finished_jobs": "2",
+                        "scheduler_prune_interval": "0"}})
+    scheduler.add_service(test_service)
+    done = threading.Semaphore(0)
+
+    for i in range(4):
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.38." + str(i))
+        spec.set_when("now + 1m / 1s")
+        scheduler.submit_job(None, spec, callback=lambda receipt: done.release())
+    for i in range(4):
+        assert_true(done.acquire(timeout=5))
+    assert_equal(len(scheduler.jobs), 4)
+
+    # expire one job, then evict the least recently used beyond two
+    jobs = list(scheduler.jobs.values())
+    jobs[0]._ended_at = mplane.clock.utcnow() - timedelta(hours=2)
+    jobs[1].get_reply()
+    assert_equal(scheduler.prune_jobs(), 2)
+    assert_equal(scheduler.evicted_ttl, 1)
+    assert_equal(scheduler.evicted_count, 1)
+    assert_true(jobs[1] in scheduler.jobs.values())
+
+    # a budget of one byte evicts everything finished
+    scheduler._result_budget = 1
+    assert_equal(scheduler.prune_jobs(), 2)
+    assert_equal(scheduler.stats()["evicted_budget"], 2)
+    assert_equal(len(scheduler.jobs), 0)
+
+    # the prune timer hands pruning to the worker pool, and re-arms
+    threads = []
+    scheduler.prune_jobs = lambda: threads.append(threading.current_thread().name)
+    scheduler._prune_interval = 3600
+    scheduler._periodic_prune()
+    assert_true(scheduler.pool.join(timeout=5))
+    assert_true(threads[0].startswith("mplane-worker"))
+    assert_true(scheduler._prune_timer is not None)
+    scheduler._prune_timer.cancel()
+
+def test_Scheduler_concurrent_access():
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(test_service)
+    other = SchedulerTestService(mplane.model.Capability(label="other-cap", when="now ... future"))
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.46.1")
+    spec.set_when("now + 1m / 1s")
+
+    # services come and go while clients submit and list capabilities
+    stop = threading.Event()
+    errors = []
+    def churn():
+        try:
+            while not stop.is_set():
+                scheduler.add_service(other)
+                for key in scheduler.capability_keys():
+                    scheduler.capability_for_key(key)
+                scheduler.remove_service(other)
+        except Exception as e:
+            errors.append(e)
+    receipts = []
+    def submit():
+        try:
+            for i in range(50):
+                receipts.append(scheduler.submit_job("client-1", spec))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=churn)] + \
+              [threading.Thread(target=submit) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads[1:]:
+        t.join()
+    stop.set()
+    threads[0].join()
+
+    # identical specifications share one job
+    assert_equal(errors, [])
+    assert_equal(len(scheduler.jobs), 1)
+    assert_equal(set(r.get_token() for r in receipts), set([spec.get_token()]))
+
+def test_Scheduler_callbacks_unlocked():
+    cap = mplane.model.Capability(label="test-unlocked", when="now ... future")
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(SchedulerTestService(cap))
+    spec = mplane.model.Specification(capability=cap)
+    spec.set_when("now + 1s")
+
+    # a run rejected by the worker pool fails at once, and calls back
+    # its subscriber with the scheduler unlocked
+    scheduler.pool.submit = lambda *args, **kwargs: False
+    unlocked = []
+    def try_lock():
+        if scheduler._lock.acquire(timeout=5):
+            unlocked.append(True)
+            scheduler._lock.release()
+    def callback(receipt):
+        t = threading.Thread(target=try_lock)
+        t.start()
+        t.join()
+    scheduler.submit_job("client-1", spec, callback=callback)
+    assert_equal(unlocked, [True])
+
+def test_Scheduler_job_store():
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "jobs.sqlite")
+    scheduler = mplane.scheduler.Scheduler({"Component": {"scheduler_store": path}})
+    scheduler.add_service(test_service)
+
+    # finished results move from memory to the store
+    done = threading.Event()
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.40.1")
+    spec.set_when("now + 1m / 1s")
+    receipt = scheduler.submit_job("client-1", spec, callback=lambda receipt: done.set())
+    assert_true(done.wait(5))
+    assert_equal(len(scheduler.jobs), 0)
+    assert_equal(scheduler.stats()["stored"], 1)
+
+    # a job scheduled in an hour is still pending
+    later = mplane.model.Specification(capability=st_cap)
+    later.set_parameter_value("destination.ip4", "10.0.40.2")
+    later.set_when(mplane.model.unparse_time(mplane.clock.utcnow() + timedelta(hours=1)) + " + 1s / 1s")
+    later_receipt = scheduler.submit_job("client-2", later)
+    assert_equal(len(scheduler.jobs), 1)
+
+    # stop the component without interrupting its jobs
+    scheduler.jobs[later_receipt.get_token()]._start_timer.cancel()
+    scheduler.jobs[later_receipt.get_token()]._end_timer.cancel()
+
+    # after a restart, pending jobs are re-armed and results redeemable
+    restarted = mplane.scheduler.Scheduler({"Component": {"scheduler_store": path}})
+    restarted.add_service(test_service)
+    assert_equal(restarted.restore_jobs(), 1)
+    assert_true(later_receipt.get_token() in restarted.jobs)
+    restarted.jobs[later_receipt.get_token()].interrupt()
+
+    redemption = mplane.model.Redemption(receipt=receipt)
+    assert_equal(restarted.process_message("client-1", redemption).get_token(),
+                 st_res.get_token())
+    assert_true(isinstance(restarted.process_message("client-1", redemption),
+                           mplane.model.Exception))
+
+def test_ShardedScheduler():
+    import mplane.shard
+    sharded = mplane.shard.ShardedScheduler(None, [test_service], 2)
+    try:
+        assert_equal(list(sharded.capability_keys()), [st_cap.get_token()])
+
+        # jobs are owned by the shard their token hashes to
+        receipts = []
+        for i in range(8):
+            spec = mplane.model.Specification(capability=st_cap)
+            spec.set_parameter_value("destination.ip4", "10.0.44." + str(i))
+            spec.set_when("now + 1m / 1s")
+            receipts.append(sharded.process_message("client-1", spec))
+        owners = [mplane.shard.shard_for_token(r.get_token(), 2) for r in receipts]
+        stats = sharded.stats()["shards"]
+        assert_equal([s["jobs"] for s in stats],
+                     [owners.count(0), owners.count(1)])
+
+        # and answer redemptions routed to them
+        for receipt in receipts:
+            redemption = mplane.model.Redemption(receipt=receipt)
+            for attempt in range(50):
+                reply = sharded.process_message("client-1", redemption)
+                if not isinstance(reply, mplane.model.Receipt):
+                    break
+                time.sleep(0.1)
+            assert_equal(reply.get_token(), st_res.get_token())
+
+        # jobs in the shards can be waited for
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.44.100")
+        spec.set_when("now + 1s / 1s")
+        receipt = sharded.process_message("client-1", spec)
+        job = sharded.job_for_message(receipt)
+        done = threading.Event()
+        job.add_done_callback(lambda job: done.set())
+        assert_true(done.wait(5))
+        assert_true(isinstance(job.get_reply_for("client-1"), mplane.model.Result))
+    finally:
+        sharded.shutdown()
+
+def test_ShardedScheduler_limits():
+    # limits apply in each shard separately
+    import mplane.shard
+    sharded = mplane.shard.ShardedScheduler({"Access": {"Limits": {"default": {"jobs": 1}}}},
+                                            [test_service], 2)
+    try:
+        specs = {0: [], 1: []}
+        i = 0
+        while len(specs[0]) < 2 or len(specs[1]) < 1:
+            spec = mplane.model.Specification(capability=st_cap)
+            spec.set_parameter_value("destination.ip4", "10.0.44." + str(i))
+            spec.set_when("2036-12-24 22:18:42 + 1m / 1s")
+            specs[mplane.shard.shard_for_token(spec.get_token(), 2)].append(spec)
+            i += 1
+        assert_true(isinstance(sharded.process_message("client-1", specs[0][0]),
+                               mplane.model.Receipt))
+        assert_true(isinstance(sharded.process_message("client-1", specs[1][0]),
+                               mplane.model.Receipt))
+        assert_true(isinstance(sharded.process_message("client-1", specs[0][1]),
+                               mplane.model.Exception))
+    finally:
+        sharded.shutdown()
+
+def test_ListenerHttpComponent_workers():
+    # the workers bind the port themselves
+    sock = tornado.netutil.bind_sockets(0, "127.0.0.1")[0]
+    port = sock.getsockname()[1]
+    sock.close()
+    config = {"Component": {"Listener": {"port": str(port),
+                                         "interfaces": ["127.0.0.1"],
+                                         "workers": 2}}}
+    component = mplane.component.ListenerHttpComponent(config)
+    component.scheduler.add_service(test_service)
+    component.serve()
+
+    pool = urllib3.HTTPConnectionPool("127.0.0.1", port, retries=False)
+    def capabilities():
+        res = pool.request("GET", "/capability?format=json")
+        assert_equal(res.status, 200)
+        return len(list(mplane.model.parse_json(res.data.decode("utf-8")).messages()))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                assert_equal(capabilities(), 1)
+                break
+            except urllib3.exceptions.HTTPError:
+                assert_true(time.monotonic() < deadline)
+                time.sleep(0.1)
+
+        # the workers run jobs on this process's scheduler, and wait for
+        # quick results
+        spec = mplane.model.Specification(capability=st_cap)
+        spec.set_parameter_value("destination.ip4", "10.0.47.1")
+        spec.set_when("now + 1s / 1s")
+        res = pool.urlopen("POST", "/", body=mplane.model.unparse_json(spec).encode("utf-8"),
+                           headers={"content-type": "application/x-mplane+json"})
+        assert_true(isinstance(mplane.model.parse_json(res.data.decode("utf-8")),
+                               mplane.model.Result))
+
+        # and see the capabilities added to it since they started
+        cap = create_test_capability()
+        cap.add_result_column("octets.ip")
+        component.scheduler.add_service(SchedulerTestService(cap))
+        time.sleep(mplane.shard.CAPABILITY_REFRESH + 0.1)
+        assert_equal(capabilities(), 2)
+    finally:
+        pool.close()
+        component.stop_workers()
+
+def test_RemoteScheduler():
+    import mplane.shard
+    scheduler = mplane.scheduler.Scheduler()
+    scheduler.add_service(test_service)
+    remote = mplane.shard.SchedulerServer(None, scheduler).remote()
+    assert_equal(remote.capability_keys(), [st_cap.get_token()])
+
+    # capabilities added are seen once the refresh interval has passed
+    cap = create_test_capability()
+    cap.add_result_column("octets.ip")
+    scheduler.add_service(SchedulerTestService(cap))
+    assert_equal(len(remote.capability_keys()), 1)
+    time.sleep(mplane.shard.CAPABILITY_REFRESH + 0.1)
+    assert_equal(len(remote.capability_keys()), 2)
+    assert_equal(remote.capability_version, scheduler.capability_version)
+
+    # jobs can be waited for, and their replies retrieved
+    spec = mplane.model.Specification(capability=st_cap)
+    spec.set_parameter_value("destination.ip4", "10.0.47.2")
+    spec.set_when("now + 1s / 1s")
+    receipt = remote.process_message("client-1", spec)
+    job = remote.job_for_message(receipt)
+    done = threading.Event()
+    job.add_done_callback(lambda job: done.set())
+    assert_true(done.wait(5))
+    assert_true(isinstance(job.get_reply_for("client-1"), mplane.model.Result))
+    remote.shutdown()
+
+@raises(ValueError)
+def test_HttpListenerClient_workers():
+    # the client's state lives in one process
+    import mplane.client
+    mplane.client.HttpListenerClient({"Client": {"Listener": {"workers": 2}}},
+                                     tls_state=mplane.tls.TlsState(None))
+
+@raises(ValueError)
+def test_BaseSupervisor_shards():
+    # relay services cannot be added to shards
+    import mplane.supervisor
+    mplane.supervisor.BaseSupervisor({"Client": {"Listener": {}},
+                                      "Component": {"Listener": {},
+                                                    "scheduler_shards": 2}})
+
+class CountingDiscoveryHandler(mplane.component.DiscoveryHandler):
+    requests = []
+
+    def prepare(self):
+        super(CountingDiscoveryHandler, self).prepare()
+        self.requests.append(self.request.uri)
+
+class HtmlDiscoveryHandler(CountingDiscoveryHandler):
+    # a component listing capabilities only as links
+    def _respond_capability_links(self):
+        self._respond_page("links", "text/html", self._render_capability_links)
+
+def run_discovery_server(scheduler, cache, discovery=mplane.component.DiscoveryHandler):
+    tls = mplane.tls.TlsState(None)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    started = threading.Event()
+    loops = []
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        args = {'scheduler': scheduler, 'tlsState': tls, 'config': None, 'cache': cache}
+        application = tornado.web.Application([
+            (r"/", mplane.component.MessagePostHandler,
+                {'scheduler': scheduler, 'tlsState': tls, 'cache': cache}),
+            (r"/capability", discovery, args),
+            (r"/capability/.*", discovery, args),
+        ])
+        tornado.httpserver.HTTPServer(application).add_sockets(sockets)
+        loops.append(tornado.ioloop.IOLoop.current())
+        started.set()
+        loops[0].start()
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return (sockets[0].getsockname()[1], loops[0])
+
+def test_DiscoveryCache():
+    scheduler = mplane.scheduler.Scheduler(None)
+    scheduler.add_service(test_service)
+    # as if the capabilities had been added a while ago
+    scheduler.capabilities_modified -= 5
+    cache = mplane.component.DiscoveryCache(scheduler)
+    (port, io_loop) = run_discovery_server(scheduler, cache)
+
+    pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+    try:
+        for path in ("/", "/capability"):
+            first = pool.request("GET", path)
+            assert_equal(first.status, 200)
+            assert_true(st_cap.get_token() in first.data.decode("utf-8"))
+            etag = first.headers["ETag"]
+
+            # repeat requests are answered from the cache, or with a 304
+            assert_equal(pool.request("GET", path).headers["ETag"], etag)
+            assert_equal(pool.request("GET", path,
+                            headers={"If-None-Match": etag}).status, 304)
+            assert_equal(pool.request("GET", path,
+                            headers={"If-Modified-Since": first.headers["Last-Modified"]}).status, 304)
+            assert_equal(pool.request("GET", path,
+                            headers={"If-None-Match": '"stale"'}).status, 200)
+
+        # adding a service invalidates the cached pages
+        other_cap = create_test_capability()
+        other_cap.add_result_column("octets.ip")
+        scheduler.add_service(SchedulerTestService(other_cap))
+        # (keeping the second of the change from ending during the test)
+        scheduler.capabilities_modified += 1
+        changed = pool.request("GET", "/capability", headers={"If-None-Match": etag})
+        assert_equal(changed.status, 200)
+        assert_true(other_cap.get_token() in changed.data.decode("utf-8"))
+        assert_true(changed.headers["ETag"] != etag)
+
+        # Last-Modified is only sent once that second is over, as a
+        # later change in the same second would not move it
+        assert_false("Last-Modified" in changed.headers)
+        assert_equal(pool.request("GET", "/capability",
+                        headers={"If-Modified-Since": first.headers["Last-Modified"]}).status, 200)
+
+        # capabilities are linked to the host each client asked for
+        for host in ("one.example:8890", "two.example:8890", "one.example:8890"):
+            res = pool.request("GET", "/capability?format=json", headers={"Host": host})
+            env = mplane.model.parse_json(res.data.decode("utf-8"))
+            links = dict((cap.get_token(), cap.get_link()) for cap in env.messages())
+            assert_equal(links[other_cap.get_token()], "http://" + host + "/")
+        assert_false(scheduler.capability_for_key(other_cap.get_token()).get_link())
+    finally:
+        pool.close()
+        io_loop.add_callback(io_loop.stop)
+
+def test_DiscoveryHandler_envelope():
+    import mplane.client
+    scheduler = mplane.scheduler.Scheduler(None)
+    caps = []
+    for i in range(5):
+        cap = create_test_capability()
+        cap.set_label("test-envelope-" + str(i % 2))
+        cap.add_parameter("source.port", str(i))
+        scheduler.add_service(SchedulerTestService(cap))
+        caps.append(cap)
+    cache = mplane.component.DiscoveryCache(scheduler)
+    (port, io_loop) = run_discovery_server(scheduler, cache, CountingDiscoveryHandler)
+
+    def listing(query="", headers=None):
+        res = pool.request("GET", "/capability" + query, headers=headers)
+        assert_equal(res.headers["Content-Type"], "application/x-mplane+json")
+        env = mplane.model.parse_json(res.data.decode("utf-8"))
+        return [cap.get_token() for cap in env.messages()]
+
+    pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+    try:
+        tokens = [cap.get_token() for cap in caps]
+        assert_equal(listing(headers={"Accept": "application/x-mplane+json"}), tokens)
+        assert_equal(listing(headers={"Accept": "text/html;q=0.5, application/x-mplane+json;q=0.8"}), tokens)
+        for accept in ("application/x-mplane+json;q=0", "text/html, application/x-mplane+json;q=0.5",
+                       "*/*", "text/*, application/x-mplane+json; q=0.2"):
+            res = pool.request("GET", "/capability", headers={"Accept": accept})
+            assert_true(res.headers["Content-Type"].startswith("text/html"))
+        assert_equal(listing("?format=json"), tokens)
+        assert_equal(listing("?format=json&label=test-envelope-1"), tokens[1::2])
+        assert_equal(listing("?format=json&offset=1&limit=2"), tokens[1:3])
+        assert_equal(listing("?format=json&schema=" + caps[0]._schema_hash()[:8]), tokens)
+        assert_equal(listing("?format=json&schema=x"), [])
+        assert_equal(pool.request("GET", "/capability?format=json&limit=0").status, 400)
+
+        # the client retrieves all capabilities in one request
+        client = mplane.client.HttpInitiatorClient(mplane.tls.TlsState(None))
+        del CountingDiscoveryHandler.requests[:]
+        client.retrieve_capabilities("http://127.0.0.1:%u/capability" % port)
+        assert_equal(sorted(client.capability_tokens()), sorted(tokens))
+        assert_equal(len(CountingDiscoveryHandler.requests), 1)
+    finally:
+        pool.close()
+        io_loop.add_callback(io_loop.stop)
+
+    # and crawls components listing links to capabilities
+    (port, io_loop) = run_discovery_server(scheduler, cache, HtmlDiscoveryHandler)
+    try:
+        client = mplane.client.HttpInitiatorClient(mplane.tls.TlsState(None))
+        del CountingDiscoveryHandler.requests[:]
+        client.retrieve_capabilities("http://127.0.0.1:%u/capability" % port)
+        assert_equal(sorted(client.capability_tokens()), sorted(tokens))
+        assert_equal(len(CountingDiscoveryHandler.requests), 1 + len(caps))
+    finally:
+        io_loop.add_callback(io_loop.stop)
+
 #
 # mplane.utils tests
 #
@@ -445,3 +1538,262 @@ def test_split_stmt_list():
     caps.append(cap)
     # using repr as no __eq__ methos is implemented fot capability objects
     assert_equal(repr(res[0]), repr(caps[0]))
+
+#
+# mplane.exporter tests
+#
+
+import mplane.exporter
+import mplane.metrics
+
+def test_exporter_format_for_path():
+    assert_equal(mplane.exporter.format_for_path("out.csv"), "csv")
+    assert_equal(mplane.exporter.format_for_path("out.tsv.gz"), "tsv")
+    assert_equal(mplane.exporter.format_for_path("out.ndjson"), "ndjson")
+    assert_equal(mplane.exporter.format_for_path("out.json"), None)
+
+def test_ResultWriter_csv():
+    out = io.StringIO()
+    writer = mplane.exporter.ResultWriter(out, mplane.exporter.FORMAT_CSV)
+    assert_equal(writer.write_message(st_res), 1)
+    # the same result is only written once
+    assert_equal(writer.write_message(st_res), 0)
+    lines = out.getvalue().splitlines()
+    assert_equal(lines[0], ",".join(list(st_res.parameter_names()) +
+                                    list(st_res.result_column_names())))
+    assert_equal(lines[1], "10.0.27.2,10.0.37.2,33155,192307,55166,58220,*")
+
+def test_ResultWriter_ndjson_envelope():
+    env = mplane.model.Envelope(token=st_spec.get_token())
+    env.append_message(st_res)
+    out = io.StringIO()
+    writer = mplane.exporter.ResultWriter(out, mplane.exporter.FORMAT_NDJSON)
+    writer.write_message(env)
+    row = json.loads(out.getvalue().splitlines()[0])
+    assert_equal(row["delay.twoway.icmp.us.min"], "33155")
+    assert_equal(row["token"], st_res.get_token())
+
+def test_export_messages_gzip():
+    import gzip
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), "results.tsv.gz")
+    assert_equal(mplane.exporter.export_messages(path, [st_res]), 1)
+    with gzip.open(path, "rt") as f:
+        assert_equal(len(f.read().splitlines()), 2)
+
+#
+# mplane.metrics tests
+#
+
+def test_metrics_render():
+    counter = mplane.metrics.Counter("test_events_total", "Test events", ("kind",))
+    histogram = mplane.metrics.Histogram("test_latency_seconds", "Test latency",
+                                         buckets=(0.1, 1))
+    try:
+        # nothing is recorded while metrics are disabled
+        counter.inc("a")
+        assert_equal(counter.value("a"), 0)
+
+        mplane.metrics.enable()
+        counter.inc("a")
+        counter.inc("b", amount=2)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        text = mplane.metrics.render()
+        assert_true('test_events_total{kind="a"} 1\n' in text)
+        assert_true('test_events_total{kind="b"} 2\n' in text)
+        assert_true('test_latency_seconds_bucket{le="0.1"} 1\n' in text)
+        assert_true('test_latency_seconds_bucket{le="+Inf"} 2\n' in text)
+        assert_true('test_latency_seconds_count 2\n' in text)
+        assert_true('# TYPE mplane_threads gauge\n' in text)
+    finally:
+        mplane.metrics.enable(False)
+        mplane.metrics.remove(counter)
+        mplane.metrics.remove(histogram)
+
+def test_metrics_redeclare():
+    # a gauge declared again replaces the first, rendered once
+    first = mplane.metrics.Gauge("test_depth", "Test depth", lambda: 1)
+    second = mplane.metrics.Gauge("test_depth", "Test depth", lambda: 2)
+    try:
+        text = mplane.metrics.render()
+        assert_equal(text.count("# TYPE test_depth gauge\n"), 1)
+        assert_true("test_depth 2\n" in text)
+        # removing the replaced gauge leaves its successor in place
+        mplane.metrics.remove(first)
+        assert_true("test_depth 2\n" in mplane.metrics.render())
+    finally:
+        mplane.metrics.remove(second)
+    assert_false("test_depth" in mplane.metrics.render())
+
+def test_metrics_configure():
+    assert_equal(mplane.metrics.configure(None), None)
+    assert_equal(mplane.metrics.configure({"Metrics": {"enabled": False}}), None)
+    assert_false(mplane.metrics.enabled())
+    try:
+        assert_equal(mplane.metrics.configure({"Metrics": {"enabled": True}}),
+                     mplane.metrics.DEFAULT_METRICS_PATH)
+        assert_true(mplane.metrics.enabled())
+    finally:
+        mplane.metrics.enable(False)
+
+def run_metrics_server(access, handler=mplane.metrics.MetricsHandler):
+    tls = mplane.tls.TlsState(None)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    started = threading.Event()
+    loops = []
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        application = tornado.web.Application([
+            (r"/metrics", handler, {'tlsState': tls, 'access': access}),
+        ])
+        tornado.httpserver.HTTPServer(application).add_sockets(sockets)
+        loops.append(tornado.ioloop.IOLoop.current())
+        started.set()
+        loops[0].start()
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return (sockets[0].getsockname()[1], loops[0])
+
+def test_MetricsHandler_access():
+    # the peer has no identity in the metrics roles
+    config = {"TLS": {}, "Access": {"Roles": {"ops": ["org.mplane.Ops"]}},
+              "Metrics": {"roles": ["ops"]}}
+    for (access, status) in ((mplane.azn.EndpointAccess(None, "Metrics"), 200),
+                             (mplane.azn.EndpointAccess(config, "Metrics"), 403)):
+        (port, io_loop) = run_metrics_server(access)
+        try:
+            res = urllib3.HTTPConnectionPool("127.0.0.1", port).request("GET", "/metrics")
+            assert_equal(res.status, status)
+        finally:
+            io_loop.add_callback(io_loop.stop)
+
+#
+# mplane.profiling tests
+#
+
+import mplane.profiling
+
+def test_profiling_hooks():
+    import tempfile
+    spool = tempfile.mkdtemp()
+    assert_equal(mplane.profiling.configure({"Profiling": {"enabled": False}}), None)
+    try:
+        path = mplane.profiling.configure({"Profiling": {"enabled": True,
+                                                         "sample_rate": 1,
+                                                         "spool": spool}})
+        assert_equal(path, mplane.profiling.DEFAULT_DIAGNOSTICS_PATH)
+
+        job = mplane.scheduler.Job(test_service, st_spec)
+        job._run()
+        mplane.model.parse_json(mplane.model.unparse_json(job.get_reply()))
+
+        label = test_service.capability().get_label()
+        diagnostics = mplane.profiling.diagnostics()
+        timing = diagnostics["timings"][mplane.profiling.JOB][label]
+        assert_equal(timing["count"], 1)
+        assert_true("cpu_total" in timing)
+        codecs = diagnostics["timings"][mplane.profiling.CODEC]
+        for name in ("parse_json", "unparse_json", "to_dict"):
+            assert_true(codecs[name]["count"] >= 1)
+        assert_true("function calls" in diagnostics["profiles"][label])
+
+        mplane.profiling.flush()
+        spooled = os.listdir(spool)
+        assert_true("jobs.ndjson" in spooled)
+        with open(os.path.join(spool, "jobs.ndjson")) as f:
+            assert_equal(json.loads(f.readline())["service"], label)
+        assert_true(any(f.endswith(".prof") for f in spooled))
+    finally:
+        mplane.profiling.reset()
+
+    # no hooks, no spans
+    assert_true(mplane.profiling.span(mplane.profiling.JOB, "x") is
+                mplane.profiling.span(mplane.profiling.CODEC, "y"))
+
+def test_DiagnosticsHandler_access():
+    # diagnostics are closed to TLS peers unless roles are configured,
+    # and served to loopback peers only without TLS
+    config = {"TLS": {}, "Access": {"Roles": {}}}
+    for (access, status) in ((mplane.azn.EndpointAccess(None, "Profiling",
+                                                        open_default=False), 200),
+                             (mplane.azn.EndpointAccess(config, "Profiling",
+                                                        open_default=False), 403)):
+        (port, io_loop) = run_metrics_server(access, mplane.profiling.DiagnosticsHandler)
+        try:
+            res = urllib3.HTTPConnectionPool("127.0.0.1", port).request("GET", "/metrics")
+            assert_equal(res.status, status)
+        finally:
+            io_loop.add_callback(io_loop.stop)
+
+def test_json_async():
+    res = mplane.model.Result(specification=st_spec)
+    res.set_when("2017-12-24 22:18:42.993000 ... 2017-12-24 22:19:42.991000")
+    for i in range(mplane.model.CODEC_OFFLOAD_ROWS):
+        res.set_result_value("packets.lost", i, i)
+
+    # large messages round-trip through the codec thread pool
+    async def roundtrip(msg):
+        return await mplane.model.parse_json_async(
+                        await mplane.model.unparse_json_async(msg))
+    loop = asyncio.new_event_loop()
+    try:
+        copied = loop.run_until_complete(roundtrip(res))
+        assert_equal(copied.count_result_rows(), mplane.model.CODEC_OFFLOAD_ROWS)
+        assert_equal(loop.run_until_complete(roundtrip(st_receipt)).get_token(),
+                     st_receipt.get_token())
+    finally:
+        loop.close()
+
+#
+# mplane.client tests
+#
+
+import mplane.client
+
+def test_HttpListenerClient_long_poll():
+    sock = tornado.netutil.bind_sockets(0, "127.0.0.1")[0]
+    port = sock.getsockname()[1]
+    sock.close()
+    config = {"Client": {"Listener": {"port": str(port), "interfaces": ["127.0.0.1"]}}}
+    clients = []
+    def start():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        clients.append(mplane.client.HttpListenerClient(config, tls_state=mplane.tls.TlsState(None)))
+    t = threading.Thread(target=start)
+    t.start()
+    t.join()
+    client = clients[0]
+
+    cap = create_test_capability()
+    cap.set_label("test-long-poll")
+    pool = urllib3.HTTPConnectionPool("127.0.0.1", port)
+    try:
+        env = mplane.model.Envelope()
+        env.append_message(cap)
+        assert_equal(pool.urlopen("POST", "/register/capability",
+                                  body=mplane.model.unparse_json(env).encode("utf-8"),
+                                  headers={"content-type": "application/x-mplane+json"}).status, 200)
+
+        # an idle long poll is answered when it times out
+        start = time.monotonic()
+        res = pool.request("GET", "/show/specification?wait=0.5")
+        assert_true(time.monotonic() - start >= 0.4)
+        assert_equal(len(mplane.model.parse_json(res.data.decode("utf-8"))), 0)
+
+        # and a waiting one as soon as a specification is queued
+        def invoke():
+            time.sleep(0.3)
+            client.invoke_capability("test-long-poll", "now + 1s / 1s",
+                                     {"destination.ip4": "10.0.50.1"})
+        threading.Thread(target=invoke).start()
+        start = time.monotonic()
+        res = pool.request("GET", "/show/specification?wait=10")
+        assert_true(time.monotonic() - start < 5)
+        specs = list(mplane.model.parse_json(res.data.decode("utf-8")).messages())
+        assert_equal(len(specs), 1)
+        assert_true(isinstance(specs[0], mplane.model.Specification))
+        assert_equal(client._outgoing_waiters, {})
+    finally:
+        pool.close()
+        client._io_loop.add_callback(client._io_loop.stop)